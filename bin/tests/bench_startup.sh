@@ -0,0 +1,19 @@
+#! /bin/bash
+
+# Benchmark the startup time of each command by printing its help message,
+# which is dominated by importing modules. The best of several runs is shown.
+# Usage: bench_startup.sh [n_repeat]
+
+BIN_DIR=$(cd $(dirname $0)/.. && pwd)
+N_REPEAT=${1:-3}
+TIMEFORMAT=%R
+
+for cmd in $BIN_DIR/*; do
+    [ -f $cmd ] || continue
+    times=''
+    for i in $(seq $N_REPEAT); do
+        times="$times $( { time python $cmd -h > /dev/null 2>&1; } 2>&1 )"
+    done
+    echo $(basename $cmd) $times | awk '{best=$2; for (i=3; i<=NF; i++) if ($i < best) best=$i;
+                                         printf "%-16s %6.2fs\n", $1, best}'
+done
@@ -0,0 +1,7 @@
+#! /bin/bash
+
+# list entries of the activation cache
+db_cache -list
+
+# evict the least recently used entries until the cache size does not exceed 1GB
+db_cache -prune 1 -list
@@ -0,0 +1,7 @@
+#! /bin/bash
+
+# print layers of a DNN without loading its weights
+db_info Vgg19_bn
+
+# print information of a stimulus file
+db_info $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv
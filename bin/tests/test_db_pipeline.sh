@@ -0,0 +1,26 @@
+#! /bin/bash
+
+TMP_DIR=~/.dnnbrain_tmp
+mkdir -p $TMP_DIR
+
+# dnn_act -> dnn_pool -> db_hrf/db_encode/db_corr in one process
+cat > $TMP_DIR/db_pipeline.json <<END
+{
+    "budget": 512,
+    "stages": [
+        {"name": "act", "op": "act", "net": "AlexNet", "layer": ["conv5", "fc3"],
+         "stim": "$DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv"},
+        {"name": "pool", "op": "pool", "meth": "max", "out": "$TMP_DIR/db_pipeline_pool.act.h5"},
+        {"name": "hrf", "op": "hrf", "layer": ["fc3"], "tr": 2, "n_vol": 10,
+         "stim": "$DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv", "out": "$TMP_DIR/db_pipeline_hrf.act.h5"},
+        {"name": "encode", "op": "encode", "input": "pool", "anal": "uv", "model": "glm", "iteraxis": "channel",
+         "resp": "$DNNBRAIN_DATA/test/PHA1.roi.h5", "roi": ["PHA1_R"], "out": "$TMP_DIR/db_pipeline_encode"},
+        {"name": "corr", "op": "corr", "input": "pool",
+         "resp": "$DNNBRAIN_DATA/test/PHA1.roi.h5", "out": "$TMP_DIR/db_pipeline_corr"}
+    ]
+}
+END
+db_pipeline -pipe $TMP_DIR/db_pipeline.json
+
+# spill the intermediate activation to the disk
+db_pipeline -pipe $TMP_DIR/db_pipeline.json -budget 0 -spill_dir $TMP_DIR/db_pipeline_spill
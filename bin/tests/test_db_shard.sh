@@ -0,0 +1,10 @@
+#! /bin/bash
+
+TMP_DIR=~/.dnnbrain_tmp
+mkdir -p $TMP_DIR
+
+# store image stimuli into 1MB tar shards
+db_shard -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -size 1 -out $TMP_DIR/db_shard_image.stim.csv
+
+# extract DNN activation from the sharded stimuli
+dnn_act -net AlexNet -layer conv5 fc3 -stim $TMP_DIR/db_shard_image.stim.csv -out $TMP_DIR/db_shard_image.act.h5
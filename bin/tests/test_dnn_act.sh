@@ -11,3 +11,28 @@ dnn_act -net AlexNet -dmask $DNNBRAIN_DATA/test/alexnet.dmask.csv -stim $DNNBRAI
 
 # extract DNN activation from image with -layer -chn
 dnn_act -net AlexNet -layer conv5 fc3 -chn 1 3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -out $TMP_DIR/dnn_act_layer_chn.act.h5
+
+# extract DNN activation from image with -stream
+dnn_act -net AlexNet -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -stream -out $TMP_DIR/dnn_act_stream.act.h5
+
+# continue the extraction recorded in the output file
+dnn_act -net AlexNet -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -resume -out $TMP_DIR/dnn_act_stream.act.h5
+
+# extract DNN activation by 4 processes
+dnn_act -net AlexNet -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -n_proc 4 -stream -out $TMP_DIR/dnn_act_n_proc.act.h5
+
+# store DNN activation as quantized uint8
+dnn_act -net AlexNet -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -dtype uint8 -out $TMP_DIR/dnn_act_uint8.act.h5
+
+# decode JPEG images at the full resolution
+dnn_act -net AlexNet -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -exact -out $TMP_DIR/dnn_act_exact.act.h5
+
+# extract DNN activation by the compiled DNN
+dnn_act -net Vgg19_bn -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -compile -out $TMP_DIR/dnn_act_compile.act.h5
+
+# extract DNN activation by the quantized DNN
+dnn_act -net AlexNet -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -quantize all -n_calib 16 -out $TMP_DIR/dnn_act_quantize.act.h5
+
+# store DNN activation in channel-major chunks compressed by lzf
+dnn_act -net AlexNet -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -layout chn -compress lzf -out $TMP_DIR/dnn_act_layout.act.h5
+dnn_act -net AlexNet -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -layout chn -compress lzf -stream -out $TMP_DIR/dnn_act_layout_stream.act.h5
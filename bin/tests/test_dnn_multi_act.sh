@@ -0,0 +1,10 @@
+#! /bin/bash
+
+TMP_DIR=~/.dnnbrain_tmp
+mkdir -p $TMP_DIR
+
+# extract DNN activation of AlexNet and Vgg11 from image with -layer
+dnn_multi_act -net AlexNet Vgg11 -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -out $TMP_DIR/dnn_multi_act_alexnet.act.h5 $TMP_DIR/dnn_multi_act_vgg11.act.h5
+
+# extract DNN activation of AlexNet and VggFace from video with dmask in the streaming mode
+dnn_multi_act -net AlexNet VggFace -dmask $DNNBRAIN_DATA/test/alexnet.dmask.csv $DNNBRAIN_DATA/test/vggface.dmask.csv -stim $DNNBRAIN_DATA/test/video/sub-CSI1_ses-01_imagenet.stim.csv -stream -out $TMP_DIR/dnn_multi_act_alexnet_video.act.h5 $TMP_DIR/dnn_multi_act_vggface_video.act.h5
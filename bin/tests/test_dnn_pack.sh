@@ -0,0 +1,10 @@
+#! /bin/bash
+
+TMP_DIR=~/.dnnbrain_tmp
+mkdir -p $TMP_DIR
+
+# pack image stimuli for AlexNet
+dnn_pack -net AlexNet -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -out $TMP_DIR/dnn_pack_image.stim.csv
+
+# extract DNN activation from the packed stimuli
+dnn_act -net AlexNet -layer conv5 fc3 -stim $TMP_DIR/dnn_pack_image.stim.csv -out $TMP_DIR/dnn_pack_image.act.h5
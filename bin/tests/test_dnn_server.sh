@@ -0,0 +1,31 @@
+#! /bin/bash
+
+TMP_DIR=~/.dnnbrain_tmp
+mkdir -p $TMP_DIR
+export DNNBRAIN_SOCKET=$TMP_DIR/dnn_server.sock
+
+# start a server with AlexNet loaded
+dnn_server -net AlexNet &
+server_pid=$!
+while ! [ -S $DNNBRAIN_SOCKET ]; do sleep 1; done
+
+# concurrent extractions are delegated to the server and batched together
+dnn_act -net AlexNet -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -out $TMP_DIR/dnn_server1.act.h5 &
+pid1=$!
+dnn_act -net AlexNet -layer conv5 -chn 1 3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -pool max -out $TMP_DIR/dnn_server2.act.h5 &
+pid2=$!
+wait $pid1 $pid2
+
+# dnn_topstim and dnn_view delegate too
+dnn_topstim -net AlexNet -top 3 -layer fc3 -chn 1 2 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -out $TMP_DIR/dnn_server_top_stim
+dnn_view -net AlexNet -layer conv5 -chn 60 125 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -out $TMP_DIR/
+
+# the server runs DNNs in the eager mode, so -compile extracts in this process
+dnn_act -net AlexNet -layer conv5 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -compile -out $TMP_DIR/dnn_server_compile.act.h5
+
+# extract in this process even if the server is running
+dnn_act -net AlexNet -layer conv5 fc3 -stim $DNNBRAIN_DATA/test/image/sub-CSI1_ses-01_imagenet.stim.csv -local -out $TMP_DIR/dnn_server_local.act.h5
+
+# stop the server
+dnn_server -stop
+wait $server_pid
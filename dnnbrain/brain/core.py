@@ -1,7 +1,6 @@
 import numpy as np
 
 from dnnbrain.io.fileio import RoiFile
-from dnnbrain.dnn.base import UnivariateMapping, MultivariateMapping
 
 
 class ROI:
@@ -379,6 +378,8 @@ class BrainEncoder:
         scoring : str or callable
             the method to evaluate the predictions on the test set.
         """
+        from dnnbrain.dnn.base import UnivariateMapping, MultivariateMapping
+
         if map_type is None:
             return
         elif map_type == 'uv':
@@ -465,12 +466,14 @@ class BrainEncoder:
 
                <br/>
         """
+        from dnnbrain.dnn.base import UnivariateMapping
+
         _, n_meas = self.brain_activ.shape
 
         encode_dict = dict()
         for layer in dnn_activ.layers:
             # get DNN activation and reshape it to 3D
-            activ = dnn_activ.get(layer)
+            activ = np.asarray(dnn_activ.get(layer))
             n_stim, n_chn, n_row, n_col = activ.shape
             n_row_col = n_row * n_col
             activ = activ.reshape((n_stim, n_chn, n_row_col))
@@ -492,12 +495,12 @@ class BrainEncoder:
             else:
                 encode_dict[layer] = {
                     'score': np.zeros((n_iter, n_meas, self.mapper.cv)),
-                    'model': np.zeros((n_iter, n_meas), dtype=np.object),
+                    'model': np.zeros((n_iter, n_meas), dtype=object),
                 }
 
             # start encoding
             if isinstance(self.mapper, UnivariateMapping):
-                encode_dict[layer]['location'] = np.zeros((n_iter, n_meas, 3), dtype=np.int)
+                encode_dict[layer]['location'] = np.zeros((n_iter, n_meas, 3), dtype=int)
 
                 # start iteration
                 for iter_idx in range(n_iter):
@@ -645,6 +648,8 @@ class BrainDecoder:
         scoring : str or callable
             the method to evaluate the predictions on the test set.
         """
+        from dnnbrain.dnn.base import UnivariateMapping, MultivariateMapping
+
         if map_type is None:
             return
         elif map_type == 'uv':
@@ -706,7 +711,7 @@ class BrainDecoder:
         decode_dict = dict()
         for layer in dnn_activ.layers:
             # get DNN activation
-            activ = dnn_activ.get(layer)
+            activ = np.asarray(dnn_activ.get(layer))
             n_stim, *shape = activ.shape
             activ = activ.reshape((n_stim, -1))
 
@@ -527,6 +527,7 @@ class SynthesisImage(Algorithm):
         """
         # Hook the selected layer
         handle = self.register_hooks(unit)
+        layer, _ = self.get_layer()
 
         # prepare initialized image
         if init_image is None:
@@ -554,7 +555,9 @@ class SynthesisImage(Algorithm):
                     img_out.save(pjoin(save_path, 'synthesized_image_iter{}.jpg'.format(i)))
 
             # Forward pass layer by layer until the target layer to trigger the hook.
-            self.dnn.model(self.optimal_image)
+            # The layers after the target layer are skipped.
+            with self.dnn.truncate(layer):
+                self.dnn(self.optimal_image)
 
             # computer loss
             loss = self.activ_loss + self.regular_lambda * self.regular_metric()
@@ -576,7 +579,8 @@ class SynthesisImage(Algorithm):
             self.precondition_metric(self.GB_radius, lr)
            
         # trigger hook for the activ_loss of the final synthesized image
-        self.dnn.model(self.optimal_image)
+        with self.dnn.truncate(layer):
+            self.dnn(self.optimal_image)
         # calculate regular_loss of the final synthesized image
         self.regular_metric()
                 
@@ -716,6 +720,7 @@ class MaskedImage(Algorithm):
         #define hooks for recording act_loss
         self.activ_trace = [] 
         handle = self.register_hooks()
+        layer, _ = self.get_layer()
         
         #transpose axis
         if len(img.shape) == 3 and img.shape[0] == 3:        
@@ -736,7 +741,8 @@ class MaskedImage(Algorithm):
 
         #prepare test img and get base acivation
         test_image = self.prepare_test(masked_img)
-        self.dnn.model(test_image)
+        with self.dnn.truncate(layer):
+            self.dnn(test_image)
         activation = base_line = self.activ.detach().numpy()
 
         print('Baseline:', base_line)
@@ -750,7 +756,8 @@ class MaskedImage(Algorithm):
             fm = gaussian_filter(mask.astype(float), sigma=self.filter_sigma)
             masked_img = fm * img + (1 - fm) * img.mean()
             test_image = self.prepare_test(masked_img)
-            self.dnn.model(test_image)
+            with self.dnn.truncate(layer):
+                self.dnn(test_image)
             activation  = - self.activ_loss.detach().numpy()
             print('Activation:', activation)
             count += 1
@@ -1275,7 +1282,7 @@ class EmpiricalReceptiveField:
         empirical_rf_size = np.sqrt(empirical_rf_area)
         return empirical_rf_size
 
-    def compute(self, stimuli, save_path=None):
+    def compute(self, stimuli, save_path=None, draft=True):
         """
         Compute empirical receptive field based on input stimulus.
 
@@ -1286,6 +1293,10 @@ class EmpiricalReceptiveField:
         save_path : str
             Path to save single image's receptive field.
             If None, it will not be saved.
+        draft : bool
+            If true, JPEG images are decoded at the smallest scale which is
+            still not smaller than the input image size of the DNN.
+            Otherwise, they are decoded at the full resolution as before.
             
         Return
         ---------
@@ -1297,8 +1308,12 @@ class EmpiricalReceptiveField:
         if not isinstance(stimuli, Stimulus):
             raise TypeError('The input stimuli must be an instance of Stimulus!')
         images = np.zeros((len(stimuli.get('stimID')),3,224,224), dtype=np.uint8)
+        img_size = self.engine.dnn.img_size
         for idx, img_id in enumerate(stimuli.get('stimID')):
-            image = Image.open(pjoin(stimuli.header['path'], img_id)).convert('RGB')
+            image = Image.open(pjoin(stimuli.header['path'], img_id))
+            if draft:
+                image.draft(None, (img_size[1], img_size[0]))
+            image = image.convert('RGB')
             image = np.asarray(image).transpose(2,0,1)
             image = ip.resize(image, self.engine.dnn.img_size)
             images[idx] = image
@@ -1,3 +1,4 @@
+import io
 import os
 import cv2
 import copy
@@ -8,17 +9,14 @@ import numpy as np
 from PIL import Image
 from os.path import join as pjoin
 from copy import deepcopy
-from sklearn.decomposition import PCA
-from sklearn.linear_model import LinearRegression, LogisticRegression, Lasso
-from sklearn.svm import SVC
-from sklearn.model_selection import StratifiedKFold, KFold, cross_val_score
-from sklearn.metrics import pairwise_distances, confusion_matrix
-from sklearn.metrics import r2_score, explained_variance_score
-from scipy.signal import periodogram
-from scipy.stats import pearsonr
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from torchvision import transforms
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
+from dnnbrain.utils.util import gen_segments
 
-DNNBRAIN_MODEL = pjoin(os.environ['DNNBRAIN_DATA'], 'models')
+# scikit-learn and SciPy take seconds to import,
+# so they are imported by the functions using them.
 
 
 def correlation_score(y_true, y_pred, multioutput='uniform_average'):
@@ -45,6 +43,8 @@ def correlation_score(y_true, y_pred, multioutput='uniform_average'):
         a single value if 'multioutput' is 'uniform_average'
         a ndarray if 'multioutput' is 'raw_values'
     """
+    from scipy.stats import pearsonr
+
     # check y
     if y_true.ndim == 1:
         y_true = y_true[:, None]
@@ -80,6 +80,8 @@ def correlation_score(y_true, y_pred, multioutput='uniform_average'):
 
 
 def correlation_scorer(regressor, X, y):
+    from scipy.stats import pearsonr
+
     y_preds = regressor.predict(X)
     return pearsonr(y, y_preds)[0]
 
@@ -112,8 +114,10 @@ def array_statistic(arr, method, axis=None, keepdims=False):
 
     Parameters
     ----------
-    arr : ndarray
-        A numpy array.
+    arr : ndarray, tensor
+        A numpy array or a PyTorch tensor.
+        A tensor is computed by PyTorch on its own device,
+        with the same semantics as numpy.
     method : str
         Feature extraction method
     axis : int, tuple
@@ -125,9 +129,12 @@ def array_statistic(arr, method, axis=None, keepdims=False):
 
     Return
     ------
-    arr : ndarray   
+    arr : ndarray, tensor
         Extracted statistic.
     """
+    if isinstance(arr, torch.Tensor):
+        return _tensor_statistic(arr, method, axis, keepdims)
+
     if method == 'max':
         arr = np.max(arr, axis, keepdims=keepdims)
     elif method == 'mean':
@@ -144,6 +151,60 @@ def array_statistic(arr, method, axis=None, keepdims=False):
     return arr
 
 
+def _tensor_statistic(arr, method, axis=None, keepdims=False):
+    """
+    extract statistic of a tensor in the same way as array_statistic
+
+    Parameters
+    ----------
+    arr : tensor
+        A PyTorch tensor.
+    method : str
+        Feature extraction method
+    axis : int, tuple
+        None or int or tuple of ints.
+    keepdims : bool
+        Keep the axis which is reduced.
+
+    Return
+    ------
+    arr : tensor
+        Extracted statistic.
+    """
+    if axis is None:
+        axis = tuple(range(arr.ndim))
+    elif isinstance(axis, int):
+        axis = (axis,)
+    axis = tuple(ax % arr.ndim for ax in axis)
+
+    if method == 'max':
+        arr = torch.amax(arr, axis, keepdims)
+    elif method == 'mean':
+        arr = torch.mean(arr, axis, keepdims)
+    elif method == 'median':
+        # move the axes to the end and flatten them
+        # median is the mean of the two middle values as numpy does
+        others = [ax for ax in range(arr.ndim) if ax not in axis]
+        shape = [1 if ax in axis else arr.shape[ax] for ax in range(arr.ndim)]
+        arr = arr.permute(*others, *axis).reshape(*[arr.shape[ax] for ax in others], -1)
+        arr = arr.sort(-1)[0]
+        n = arr.shape[-1]
+        arr = (arr[..., (n - 1) // 2] + arr[..., n // 2]) / 2
+        if keepdims:
+            arr = arr.reshape(shape)
+    elif method in ('L1', 'L2'):
+        # numpy computes matrix norms for 2 axes and vector norms otherwise
+        ord = 1 if method == 'L1' else 2
+        if len(axis) == 2:
+            arr = torch.linalg.matrix_norm(arr, ord, axis, keepdims)
+        else:
+            arr = torch.linalg.vector_norm(arr, ord, axis, keepdims)
+    else:
+        raise ValueError('Not supported method:', method)
+
+    return arr
+
+
 class ImageProcessor:
     """
     Metrics for pre-processing pictures to further DNN operations.
@@ -464,11 +525,162 @@ class ImageProcessor:
         return tv
 
 
+def gen_n_thread(n_thread=None):
+    """
+    Generate the number of threads which a stimulus set uses to load
+    multiple stimuli at once
+
+    Parameters
+    ----------
+    n_thread : int
+        The number of threads.
+        If is None, it is the CPU count in the main process, and the CPU count
+        divided by the number of workers in a DataLoader worker, so that the
+        workers don't oversubscribe the CPU cores.
+
+    Returns
+    -------
+    n_thread : int
+    """
+    if n_thread is None:
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            n_thread = os.cpu_count()
+        else:
+            n_thread = max(os.cpu_count() // worker_info.num_workers, 1)
+
+    return n_thread
+
+
+def assemble_batch(items, load, n_item, n_thread=1):
+    """
+    Load items into a batch tensor which is allocated once.
+    Items are loaded by a thread pool, since decoding and transforming
+    by PIL and cv2 release the GIL.
+
+    Parameters
+    ----------
+    items : iterable
+        Items to be loaded. It is iterated in the calling thread,
+        so it can be a generator which decodes items in order.
+    load : callable
+        Load an item as a tensor or a tuple of tensors (see TransformGroup).
+        All items must have the same shape.
+    n_item : int
+        The number of items
+    n_thread : int
+        The number of threads
+
+    Returns
+    -------
+    data : tensor, tuple
+        Loaded items with shape as (n_item, *item_shape)
+        If an item is a tuple of tensors, it is a tuple of such batches.
+    """
+    if n_item == 0:
+        return torch.zeros(0)
+
+    items = iter(items)
+    item = load(next(items))
+    if isinstance(item, tuple):
+        data = tuple(torch.empty((n_item, *x.shape), dtype=x.dtype) for x in item)
+    else:
+        data = torch.empty((n_item, *item.shape), dtype=item.dtype)
+
+    def put(idx, item):
+        if isinstance(data, tuple):
+            for batch, x in zip(data, item):
+                batch[idx] = x
+        else:
+            data[idx] = item
+
+    def fill(idx, item):
+        put(idx, load(item))
+
+    put(0, item)
+
+    if n_item == 1 or n_thread < 2:
+        for idx, item in enumerate(items, 1):
+            fill(idx, item)
+    else:
+        with ThreadPoolExecutor(n_thread) as executor:
+            # bound the number of items waiting to be loaded
+            futures = deque()
+            for idx, item in enumerate(items, 1):
+                futures.append(executor.submit(fill, idx, item))
+                if len(futures) > 2 * n_thread:
+                    futures.popleft().result()
+            for future in futures:
+                future.result()
+
+    return data
+
+
+def index_batch(data, indices):
+    """
+    Index a batch, which is a tensor or a tuple of tensors
+
+    Parameters
+    ----------
+    data : tensor, tuple
+        A batch from assemble_batch
+    indices : int, list, slice
+        Subscript indices of the first dimension
+
+    Returns
+    -------
+    data : tensor, tuple
+    """
+    if isinstance(data, tuple):
+        return tuple(batch[indices] for batch in data)
+    return data[indices]
+
+
+class TransformGroup:
+    """
+    Apply several transforms to the same image, so that the image is decoded
+    once for all of them. Transforms with the same representation are
+    regarded as the same one and applied once.
+    """
+    def __init__(self, transforms_list):
+        """
+        Parameters
+        ----------
+        transforms_list : list
+            Transforms for PIL images
+        """
+        self.transforms = []
+        self.indices = []  # the index of each input transform in self.transforms
+        reprs = []
+        for transform in transforms_list:
+            if repr(transform) not in reprs:
+                reprs.append(repr(transform))
+                self.transforms.append(transform)
+            self.indices.append(reprs.index(repr(transform)))
+
+    def __call__(self, image):
+        """
+        Parameters
+        ----------
+        image : PIL.Image
+
+        Returns
+        -------
+        images : tuple
+            Outputs of the distinct transforms
+        """
+        return tuple(transform(image) for transform in self.transforms)
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, self.transforms)
+
+
 class ImageSet:
     """
     Build a dataset to load image.
     """
-    def __init__(self, img_dir, img_ids, labels=None, transform=None):
+    def __init__(self, img_dir, img_ids, labels=None, transform=None, n_thread=None,
+                 draft=False):
         """
         Initialize ImageSet
 
@@ -482,12 +694,25 @@ class ImageSet:
             Each image's label.
         transform : callable function   
             Optional transform to be applied on a stimulus.
+            If is a TransformGroup, the image data is a tuple of tensors.
+        n_thread : int
+            The number of threads which decode and transform images
+            when getting multiple images at once.
+            Default is the CPU count shared by the DataLoader workers
+            (see gen_n_thread).
+        draft : bool
+            If true, JPEG images are decoded at a reduced scale which is still
+            not smaller than the size of the first Resize in the transform
+            (see gen_draft_size). It is much faster for large images,
+            but the output isn't bit-identical to the full decoding.
         """
+        self.n_thread = n_thread
         self.img_dir = img_dir
         self.img_ids = img_ids
         self.labels = np.ones(len(self.img_ids)) if labels is None else labels
         self.labels = np.int64(self.labels)
         self.transform = transforms.Compose([transforms.ToTensor()]) if transform is None else transform
+        self.draft = gen_draft_size(self.transform) if draft else None
 
     def __len__(self):
         """
@@ -522,25 +747,82 @@ class ImageSet:
             raise IndexError("only integer, slices (`:`) and list are valid indices")
 
         # load data
-        data = torch.zeros(0)
-        for img_id in tmp_ids:
-            image = Image.open(pjoin(self.img_dir, img_id)).convert('RGB')  # load image
-            image = self.transform(image)  # transform image
-            image = torch.unsqueeze(image, 0)
-            data = torch.cat((data, image))
-
-        if data.shape[0] == 1:
-            data = data[0]
+        data = assemble_batch(tmp_ids, self._load, len(tmp_ids),
+                              gen_n_thread(self.n_thread))
+
+        if len(tmp_ids) == 1:
+            data = index_batch(data, 0)
             labels = labels[0]  # len(labels) == 1
 
         return data, labels
 
+    def _load(self, img_id):
+        """
+        Load and transform an image
+
+        Parameters
+        ----------
+        img_id : str
+            The path of the image relative to img_dir
+
+        Returns
+        -------
+        image : tensor
+        """
+        image = Image.open(pjoin(self.img_dir, img_id))
+        if self.draft is not None:
+            image.draft(None, self.draft)
+        image = image.convert('RGB')  # load image
+        image = self.transform(image)  # transform image
+
+        return image
+
+
+def gen_draft_size(transform):
+    """
+    Get the size for decoding images in draft mode, with which a JPEG image is
+    decoded at the smallest scale (1/8, 1/4, 1/2 or 1) whose size is still
+    not smaller than the output of the transform's first Resize.
+
+    Parameters
+    ----------
+    transform : transforms.Compose, TransformGroup
+        The transform for PIL images
+
+    Returns
+    -------
+    size : tuple
+        (width, height) for PIL.Image.draft
+        It is None if the first transform isn't Resize, since the other
+        transforms (e.g. crops) need the image at the full resolution.
+    """
+    if isinstance(transform, TransformGroup):
+        # decode at the size needed by all the transforms
+        sizes = [gen_draft_size(t) for t in transform.transforms]
+        if None in sizes:
+            return None
+        return tuple(np.max(sizes, 0).tolist())
+    if not isinstance(transform, transforms.Compose) or len(transform.transforms) == 0:
+        return None
+    resize = transform.transforms[0]
+    if not isinstance(resize, transforms.Resize):
+        return None
+
+    size = [resize.size] if isinstance(resize.size, int) else list(resize.size)
+    if len(size) == 1:
+        # the smaller edge is matched to the size
+        return size[0], size[0]
+    return size[1], size[0]
+
 
 class VideoSet:
     """
     Dataset for video data
+    The video capture is opened lazily in each process, so the dataset
+    can be loaded by multiple workers of a DataLoader.
     """
-    def __init__(self, vid_file, frame_nums, labels=None, transform=None):
+    def __init__(self, vid_file, frame_nums, labels=None, transform=None, max_grab=100,
+                 n_thread=None):
         """
         Parameters
         ----------
@@ -551,8 +833,24 @@ class VideoSet:
         labels : list   
             Each frame's label.
         transform : pytorch transform
+            If is a TransformGroup, the frame data is a tuple of tensors.
+        max_grab : int
+            Frames are decoded sequentially, and frames not of interest are
+            skipped by grabbing them without retrieving.
+            Seek only when going backward or forward by more than max_grab frames,
+            because seeking decodes from the previous keyframe.
+        n_thread : int
+            The number of threads which transform frames when getting multiple
+            frames at once. Frames are still decoded in order by one thread.
+            Default is the CPU count shared by the DataLoader workers
+            (see gen_n_thread).
         """
-        self.vid_cap = cv2.VideoCapture(vid_file)
+        self.n_thread = n_thread
+        self.vid_file = vid_file
+        self.max_grab = max_grab
+        self._vid_cap = None
+        self._pid = None  # the process which opens the video capture
+        self._next_num = 1  # the sequence number of the frame read next
         self.frame_nums = frame_nums
         self.labels = np.ones(len(self.frame_nums)) if labels is None else labels
         self.labels = np.int64(self.labels)
@@ -588,19 +886,13 @@ class VideoSet:
             raise IndexError("only integer, slices (`:`) and list are valid indices")
 
         # load data
-        data = torch.zeros(0)
-        for frame_num in tmp_nums:
-            # get frame
-            self.vid_cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num-1)
-            _, frame = self.vid_cap.read()
-            frame = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-
-            frame = self.transform(frame)  # transform frame
-            frame = torch.unsqueeze(frame, 0)
-            data = torch.cat((data, frame))
-
-        if data.shape[0] == 1:
-            data = data[0]
+        # decode frames in order while transforming them by threads
+        frames = (self._read(frame_num) for frame_num in tmp_nums)
+        data = assemble_batch(frames, self._transform, len(tmp_nums),
+                              gen_n_thread(self.n_thread))
+
+        if len(tmp_nums) == 1:
+            data = index_batch(data, 0)
             labels = labels[0]  # len(labels) == 1
 
         return data, labels
@@ -611,6 +903,721 @@ class VideoSet:
         """
         return len(self.frame_nums)
 
+    def __getstate__(self):
+        """
+        The video capture can't be pickled, and is reopened after unpickling.
+        """
+        state = self.__dict__.copy()
+        state['_vid_cap'] = None
+        state['_pid'] = None
+
+        return state
+
+    @property
+    def vid_cap(self):
+        """
+        Get the video capture of the current process
+
+        Returns
+        -------
+        vid_cap : cv2.VideoCapture
+        """
+        if self._vid_cap is None or self._pid != os.getpid():
+            self._vid_cap = cv2.VideoCapture(self.vid_file)
+            self._pid = os.getpid()
+            self._next_num = 1
+
+        return self._vid_cap
+
+    def _transform(self, frame):
+        """
+        Transform a frame
+
+        Parameters
+        ----------
+        frame : ndarray
+            The frame in BGR
+
+        Returns
+        -------
+        frame : tensor
+        """
+        frame = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        frame = self.transform(frame)  # transform frame
+
+        return frame
+
+    def _read(self, frame_num):
+        """
+        Read a frame
+
+        Parameters
+        ----------
+        frame_num : int
+            The sequence number of the frame
+
+        Returns
+        -------
+        frame : ndarray
+            The frame in BGR
+        """
+        vid_cap = self.vid_cap
+        n_grab = frame_num - self._next_num
+        if 0 <= n_grab <= self.max_grab:
+            for _ in range(n_grab):
+                vid_cap.grab()
+        else:
+            vid_cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num-1)
+        _, frame = vid_cap.read()
+        self._next_num = frame_num + 1
+
+        return frame
+
+
+class PackSet:
+    """
+    Dataset for a stimulus pack, which is a .npy file of uint8 images with
+    shape as (n_stim, n_chn, height, width). The images have been decoded and
+    resized when packing, so they are read from the memory-mapped file
+    without decoding. The memory map is opened lazily in each process.
+    """
+    def __init__(self, pack_file, labels=None, transform=None):
+        """
+        Parameters
+        ----------
+        pack_file : str
+            The .npy file of the stimulus pack
+        labels : list
+            Each image's label.
+        transform : callable
+            Transform applied to uint8 tensors with shape as (n_chn, height, width)
+            or (n_stim, n_chn, height, width). It must convert them to floats.
+            Default is converting them to floats in [0, 1] as ToTensor does.
+            See gen_pack_transform.
+        """
+        self.pack_file = pack_file
+        self._pack = None
+        self._pid = None  # the process which opens the memory map
+        self.shape = np.load(pack_file, mmap_mode='r').shape
+        self.labels = np.ones(self.shape[0]) if labels is None else labels
+        self.labels = np.int64(self.labels)
+        self.transform = transforms.ConvertImageDtype(torch.float) if transform is None else transform
+
+    def __len__(self):
+        """
+        Return the number of images
+        """
+        return self.shape[0]
+
+    def __getitem__(self, indices):
+        """
+        Get image data and corresponding labels
+
+        Parameters
+        ----------
+        indices : int, list, slice
+            Subscript indices
+            Contiguous ascending indices in a list are read as a slice.
+
+        Returns
+        -------
+        data : tensor
+            Image data with shape as (n_stim, n_chn, height, weight)
+            The first dimension is removed only for an integer index.
+        labels : list
+            Image labels
+        """
+        if isinstance(indices, (int, np.integer)):
+            data = self.pack[indices]
+            labels = self.labels[indices]
+        elif isinstance(indices, list):
+            if len(indices) > 0 and indices == list(range(indices[0], indices[-1] + 1)):
+                data = self.pack[indices[0]:indices[-1] + 1]
+            else:
+                data = self.pack[indices]
+            labels = self.labels[indices]
+        elif isinstance(indices, slice):
+            data = self.pack[indices]
+            labels = self.labels[indices]
+        else:
+            raise IndexError("only integer, slices (`:`) and list are valid indices")
+
+        # the memory map is copy-on-write, so the tensor shares its memory
+        data = self.transform(torch.from_numpy(data))
+
+        return data, labels
+
+    def __getstate__(self):
+        """
+        The memory map isn't pickled, and is reopened after unpickling.
+        """
+        state = self.__dict__.copy()
+        state['_pack'] = None
+        state['_pid'] = None
+
+        return state
+
+    @property
+    def pack(self):
+        """
+        Get the memory map of the current process
+
+        Returns
+        -------
+        pack : ndarray
+            uint8 memory map with shape as (n_stim, n_chn, height, width)
+        """
+        if self._pack is None or self._pid != os.getpid():
+            self._pack = np.load(self.pack_file, mmap_mode='c')
+            self._pid = os.getpid()
+
+        return self._pack
+
+
+class ArraySet:
+    """
+    Dataset for uint8 images in an array with shape as (n_stim, n_chn, height, width).
+    The images are transformed by torch ops on tensors rather than PIL images,
+    and a batch of them is transformed at once if the transform only
+    contains Resize, CenterCrop, ToTensor and Normalize.
+    """
+    def __init__(self, arrays, labels=None, transform=None):
+        """
+        Parameters
+        ----------
+        arrays : ndarray
+            uint8 images with shape as (n_stim, n_chn, height, width)
+        labels : array_like
+            Each image's label or target.
+        transform : transforms.Compose
+            The transform for PIL images which contains ToTensor.
+            It is converted to the one for uint8 tensors by gen_pack_transform.
+        """
+        if arrays.dtype != np.uint8:
+            raise TypeError('The images must be uint8 arrays.')
+        self.arrays = arrays
+        self.labels = np.zeros(len(arrays), np.int64) if labels is None else np.asarray(labels)
+        transform = transforms.Compose([transforms.ToTensor()]) if transform is None else transform
+        self.batched = all(isinstance(t, BATCH_TRANSFORMS) for t in transform.transforms)
+        self.transform = gen_pack_transform(transform, False)
+
+    def __len__(self):
+        """
+        Return the number of images
+        """
+        return len(self.arrays)
+
+    def __getitem__(self, indices):
+        """
+        Get image data and corresponding labels
+
+        Parameters
+        ----------
+        indices : int, list, slice
+            Subscript indices
+
+        Returns
+        -------
+        data : tensor
+            Image data with shape as (n_stim, n_chn, height, weight)
+            The first dimension is removed only for an integer index.
+        labels : ndarray
+            Image labels
+        """
+        if not isinstance(indices, (int, np.integer, list, slice)):
+            raise IndexError("only integer, slices (`:`) and list are valid indices")
+        data = torch.from_numpy(self.arrays[indices])
+        labels = self.labels[indices]
+
+        if data.ndim == 3 or self.batched:
+            data = self.transform(data)
+        else:
+            # random transforms are applied image by image
+            data = assemble_batch(data, self.transform, len(data))
+
+        return data, labels
+
+
+def read_tar_index(tar_dir):
+    """
+    Read the index of tar shards
+
+    Parameters
+    ----------
+    tar_dir : str
+        The directory of the tar shards, which contains the index.csv.
+        Each line of the index is 'stimID,shard,offset,size', where shard is
+        the name of the tar file, offset is the position of the stimulus file's
+        data in the shard, and size is its number of bytes.
+
+    Returns
+    -------
+    index : dict
+        Keys are stimulus IDs, values are tuples as (shard, offset, size).
+    """
+    index = dict()
+    with open(pjoin(tar_dir, 'index.csv')) as rf:
+        lines = rf.read().splitlines()
+    assert lines[0] == 'stimID,shard,offset,size', 'Invalid index of tar shards'
+    for line in lines[1:]:
+        if line == '':
+            continue
+        stim_id, shard, offset, size = line.rsplit(',', 3)
+        index[stim_id] = (shard, int(offset), int(size))
+
+    return index
+
+
+class TarSet:
+    """
+    Dataset for image files stored in tar shards, which are built by
+    Stimulus.shard. It avoids opening millions of small files on
+    network filesystems. The images of a batch are sorted by their positions
+    in the shards, and nearby images are read by one large read.
+    The shards are opened lazily in each process.
+    """
+    def __init__(self, tar_dir, img_ids, labels=None, transform=None,
+                 n_thread=None, max_gap=2**20, draft=False):
+        """
+        Parameters
+        ----------
+        tar_dir : str
+            The directory of the tar shards and their index.csv
+        img_ids : list
+            Each img_id is the path of the image file when it was sharded.
+        labels : list
+            Each image's label.
+        transform : callable function
+            Optional transform to be applied on a stimulus.
+            If is a TransformGroup, the image data is a tuple of tensors.
+        n_thread : int
+            The number of threads which decode and transform images
+            when getting multiple images at once.
+            Default is the CPU count shared by the DataLoader workers
+            (see gen_n_thread).
+        max_gap : int
+            Images in the same shard are read at once if the number of bytes
+            between them doesn't exceed max_gap.
+        draft : bool
+            Decode JPEG images at a reduced scale or not.
+            See ImageSet for details.
+        """
+        index = read_tar_index(tar_dir)
+        missing = [img_id for img_id in img_ids if img_id not in index]
+        if len(missing) > 0:
+            raise ValueError('{0} images are not in the tar shards, such as {1}'.format(
+                len(missing), missing[0]))
+
+        self.n_thread = n_thread
+        self.max_gap = max_gap
+        self.tar_dir = tar_dir
+        self.img_ids = img_ids
+        self.members = [index[img_id] for img_id in img_ids]
+        self.labels = np.ones(len(self.img_ids)) if labels is None else labels
+        self.labels = np.int64(self.labels)
+        self.transform = transforms.Compose([transforms.ToTensor()]) if transform is None else transform
+        self.draft = gen_draft_size(self.transform) if draft else None
+        self._files = dict()
+        self._pid = None  # the process which opens the shards
+
+    def __len__(self):
+        """
+        Return the number of images
+        """
+        return len(self.img_ids)
+
+    def __getitem__(self, indices):
+        """
+        Get image data and corresponding labels
+
+        Parameters
+        ----------
+        indices : int, list, slice
+            Subscript indices
+
+        Returns
+        -------
+        data : tensor
+            Image data with shape as (n_stim, n_chn, height, weight)
+            The first dimension is removed only for an integer index.
+        labels : list
+            Image labels
+        """
+        if isinstance(indices, (int, np.integer)):
+            members = [self.members[indices]]
+            labels = [self.labels[indices]]
+        elif isinstance(indices, list):
+            members = [self.members[idx] for idx in indices]
+            labels = self.labels[indices]
+        elif isinstance(indices, slice):
+            members = self.members[indices]
+            labels = self.labels[indices]
+        else:
+            raise IndexError("only integer, slices (`:`) and list are valid indices")
+
+        # load data
+        data = assemble_batch(self._read(members), self._load, len(members),
+                              gen_n_thread(self.n_thread))
+        if isinstance(indices, (int, np.integer)):
+            data = index_batch(data, 0)
+            labels = labels[0]
+
+        return data, labels
+
+    def __getstate__(self):
+        """
+        The shards' file objects aren't pickled, and are reopened after unpickling.
+        """
+        state = self.__dict__.copy()
+        state['_files'] = dict()
+        state['_pid'] = None
+
+        return state
+
+    def _open(self, shard):
+        """
+        Get the file object of a shard opened by the current process
+
+        Parameters
+        ----------
+        shard : str
+            The name of the shard
+
+        Returns
+        -------
+        file : file object
+        """
+        if self._pid != os.getpid():
+            self._files = dict()
+            self._pid = os.getpid()
+        if shard not in self._files:
+            self._files[shard] = open(pjoin(self.tar_dir, shard), 'rb')
+
+        return self._files[shard]
+
+    def _read(self, members):
+        """
+        Read the bytes of image files
+
+        Parameters
+        ----------
+        members : list
+            Each member is a tuple as (shard, offset, size).
+
+        Returns
+        -------
+        buffers : list
+            The bytes of each member
+        """
+        buffers = [None] * len(members)
+        order = sorted(range(len(members)), key=lambda i: members[i][:2])
+        idx = 0
+        while idx < len(order):
+            # merge nearby members into a range
+            shard, start, size = members[order[idx]]
+            end = start + size
+            idx_end = idx + 1
+            while idx_end < len(order):
+                shard_next, offset, size = members[order[idx_end]]
+                if shard_next != shard or offset - end > self.max_gap:
+                    break
+                end = max(end, offset + size)
+                idx_end += 1
+
+            # read the range
+            rf = self._open(shard)
+            rf.seek(start)
+            buffer = memoryview(rf.read(end - start))
+            for i in order[idx:idx_end]:
+                _, offset, size = members[i]
+                buffers[i] = buffer[offset-start:offset-start+size]
+            idx = idx_end
+
+        return buffers
+
+    def _load(self, buffer):
+        """
+        Decode and transform an image
+
+        Parameters
+        ----------
+        buffer : bytes-like
+            The bytes of the image file
+
+        Returns
+        -------
+        image : tensor
+        """
+        image = Image.open(io.BytesIO(buffer))
+        if self.draft is not None:
+            image.draft(None, self.draft)
+        image = image.convert('RGB')  # decode image
+        image = self.transform(image)  # transform image
+
+        return image
+
+
+# transforms which are applied to a batch of images in the same way as to each image
+BATCH_TRANSFORMS = (transforms.Resize, transforms.CenterCrop,
+                    transforms.ToTensor, transforms.Normalize)
+
+
+class TensorResize:
+    """
+    Resize uint8 image tensors as transforms.Resize resizes PIL images.
+    Bilinear resizing with antialias is done by the uint8 kernel of torch,
+    whose results are closer to PIL than the float kernel which
+    transforms.Resize uses for tensors.
+    """
+    def __init__(self, resize):
+        """
+        Parameters
+        ----------
+        resize : transforms.Resize
+        """
+        self.resize = resize
+
+    def __call__(self, data):
+        """
+        Parameters
+        ----------
+        data : tensor
+            Images with shape as (n_chn, height, width) or (n_stim, n_chn, height, width)
+
+        Returns
+        -------
+        data : tensor
+            Resized images
+        """
+        resize = self.resize
+        if data.dtype != torch.uint8 or resize.max_size is not None or \
+                resize.antialias is False or \
+                resize.interpolation != transforms.InterpolationMode.BILINEAR:
+            return resize(data)
+
+        # calculate the output size
+        size = [resize.size] if isinstance(resize.size, int) else list(resize.size)
+        if len(size) == 1:
+            # match the smaller edge to the size
+            height, width = data.shape[-2:]
+            if width <= height:
+                size = [int(size[0] * height / width), size[0]]
+            else:
+                size = [size[0], int(size[0] * width / height)]
+        if list(data.shape[-2:]) == size:
+            return data
+
+        if data.ndim == 3:
+            return self(data[None])[0]
+        return torch.nn.functional.interpolate(data, size, mode='bilinear',
+                                               align_corners=False, antialias=True)
+
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, self.resize)
+
+
+def gen_pack_transform(transform, packed=True):
+    """
+    Convert a transform for PIL images to the one for uint8 tensors
+    of a stimulus pack. ToTensor is replaced with ConvertImageDtype.
+
+    Parameters
+    ----------
+    transform : transforms.Compose
+        The transform for PIL images which contains ToTensor.
+    packed : bool
+        If true, drop the transforms before ToTensor, since they have
+        been applied when packing (see gen_pil_transform).
+        Otherwise, apply them to tensors, e.g. random augmentations for training,
+        and Resize is replaced with TensorResize.
+
+    Returns
+    -------
+    transform : transforms.Compose
+    """
+    pil_transforms, tensor_transforms = _split_transform(transform)
+    transform = [transforms.ConvertImageDtype(torch.float)] + tensor_transforms
+    if not packed:
+        pil_transforms = [TensorResize(t) if isinstance(t, transforms.Resize) else t
+                          for t in pil_transforms]
+        transform = pil_transforms + transform
+
+    return transforms.Compose(transform)
+
+
+def gen_pil_transform(transform):
+    """
+    Get the part of a transform which is applied to PIL images,
+    and convert its output to uint8 tensors, which are stored in a stimulus pack.
+
+    Parameters
+    ----------
+    transform : transforms.Compose
+        The transform for PIL images which contains ToTensor.
+
+    Returns
+    -------
+    transform : transforms.Compose
+    """
+    pil_transforms, _ = _split_transform(transform)
+
+    return transforms.Compose(pil_transforms + [transforms.PILToTensor()])
+
+
+def _split_transform(transform):
+    """
+    Split a transform at ToTensor
+
+    Parameters
+    ----------
+    transform : transforms.Compose
+
+    Returns
+    -------
+    pil_transforms : list
+        Transforms before ToTensor
+    tensor_transforms : list
+        Transforms after ToTensor
+    """
+    if not isinstance(transform, transforms.Compose):
+        raise TypeError('The transform must be an instance of transforms.Compose')
+    to_tensor_indices = [idx for idx, t in enumerate(transform.transforms)
+                         if isinstance(t, transforms.ToTensor)]
+    if len(to_tensor_indices) != 1:
+        raise ValueError('The transform must contain a ToTensor.')
+    idx = to_tensor_indices[0]
+
+    return transform.transforms[:idx], transform.transforms[idx+1:]
+
+
+class SegmentBatchSampler:
+    """
+    Yield batches of contiguous segments in turn.
+    A DataLoader dispatches batches to its workers in turn, so each worker
+    loads its own segment sequentially if there are as many segments as workers
+    and each segment has the same number of batches.
+    """
+    def __init__(self, segments, batch_size):
+        """
+        Parameters
+        ----------
+        segments : list
+            Each element is a tuple as (start, stop).
+        batch_size : int
+            The number of items per batch
+        """
+        self.segments = segments
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        """
+        Yield indices of each batch
+        """
+        seg_batches = []
+        for start, stop in self.segments:
+            seg_batches.append([list(range(idx, min(idx + self.batch_size, stop)))
+                                for idx in range(start, stop, self.batch_size)])
+        n_batch_max = max([len(batches) for batches in seg_batches] + [0])
+        for batch_idx in range(n_batch_max):
+            for batches in seg_batches:
+                if batch_idx < len(batches):
+                    yield batches[batch_idx]
+
+    def __len__(self):
+        """
+        Return the number of batches
+        """
+        return sum([int(np.ceil((stop - start) / self.batch_size))
+                    for start, stop in self.segments])
+
+
+def gen_data_loader(stim_set, batch_size=8, shuffle=False, n_worker=None,
+                    prefetch=2, pin_memory=False, segment=False):
+    """
+    Generate a DataLoader for the stimulus set
+
+    Parameters
+    ----------
+    stim_set : ImageSet, VideoSet, PackSet, TarSet, ArraySet, list
+        The stimulus set
+        A PackSet, TarSet or ArraySet without shuffle is read batch by batch
+        rather than image by image, so its batches are read as slices of the
+        memory map or large reads of the shards, and transformed at once.
+    batch_size : int
+        The number of stimuli per batch
+    shuffle : bool
+        Reshuffle the stimuli at every epoch or not
+    n_worker : int
+        The number of subprocesses used to load stimuli.
+        0 means stimuli will be loaded in the main process.
+        If is None, it is the CPU count for the ImageSet, VideoSet and TarSet
+        which decode stimuli from the disk, but not more than the number of
+        batches, and 0 for the PackSet, ArraySet and list whose stimuli have
+        been decoded.
+    prefetch : int
+        The number of batches loaded in advance by each worker.
+        Only used when n_worker > 0.
+    pin_memory : bool
+        Copy tensors into pinned memory before returning them or not.
+        It speeds up the host to GPU transfer.
+    segment : bool
+        Only used when stim_set is a VideoSet loaded by workers without shuffle.
+        If true, split the frames into contiguous segments, one per worker,
+        so that each worker decodes its segment sequentially.
+        Batches are yielded out of order, and their positions can be found
+        by iterating batch indices (see iter_batch_indices) in the same order.
+
+    Returns
+    -------
+    data_loader : DataLoader
+    """
+    if n_worker is None:
+        if isinstance(stim_set, (ImageSet, VideoSet, TarSet)):
+            # each worker imports PyTorch, so don't start idle ones
+            n_batch = -(-len(stim_set) // batch_size)
+            n_worker = min(os.cpu_count(), n_batch)
+        else:
+            n_worker = 0
+    assert n_worker >= 0, 'n_worker must be a nonnegative integer.'
+
+    kwargs = dict()
+    if n_worker > 0:
+        kwargs['prefetch_factor'] = prefetch
+    if segment and n_worker > 0 and not shuffle and isinstance(stim_set, VideoSet):
+        segments = gen_segments(len(stim_set), n_worker, batch_size)
+        kwargs['batch_sampler'] = SegmentBatchSampler(segments, batch_size)
+    elif not shuffle and isinstance(stim_set, (PackSet, TarSet, ArraySet)):
+        kwargs['batch_size'] = None
+        kwargs['sampler'] = BatchSampler(SequentialSampler(stim_set), batch_size, False)
+    else:
+        kwargs['batch_size'] = batch_size
+        kwargs['shuffle'] = shuffle
+    data_loader = DataLoader(stim_set, num_workers=n_worker,
+                             pin_memory=pin_memory, **kwargs)
+
+    return data_loader
+
+
+def iter_batch_indices(data_loader):
+    """
+    Iterate indices of batches in the order the data loader yields them
+
+    Parameters
+    ----------
+    data_loader : DataLoader
+        Generated by gen_data_loader without shuffle
+
+    Returns
+    -------
+    batch_indices : iterator
+        Each element is a list of indices of a batch.
+    """
+    if data_loader.batch_sampler is None:
+        # the sampler yields batches by itself
+        return iter(data_loader.sampler)
+    else:
+        return iter(data_loader.batch_sampler)
+
 
 def cross_val_confusion(classifier, X, y, cv=None):
     """
@@ -634,6 +1641,9 @@ def cross_val_confusion(classifier, X, y, cv=None):
     accuracies : list   
         Accuracies of the folds.
     """
+    from sklearn.model_selection import StratifiedKFold
+    from sklearn.metrics import confusion_matrix
+
     assert getattr(classifier, "_estimator_type", None) == "classifier", \
         "Estimator must be a classifier!"
 
@@ -686,6 +1696,9 @@ def cross_val_scores(regressor, X, Y, scoring, cv=None, multi_trg_flag=True):
     scores : ndarray
         shape=(cv, n_target)
     """
+    from sklearn.model_selection import KFold
+    from sklearn.metrics import r2_score, explained_variance_score
+
     assert getattr(regressor, "_estimator_type", None) == "regressor", \
         "Estimator must be a regressor!"
     regressor = copy.deepcopy(regressor)
@@ -750,6 +1763,9 @@ def gen_estimator_from_name(name):
     -------
     estimator : sklearn estimator
     """
+    from sklearn.linear_model import LinearRegression, LogisticRegression, Lasso
+    from sklearn.svm import SVC
+
     if name == 'lrc':
         estimator = LogisticRegression()
     elif name == 'svc':
@@ -961,6 +1977,9 @@ class UnivariateMapping:
 
                <br/>
         """
+        from sklearn.model_selection import cross_val_score
+        from sklearn.metrics import pairwise_distances
+
         assert X.ndim == 2, "X's shape must be (n_sample, n_feature)!"
         assert Y.ndim == 2, "Y's shape must be (n_sample, n_target)!"
         assert X.shape[0] == Y.shape[0], 'X and Y must have the ' \
@@ -969,13 +1988,13 @@ class UnivariateMapping:
         n_trg = Y.shape[1]
 
         # initialize mapping dict
-        map_dict = {'location': np.zeros((n_trg,), dtype=np.int)}
+        map_dict = {'location': np.zeros((n_trg,), dtype=int)}
         if self.estimator_type == 'classifier':
-            map_dict['model'] = np.zeros((n_trg,), dtype=np.object)
+            map_dict['model'] = np.zeros((n_trg,), dtype=object)
             map_dict['score'] = np.zeros((n_trg, self.cv))
-            map_dict['conf_m'] = np.zeros((n_trg, self.cv), dtype=np.object)
+            map_dict['conf_m'] = np.zeros((n_trg, self.cv), dtype=object)
         elif self.estimator_type == 'regressor':
-            map_dict['model'] = np.zeros((n_trg,), dtype=np.object)
+            map_dict['model'] = np.zeros((n_trg,), dtype=object)
             map_dict['score'] = np.zeros((n_trg, self.cv))
         else:
             map_dict['score'] = np.zeros((n_trg,))
@@ -1007,7 +2026,7 @@ class UnivariateMapping:
             else:
                 # cross validation
                 scores_cv = np.zeros((n_feat, self.cv))
-                conf_ms_cv = np.zeros((n_feat, self.cv), dtype=np.object)
+                conf_ms_cv = np.zeros((n_feat, self.cv), dtype=object)
                 for feat_idx in range(n_feat):
                     conf_ms, accs = cross_val_confusion(self.estimator, X[:, [feat_idx]], y, cv=self.cv)
                     scores_cv[feat_idx] = accs
@@ -1187,12 +2206,12 @@ class MultivariateMapping:
                                          'same number of samples!'
         n_trg = Y.shape[1]
         # initialize prediction dict
-        map_dict = {'model': np.ones((n_trg,), dtype=np.object) * 'm'}
+        map_dict = {'model': np.ones((n_trg,), dtype=object) * 'm'}
         print('Start mapping:')
         time1 = time.time()
         if self.estimator_type == 'classifier':
             map_dict['score'] = np.zeros((n_trg, self.cv))
-            map_dict['conf_m'] = np.zeros((n_trg, self.cv), dtype=np.object)
+            map_dict['conf_m'] = np.zeros((n_trg, self.cv), dtype=object)
             for trg_idx in range(n_trg):
                 time2 = time.time()
                 y = Y[:, trg_idx]
@@ -1235,7 +2254,7 @@ def dnn_mask(dnn_acts, channels='all', rows='all', columns='all'):
 
     Parameters
     ----------
-    dnn_acts : ndarray   
+    dnn_acts : ndarray, tensor
         DNN activation
         A 4D array with its shape as (n_stim, n_chn, n_row, n_col).
     channels: str, list   
@@ -1253,7 +2272,7 @@ def dnn_mask(dnn_acts, channels='all', rows='all', columns='all'):
 
     Return
     ------
-    dnn_acts : ndarray   
+    dnn_acts : ndarray, tensor
         DNN activation after mask.
         A 4D array with its shape as (n_stim, n_chn, n_row, n_col).
     """
@@ -1319,6 +2338,9 @@ def dnn_fe(dnn_acts, method, n_feat, axis=None):
         DNN activation.
         A 4D array with its shape as (n_stim, n_chn, n_row, n_col).
     """
+    from sklearn.decomposition import PCA
+    from scipy.signal import periodogram
+
     # adjust iterative axis
     n_stim, n_chn, n_row, n_col = dnn_acts.shape
     dnn_acts = dnn_acts.reshape((n_stim, n_chn, n_row*n_col))
@@ -0,0 +1,398 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from os.path import join as pjoin
+from dnnbrain.dnn.core import Stimulus
+
+# the file in the cache directory which memoizes hashes of stimulus files
+FILE_HASHES = 'file_hashes.json'
+
+
+def hash_stimuli(stimuli, content=False, file_hashes=None):
+    """
+    Calculate a hash of the stimuli which identifies their order and contents
+
+    Parameters
+    ----------
+    stimuli : Stimulus, ndarray
+        Input stimuli
+    content : bool
+        Only used when stimuli is Stimulus.
+        If true, hash the contents of the stimulus files on the disk.
+        Otherwise, only the stimulus type, path and IDs are hashed.
+    file_hashes : dict
+        Only used when content is true.
+        Hashes of the files' contents memoized by hash_file(),
+        which is updated in place.
+
+    Returns
+    -------
+    hash_value : str
+        SHA1 hex digest
+    """
+    from dnnbrain.dnn.base import read_tar_index
+
+    sha1 = hashlib.sha1()
+    if isinstance(stimuli, np.ndarray):
+        sha1.update(str(stimuli.shape).encode())
+        sha1.update(np.ascontiguousarray(stimuli).tobytes())
+    elif isinstance(stimuli, Stimulus):
+        stim_type = stimuli.header['type']
+        stim_path = stimuli.header['path']
+        sha1.update(stim_type.encode())
+        if not content:
+            sha1.update(stim_path.encode())
+        elif stim_type in ('video', 'pack'):
+            sha1.update(hash_file(stim_path, file_hashes=file_hashes).encode())
+        elif stim_type == 'tar':
+            index = read_tar_index(stim_path)
+            stim_ids = set(stimuli.get('stimID'))
+            for stim_id, (shard, offset, size) in sorted(index.items()):
+                if stim_id in stim_ids:
+                    sha1.update(hash_file(pjoin(stim_path, shard), offset, size,
+                                          file_hashes).encode())
+        for stim_id in stimuli.get('stimID'):
+            sha1.update('{}\n'.format(stim_id).encode())
+            if content and stim_type == 'image':
+                sha1.update(hash_file(pjoin(stim_path, stim_id),
+                                      file_hashes=file_hashes).encode())
+    else:
+        raise TypeError('The input stimuli must be an instance of ndarray or Stimulus!')
+
+    return sha1.hexdigest()
+
+
+def hash_file(fname, offset=0, size=None, file_hashes=None):
+    """
+    Calculate a hash of the file's contents
+
+    Parameters
+    ----------
+    fname : str
+        File name
+    offset : int
+        The position where the contents start
+    size : int
+        The number of bytes of the contents.
+        Default is reading to the end of the file.
+    file_hashes : dict
+        Memoized hashes, which map '<path>:<offset>:<size>' to
+        [file size, modification time in ns, hash value].
+        The memoized hash is used if the file's size and modification time
+        haven't changed, otherwise the file is hashed again and the memo
+        is updated in place.
+
+    Returns
+    -------
+    hash_value : str
+        SHA1 hex digest
+    """
+    stat = os.stat(fname)
+    memo_key = '{0}:{1}:{2}'.format(os.path.abspath(fname), offset, size)
+    if file_hashes is not None and memo_key in file_hashes:
+        st_size, st_mtime, hash_value = file_hashes[memo_key]
+        if st_size == stat.st_size and st_mtime == stat.st_mtime_ns:
+            return hash_value
+
+    sha1 = hashlib.sha1()
+    _update_file(sha1, fname, offset, size)
+    hash_value = sha1.hexdigest()
+    if file_hashes is not None:
+        file_hashes[memo_key] = [stat.st_size, stat.st_mtime_ns, hash_value]
+
+    return hash_value
+
+
+def hash_model(model):
+    """
+    Calculate a hash of the model's weights
+
+    Parameters
+    ----------
+    model : nn.Module
+        DNN model
+
+    Returns
+    -------
+    hash_value : str
+        SHA1 hex digest
+    """
+    import torch
+
+    sha1 = hashlib.sha1()
+    for name, value in model.state_dict().items():
+        sha1.update(name.encode())
+        # weights of quantized layers are packed as tuples
+        for tensor in (value if isinstance(value, tuple) else [value]):
+            if not isinstance(tensor, torch.Tensor):
+                sha1.update(repr(tensor).encode())
+                continue
+            if tensor.is_quantized:
+                tensor = tensor.dequantize()
+            sha1.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+
+    return sha1.hexdigest()
+
+
+def _update_file(sha1, fname, offset=0, size=None, chunk_size=2**20):
+    """
+    Update the hash object with the file's contents
+
+    Parameters
+    ----------
+    sha1 : hash object
+    fname : str
+        File name
+    offset : int
+        The position where the contents start
+    size : int
+        The number of bytes of the contents.
+        Default is reading to the end of the file.
+    chunk_size : int
+        The number of bytes read at a time
+    """
+    with open(fname, 'rb') as rf:
+        rf.seek(offset)
+        while size is None or size > 0:
+            chunk = rf.read(chunk_size if size is None else min(size, chunk_size))
+            if chunk == b'':
+                break
+            sha1.update(chunk)
+            if size is not None:
+                size -= len(chunk)
+
+
+def _to_json(obj):
+    """
+    Convert numpy objects, which are not JSON serializable, to Python objects
+    """
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError('{} is not JSON serializable'.format(type(obj)))
+
+
+class ActivationCache:
+    """
+    A content-addressed on-disk cache of DNN activation.
+    Each entry holds activation of a layer as a .npy file named by its key,
+    and a .json file which describes how the activation was computed.
+    The least recently used entries are evicted when the cache's size
+    exceeds the max_size.
+    """
+    def __init__(self, cache_dir=None, max_size=None):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            The cache directory.
+            Default is $DNNBRAIN_DATA/cache
+        max_size : int
+            The max size of the cache in bytes.
+            Default is $DNNBRAIN_CACHE_SIZE if set, otherwise 10GB.
+        """
+        if cache_dir is None:
+            cache_dir = pjoin(os.environ['DNNBRAIN_DATA'], 'cache')
+        if max_size is None:
+            max_size = int(os.environ.get('DNNBRAIN_CACHE_SIZE', 10 * 2**30))
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    @staticmethod
+    def gen_key(**factors):
+        """
+        Generate a key from the factors which determine the activation
+
+        Parameters
+        ----------
+        factors : dict
+            JSON serializable values such as hashes of the model and stimuli,
+            the transform, layer, mask and pooling method.
+
+        Returns
+        -------
+        key : str
+            SHA1 hex digest
+        """
+        factors = json.dumps(factors, sort_keys=True, default=_to_json)
+        return hashlib.sha1(factors.encode()).hexdigest()
+
+    def read_file_hashes(self):
+        """
+        Read the hashes of stimulus files memoized in the cache directory
+
+        Returns
+        -------
+        file_hashes : dict
+            See hash_file()
+        """
+        try:
+            with open(pjoin(self.cache_dir, FILE_HASHES)) as rf:
+                file_hashes = json.load(rf)
+        except (FileNotFoundError, ValueError):
+            file_hashes = dict()
+
+        return file_hashes
+
+    def write_file_hashes(self, file_hashes):
+        """
+        Write the hashes of stimulus files into the cache directory
+
+        Parameters
+        ----------
+        file_hashes : dict
+            See hash_file()
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fname_tmp = pjoin(self.cache_dir, '{0}.{1}.tmp'.format(FILE_HASHES, os.getpid()))
+        with open(fname_tmp, 'w') as wf:
+            json.dump(file_hashes, wf)
+        os.replace(fname_tmp, pjoin(self.cache_dir, FILE_HASHES))
+
+    def get(self, key):
+        """
+        Get the cached activation
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry
+
+        Returns
+        -------
+        data : ndarray
+            The activation. It is None if the key is missing.
+        """
+        fname = pjoin(self.cache_dir, key + '.npy')
+        try:
+            data = np.load(fname)
+        except (FileNotFoundError, ValueError):
+            return None
+        # mark it as the most recently used
+        os.utime(fname)
+
+        return data
+
+    def set(self, key, data, info=None):
+        """
+        Put activation into the cache, and evict the least recently
+        used entries if the cache's size exceeds the max_size.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry
+        data : ndarray
+            The activation
+        info : dict
+            JSON serializable information of the entry
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # write a temporary file first, so that readers never see a partial entry
+        info = dict() if info is None else info
+        info['shape'] = data.shape
+        with open(pjoin(self.cache_dir, key + '.json'), 'w') as wf:
+            json.dump(info, wf, default=_to_json)
+        fname_tmp = pjoin(self.cache_dir, '{0}.{1}.tmp'.format(key, os.getpid()))
+        with open(fname_tmp, 'wb') as wf:
+            np.save(wf, data)
+        os.replace(fname_tmp, pjoin(self.cache_dir, key + '.npy'))
+
+        self.prune()
+
+    def entries(self):
+        """
+        List entries of the cache from the most to the least recently used
+
+        Returns
+        -------
+        entries : list
+            Each element is a dict with keys as
+            ('key', 'size', 'atime', 'info')
+        """
+        if not os.path.isdir(self.cache_dir):
+            return []
+
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith('.npy'):
+                continue
+            key = fname[:-4]
+            try:
+                stat = os.stat(pjoin(self.cache_dir, fname))
+            except FileNotFoundError:
+                # evicted by another process
+                continue
+            try:
+                with open(pjoin(self.cache_dir, key + '.json')) as rf:
+                    info = json.load(rf)
+            except (FileNotFoundError, ValueError):
+                info = dict()
+            entries.append({'key': key, 'size': stat.st_size,
+                            'atime': stat.st_mtime, 'info': info})
+        entries.sort(key=lambda x: x['atime'], reverse=True)
+
+        return entries
+
+    def delete(self, key):
+        """
+        Delete an entry
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry
+        """
+        for suffix in ('.npy', '.json'):
+            fname = pjoin(self.cache_dir, key + suffix)
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def prune(self, max_size=None):
+        """
+        Evict the least recently used entries until the cache's size
+        doesn't exceed the max_size.
+
+        Parameters
+        ----------
+        max_size : int
+            The max size of the cache in bytes.
+            Default is self.max_size
+
+        Returns
+        -------
+        keys : list
+            Keys of the evicted entries
+        """
+        max_size = self.max_size if max_size is None else max_size
+        keys = []
+        size = 0
+        for entry in self.entries():
+            size += entry['size']
+            if size > max_size:
+                self.delete(entry['key'])
+                keys.append(entry['key'])
+
+        return keys
+
+    def clear(self):
+        """
+        Delete all entries
+        """
+        return self.prune(0)
+
+    @property
+    def size(self):
+        """
+        Get the cache's size in bytes
+
+        Returns
+        -------
+        size : int
+        """
+        return sum([entry['size'] for entry in self.entries()])
+
@@ -1,10 +1,13 @@
+import os
+import tarfile
 import numpy as np
 
 from copy import deepcopy
 from dnnbrain.io import fileio as fio
-from dnnbrain.dnn.base import dnn_mask, dnn_fe, array_statistic
-from dnnbrain.dnn.base import UnivariateMapping, MultivariateMapping
-from dnnbrain.brain.algo import convolve_hrf
+
+# dnnbrain.dnn.base and dnnbrain.brain.algo depend on PyTorch, scikit-learn,
+# SciPy and so on, which take seconds to import. They are imported by the
+# methods using them, so that CLIs which only handle files start fast.
 
 
 class Stimulus:
@@ -65,6 +68,129 @@ class Stimulus:
         stim_file.write(header.pop('type'), header.pop('path'),
                         self._data, **header)
 
+    def pack(self, fname, transform, batch_size=64, draft=True):
+        """
+        Pack the stimuli into a .npy file of uint8 images with shape as
+        (n_stim, n_chn, height, width). The images are decoded and transformed
+        by the part of the transform before ToTensor, e.g. resized to the
+        input image size of a DNN. Then the packed stimuli can be read from
+        the memory-mapped file without decoding.
+
+        Parameters
+        ----------
+        fname : str
+            File name of the stimulus pack with suffix as .npy
+        transform : transforms.Compose
+            The transform for PIL images which contains ToTensor,
+            such as DNN.test_transform.
+        batch_size : int
+            The number of stimuli packed at a time
+        draft : bool
+            Decode JPEG images at a reduced scale or not.
+            See DNN.compute_activation() for details.
+
+        Returns
+        -------
+        stim : Stimulus
+            The packed stimuli with type as 'pack' and path as fname.
+        """
+        from dnnbrain.dnn.base import ImageSet, VideoSet, gen_pil_transform
+
+        assert fname.endswith('.npy'), 'File suffix must be .npy'
+        assert len(self) > 0, 'There is no stimulus to pack.'
+
+        # prepare stimulus set
+        pil_transform = gen_pil_transform(transform)
+        if self.header['type'] == 'image':
+            stim_set = ImageSet(self.header['path'], self.get('stimID'),
+                                transform=pil_transform, draft=draft)
+        elif self.header['type'] == 'video':
+            stim_set = VideoSet(self.header['path'], self.get('stimID'),
+                                transform=pil_transform)
+        else:
+            raise TypeError('{} is not a supported stimulus type.'.format(self.header['type']))
+
+        # pack stimuli batch by batch
+        n_stim = len(stim_set)
+        pack = None
+        for start in range(0, n_stim, batch_size):
+            data, _ = stim_set[start:start+batch_size]
+            data = data.numpy()
+            if data.ndim == 3:
+                data = data[None]
+            if pack is None:
+                pack = np.lib.format.open_memmap(fname, 'w+', np.uint8,
+                                                 (n_stim, *data.shape[1:]))
+            pack[start:start+data.shape[0]] = data
+            print('Packed stimuli: {0}/{1}'.format(start+data.shape[0], n_stim))
+        pack.flush()
+        del pack
+
+        stim = self[:]
+        stim.header['type'] = 'pack'
+        stim.header['path'] = os.path.abspath(fname)
+
+        return stim
+
+    def shard(self, tar_dir, shard_size=2**30):
+        """
+        Store the image files into tar shards with an index.csv in tar_dir.
+        Each image file is stored once, with its stimID as the member name.
+        Then the images can be read by large sequential reads of a few
+        shards rather than opening each file.
+
+        Parameters
+        ----------
+        tar_dir : str
+            The output directory of the shards
+        shard_size : int
+            The max number of bytes of image files in a shard.
+            A shard contains one image at least.
+
+        Returns
+        -------
+        stim : Stimulus
+            The sharded stimuli with type as 'tar' and path as tar_dir.
+        """
+        if self.header['type'] != 'image':
+            raise TypeError('Only image stimuli can be sharded.')
+        assert len(self) > 0, 'There is no stimulus to shard.'
+        if not os.path.isdir(tar_dir):
+            os.makedirs(tar_dir)
+
+        img_ids = list(dict.fromkeys(self.get('stimID')))
+        index_lines = ['stimID,shard,offset,size']
+        n_shard = 0
+        tf = None
+        for idx, img_id in enumerate(img_ids, 1):
+            assert ',' not in img_id, 'stimID with comma is not supported: ' + img_id
+            img_file = os.path.join(self.header['path'], img_id)
+            size = os.path.getsize(img_file)
+            if tf is None or (tf.offset > 0 and tf.offset + size > shard_size):
+                # start a new shard
+                if tf is not None:
+                    tf.close()
+                shard = 'shard-{:05d}.tar'.format(n_shard)
+                tf = tarfile.open(os.path.join(tar_dir, shard), 'w', format=tarfile.GNU_FORMAT)
+                n_shard += 1
+            tarinfo = tf.gettarinfo(img_file, arcname=img_id)
+            with open(img_file, 'rb') as rf:
+                tf.addfile(tarinfo, rf)
+            # the data is followed by padding to a multiple of the block size
+            offset = tf.offset - -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            index_lines.append('{0},{1},{2},{3}'.format(img_id, shard, offset, tarinfo.size))
+            if idx % 1000 == 0 or idx == len(img_ids):
+                print('Sharded images: {0}/{1}'.format(idx, len(img_ids)))
+        tf.close()
+        with open(os.path.join(tar_dir, 'index.csv'), 'w') as wf:
+            wf.write('\n'.join(index_lines))
+
+        stim = self[:]
+        stim.header['type'] = 'tar'
+        stim.header['path'] = os.path.abspath(tar_dir)
+
+        return stim
+
     def get(self, item):
         """
         Get a column of data according to the item
@@ -240,7 +366,7 @@ class Activation:
             assert value is not None, "value can't be None if layer is not None."
             self.set(layer, value)
 
-    def load(self, fname, dmask=None):
+    def load(self, fname, dmask=None, dtype=None, lazy=False):
         """
         Load DNN activation
 
@@ -250,6 +376,13 @@ class Activation:
             DNN activation file
         dmask : Mask
             The mask includes layers/channels/rows/columns of interest.
+        dtype : str
+            Data type of the loaded activation, such as 'float32'.
+            Default is the data type before saving.
+        lazy : bool
+            If true, keep the file open and read nothing until it's used.
+            Then get() returns a LazyArray, which reads only the indexed part
+            of the layer, and the other methods read one layer at a time.
         """
         if dmask is not None:
             dmask_dict = dict()
@@ -258,9 +391,9 @@ class Activation:
         else:
             dmask_dict = None
 
-        self._activation = fio.ActivationFile(fname).read(dmask_dict)
+        self._activation = fio.ActivationFile(fname).read(dmask_dict, dtype, lazy)
 
-    def save(self, fname):
+    def save(self, fname, dtype=None, layout=None, compression='gzip'):
         """
         Save DNN activation
 
@@ -268,8 +401,21 @@ class Activation:
         ----------
         fname : str
             Output file of DNN activation
-        """
-        fio.ActivationFile(fname).write(self._activation)
+        dtype : str
+            Data type used to store the activation, choices=(None, float16, uint8, int16).
+            If is None, store activation as it is.
+            uint8 and int16 mean quantizing each channel linearly.
+        layout : str
+            Chunk layout for the access pattern, choices=(None, stim, chn).
+            stim: suits reading batches of stimuli.
+            chn: suits reading channels of all stimuli, such as
+            loading with a DNN mask and iterating along channels.
+            If is None, the chunk shape is guessed by h5py.
+        compression : str
+            Compression method, choices=(gzip, lzf, None).
+            lzf is faster than gzip with a moderate compression ratio.
+        """
+        fio.ActivationFile(fname).write(self._activation, dtype, layout, compression)
 
     def get(self, layer):
         """
@@ -282,8 +428,9 @@ class Activation:
 
         Returns
         -------
-        act_layer : array
+        act_layer : array, LazyArray
             (n_stim, n_chn, n_row, n_col) array
+            It's a LazyArray if the activation is loaded lazily.
         """
         return self._activation[layer]
 
@@ -336,8 +483,8 @@ class Activation:
         activation = Activation()
         for layer in self.layers:
             # concatenate activation
-            data = [v.get(layer) for v in activations]
-            data.insert(0, self.get(layer))
+            data = [np.asarray(v.get(layer)) for v in activations]
+            data.insert(0, np.asarray(self.get(layer)))
             data = np.concatenate(data)
             activation.set(layer, data)
 
@@ -369,11 +516,17 @@ class Activation:
         activation : Activation
             DNN activation
         """
+        from dnnbrain.dnn.base import dnn_mask
+
         activation = Activation()
         for layer in dmask.layers:
             mask = dmask.get(layer)
-            data = dnn_mask(self.get(layer), mask.get('chn'),
-                            mask.get('row'), mask.get('col'))
+            data = self.get(layer)
+            if isinstance(data, fio.LazyArray):
+                # keep it lazy
+                data = data.mask(mask.get('chn'), mask.get('row'), mask.get('col'))
+            else:
+                data = dnn_mask(data, mask.get('chn'), mask.get('row'), mask.get('col'))
             activation.set(layer, data)
 
         return activation
@@ -392,9 +545,11 @@ class Activation:
         activation : Activation
             DNN activation
         """
+        from dnnbrain.dnn.base import array_statistic
+
         activation = Activation()
-        for layer, data in self._activation.items():
-            data = array_statistic(data, method, (2, 3), True)
+        for layer in self.layers:
+            data = array_statistic(np.asarray(self.get(layer)), method, (2, 3), True)
             activation.set(layer, data)
 
         return activation
@@ -430,9 +585,11 @@ class Activation:
         activation : Activation
             DNN activation
         """
+        from dnnbrain.dnn.base import dnn_fe
+
         activation = Activation()
-        for layer, data in self._activation.items():
-            data = dnn_fe(data, method, n_feat, axis)
+        for layer in self.layers:
+            data = dnn_fe(np.asarray(self.get(layer)), method, n_feat, axis)
             activation.set(layer, data)
 
         return activation
@@ -459,8 +616,11 @@ class Activation:
         activation : Activation
             DNN activation
         """
+        from dnnbrain.brain.algo import convolve_hrf
+
         activation = Activation()
-        for layer, data in self._activation.items():
+        for layer in self.layers:
+            data = np.asarray(self.get(layer))
             n_stim, n_chn, n_row, n_col = data.shape
             data = convolve_hrf(data.reshape(n_stim, -1), onsets, durations,
                                 n_vol, tr, ops)
@@ -505,7 +665,7 @@ class Activation:
 
         activation = Activation()
         for layer in self.layers:
-            data = self.get(layer) + other.get(layer)
+            data = np.asarray(self.get(layer)) + np.asarray(other.get(layer))
             activation.set(layer, data)
 
         return activation
@@ -528,7 +688,7 @@ class Activation:
 
         activation = Activation()
         for layer in self.layers:
-            data = self.get(layer) - other.get(layer)
+            data = np.asarray(self.get(layer)) - np.asarray(other.get(layer))
             activation.set(layer, data)
 
         return activation
@@ -551,7 +711,7 @@ class Activation:
 
         activation = Activation()
         for layer in self.layers:
-            data = self.get(layer) * other.get(layer)
+            data = np.asarray(self.get(layer)) * np.asarray(other.get(layer))
             activation.set(layer, data)
 
         return activation
@@ -574,7 +734,7 @@ class Activation:
 
         activation = Activation()
         for layer in self.layers:
-            data = self.get(layer) / other.get(layer)
+            data = np.asarray(self.get(layer)) / np.asarray(other.get(layer))
             activation.set(layer, data)
 
         return activation
@@ -970,6 +1130,8 @@ class DnnProbe:
         scoring : str or callable
             The method to evaluate the predictions on the test set.
         """
+        from dnnbrain.dnn.base import UnivariateMapping, MultivariateMapping
+
         if map_type is None:
             return
         elif map_type == 'uv':
@@ -1067,12 +1229,14 @@ class DnnProbe:
 
                <br/>
         """
+        from dnnbrain.dnn.base import UnivariateMapping
+
         _, n_beh = beh_data.shape
 
         probe_dict = dict()
         for layer in self.dnn_activ.layers:
             # get DNN activation and reshape it to 3D
-            activ = self.dnn_activ.get(layer)
+            activ = np.asarray(self.dnn_activ.get(layer))
             n_stim, n_chn, n_row, n_col = activ.shape
             n_row_col = n_row * n_col
             activ = activ.reshape((n_stim, n_chn, n_row_col))
@@ -1,19 +1,98 @@
 import os
+import copy
 import time
+import shutil
+import tempfile
+import warnings
+import multiprocessing
 import torch
 import numpy as np
 
+from functools import partial
+from contextlib import contextmanager, ExitStack
 from os.path import join as pjoin
-from scipy.stats import pearsonr
-from PIL import Image
 from torch import nn
-from torch.utils.data import DataLoader
+from torch.ao import quantization
+from torch.utils.data import Subset
 from torchvision import transforms
 from torchvision import models as tv_models
-from dnnbrain.dnn.core import Stimulus, Activation
-from dnnbrain.dnn.base import ImageSet, VideoSet, dnn_mask, array_statistic
+from dnnbrain.io.fileio import ActivationFile
+from dnnbrain.dnn.core import Stimulus, Activation, Mask
+from dnnbrain.dnn.cache import ActivationCache, hash_stimuli, hash_model
+from dnnbrain.dnn.base import ImageSet, VideoSet, PackSet, TarSet, ArraySet, \
+    TransformGroup, dnn_mask, array_statistic, gen_data_loader, gen_pack_transform, \
+    iter_batch_indices, index_batch
 
-DNNBRAIN_MODEL = pjoin(os.environ['DNNBRAIN_DATA'], 'models')
+
+def get_model_dir():
+    """
+    Get the directory of model weights, which is read from
+    the environment when it is used rather than imported.
+
+    Returns
+    -------
+    model_dir : str
+        $DNNBRAIN_DATA/models
+    """
+    return pjoin(os.environ['DNNBRAIN_DATA'], 'models')
+
+
+def __getattr__(name):
+    # DNNBRAIN_MODEL used to be a module constant
+    if name == 'DNNBRAIN_MODEL':
+        return get_model_dir()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+class _ForwardStop(Exception):
+    """
+    Raised by a forward hook to abort the forward pass of a truncated DNN
+    """
+    def __init__(self, output):
+        super(_ForwardStop, self).__init__()
+        self.output = output
+
+
+def _store_output(outputs, idx, module, input, output):
+    """
+    A forward hook which stores the output of a module into outputs[idx]
+    The output is cloned since the following layers may modify it in place,
+    e.g. ReLU(inplace=True).
+    """
+    outputs[idx] = output.clone()
+
+
+class _LayerOutputs(nn.Module):
+    """
+    Wrap a DNN model to return outputs of its layers rather than its own output,
+    so that they are outputs of the graph traced by TorchScript.
+    """
+    def __init__(self, model, modules):
+        """
+        Parameters
+        ----------
+        model : nn.Module
+            DNN model
+        modules : list
+            Modules of the layers.
+            If is empty, return the output of the model.
+        """
+        super(_LayerOutputs, self).__init__()
+        self.model = model
+        # a plain list, since the modules have been registered in the model
+        self.layer_modules = modules
+
+    def forward(self, inputs):
+        outputs = [None] * len(self.layer_modules)
+        hook_handles = [module.register_forward_hook(partial(_store_output, outputs, idx))
+                        for idx, module in enumerate(self.layer_modules)]
+        try:
+            model_outputs = self.model(inputs)
+        finally:
+            for hook_handle in hook_handles:
+                hook_handle.remove()
+
+        return tuple(outputs) if self.layer_modules else model_outputs
 
 
 class VggFaceModel(nn.Module):
@@ -107,6 +186,200 @@ class VggFaceModel(nn.Module):
         return x
 
 
+def _extract_shard(dnn, stimuli, dmask, pool_method, out_file, n_thread, kwargs):
+    """
+    Extract DNN activation of a shard of stimuli into a file.
+    It is the target of the processes started by DNN.compute_activation().
+
+    Parameters
+    ----------
+    dnn : DNN
+    stimuli : Stimulus, ndarray
+        The shard of stimuli
+    dmask : Mask
+        The mask includes layers/channels/rows/columns of interest.
+    pool_method : str
+        pooling method, choices=(max, mean, median, L1, L2)
+    out_file : str
+        A .act.h5 file
+    n_thread : int
+        The number of threads used by PyTorch in the process
+    kwargs : dict
+        Other keyword arguments passed to DNN.compute_activation()
+    """
+    torch.set_num_threads(n_thread)
+    dnn.compute_activation(stimuli, dmask, pool_method, out_file=out_file, **kwargs)
+
+
+def _gen_file_set(stimuli, transform, labels=None, draft=False):
+    """
+    Generate a dataset which decodes stimuli from files on the disk
+
+    Parameters
+    ----------
+    stimuli : Stimulus
+        Stimuli with type as 'image', 'video' or 'tar'
+    transform : callable
+        The transform for PIL images
+    labels : list
+        Each stimulus's label.
+    draft : bool
+        Decode JPEG images at a reduced scale or not.
+        See ImageSet for details.
+
+    Returns
+    -------
+    stim_set : ImageSet, VideoSet, TarSet
+    """
+    stim_type = stimuli.header['type']
+    if stim_type == 'image':
+        stim_set = ImageSet(stimuli.header['path'], stimuli.get('stimID'),
+                            labels, transform, draft=draft)
+    elif stim_type == 'video':
+        stim_set = VideoSet(stimuli.header['path'], stimuli.get('stimID'),
+                            labels, transform)
+    elif stim_type == 'tar':
+        stim_set = TarSet(stimuli.header['path'], stimuli.get('stimID'),
+                          labels, transform, draft=draft)
+    else:
+        raise TypeError('{} is not a supported stimulus type.'.format(stim_type))
+
+    return stim_set
+
+
+class _ActivationExtractor:
+    """
+    Extract activation of a DNN from batches of stimuli, and hold it in memory
+    or write it into an activation file in the streaming mode.
+    It is used as a context manager, in which the layers of interest are hooked.
+    """
+    def __init__(self, dnn, dmask, pool_method=None, cuda=False, act_file=None,
+                 n_stim=None, n_done=0):
+        """
+        Parameters
+        ----------
+        dnn : DNN
+        dmask : Mask
+            The mask includes layers/channels/rows/columns of interest.
+        pool_method : str
+            pooling method, choices=(max, mean, median, L1, L2)
+        cuda : bool
+            use GPU or not
+        act_file : ActivationFile
+            The activation file opened by ActivationFile.open().
+            If is None, the activation is held in memory.
+        n_stim : int
+            The total number of stimuli in the activation file
+        n_done : int
+            Activation of the first n_done stimuli has been finished in the file,
+            and the extracted batches are positioned after them.
+        """
+        self.dnn = dnn
+        self.dmask = dmask
+        self.pool_method = pool_method
+        self.cuda = cuda
+        self.act_file = act_file
+        self.n_stim = n_stim
+        self.n_start = n_done
+        self.n_done = n_done
+        self._stack = None
+
+    def __enter__(self):
+        # prepare model
+        self.dnn.model.eval()
+        if self.cuda:
+            if self.dnn.quantized:
+                raise ValueError('Quantized models only run on CPU.')
+            assert torch.cuda.is_available(), 'There is no CUDA available.'
+            self.dnn.model.to(torch.device('cuda'))
+
+        # prepare dnn activation hooks
+        # All layers of interest are hooked at once, so that activation
+        # of all of them is filled by a single pass over the stimuli.
+        self._stack = ExitStack()
+        self.batch_acts = dict()
+        self._hooks = dict()
+        for layer in self.dmask.layers:
+            self._hooks[layer] = self.dnn._gen_activation_hook(
+                layer, self.dmask.get(layer), self.pool_method, self.batch_acts)
+        if self.dnn.compiled:
+            # activation of the layers is output by the frozen graph
+            self._traced = self.dnn._get_traced(self.dmask.layers)
+        else:
+            self._traced = None
+            for layer in self.dmask.layers:
+                module = self.dnn.layer2module(layer)
+                self._stack.callback(module.register_forward_hook(self._hooks[layer]).remove)
+            # stop forward passes once all layers of interest are computed
+            self._stack.enter_context(self.dnn.truncate(self.dmask.layers))
+
+        # prepare activation holders
+        if self.act_file is None:
+            self.acts_holders = dict((layer, []) for layer in self.dmask.layers)
+            self.starts = []
+        else:
+            self.finished = np.zeros(self.n_stim - self.n_start, bool)
+
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._stack.__exit__(*exc_info)
+
+    def extract(self, indices, stims):
+        """
+        Extract activation of a batch
+
+        Parameters
+        ----------
+        indices : list
+            Positions of the batch's stimuli, which are contiguous.
+        stims : tensor
+            Stimuli with shape as (n_stim, n_chn, height, width)
+            on the same device as the model.
+        """
+        if self._traced is None:
+            self.dnn(stims)
+        else:
+            for layer, output in zip(self.dmask.layers, self._traced(stims)):
+                self._hooks[layer](None, None, output)
+
+        # hold activation of the batch
+        start = indices[0]
+        if self.act_file is None:
+            for layer in self.dmask.layers:
+                self.acts_holders[layer].append(self.batch_acts[layer])
+            self.starts.append(start)
+        else:
+            # record progress: activation of the first n_done stimuli is finished
+            finished = self.finished
+            finished[start:start+len(indices)] = True
+            self.n_done = self.n_start + (len(finished) if finished.all()
+                                          else int(np.argmin(finished)))
+            for layer in self.dmask.layers:
+                self.act_file.write_batch(layer, self.batch_acts[layer],
+                                          self.n_start + start, self.n_stim)
+                attrs = self.dnn._mask2attrs(self.dmask.get(layer))
+                attrs['n_done'] = self.n_done
+                self.act_file.write_attrs(attrs, layer)
+            self.act_file.flush()
+
+    def get_activation(self):
+        """
+        Get the activation held in memory
+
+        Returns
+        -------
+        activation : Activation
+            DNN activation in the order of stimuli
+        """
+        activation = Activation()
+        order = np.argsort(self.starts)
+        for layer in self.dmask.layers:
+            activation.set(layer, np.concatenate([self.acts_holders[layer][i] for i in order]))
+
+        return activation
+
+
 class DNN:
     """
     Deep neural network
@@ -115,6 +388,11 @@ class DNN:
     ----------
     model : nn.Modules
         DNN model
+        It is built and loaded with weights when it is first used,
+        so that instantiating a DNN only costs its layer information.
+    weight_file : str
+        The file of the pretrained weights.
+        If is None, the model is randomly initialized.
     layer2loc : dict
         Map layer name to its location in the DNN model
     img_size : tuple
@@ -128,15 +406,76 @@ class DNN:
     def __init__(self):
 
         self.model = None
+        self.weight_file = None
         self.layer2loc = None
         self.img_size = None  # (height, width)
         self.train_transform = None
         self.test_transform = None
+        self.compiled = False  # see self.compile()
+        self._compile_cache = True
+        self._traced = dict()
+        self.quantized = False  # see self.quantize()
+        self._model_fp32 = None
+
+    def __getstate__(self):
+        """
+        TorchScript modules can't be pickled, and are traced again when needed.
+        """
+        state = self.__dict__.copy()
+        state['_traced'] = dict()
+
+        return state
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self._load_model()
+
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
 
     @property
     def layers(self):
         raise NotImplementedError('This method should be implemented in subclasses.')
 
+    def gen_model(self):
+        """
+        Generate the model's architecture without loading weights
+
+        Returns
+        -------
+        model : nn.Module
+        """
+        raise NotImplementedError('This method should be implemented in subclasses.')
+
+    def _load_model(self):
+        """
+        Build the model and load the pretrained weights.
+        The weights are memory-mapped if possible, and assigned to the model
+        built on the meta device, so that they are neither initialized
+        randomly nor copied.
+
+        Returns
+        -------
+        model : nn.Module
+        """
+        if self.weight_file is None:
+            return self.gen_model()
+
+        try:
+            state_dict = torch.load(self.weight_file, map_location='cpu', mmap=True)
+        except RuntimeError:
+            # files in the legacy format of torch.save can't be memory-mapped
+            state_dict = torch.load(self.weight_file, map_location='cpu')
+        with torch.device('meta'):
+            model = self.gen_model()
+        model.load_state_dict(state_dict, assign=True)
+
+        return model
+
     def save(self, fname):
         """
         Save DNN parameters
@@ -178,7 +517,44 @@ class DNN:
         """
         raise NotImplementedError('This method should be implemented in subclasses.')
 
-    def compute_activation(self, stimuli, dmask, pool_method=None, cuda=False):
+    @contextmanager
+    def truncate(self, layers):
+        """
+        Truncated execution mode.
+        Within the context, the forward pass stops right after the deepest
+        layer of the layers is computed, and the rest of the model is skipped.
+        The depth of a layer is its order in the layer2loc.
+
+        Parameters
+        ----------
+        layers : str, list
+            Layer name(s) whose outputs are needed.
+
+        Examples
+        --------
+        >>> with dnn.truncate(['conv1', 'conv2']):
+        ...     outputs = dnn(inputs)  # outputs of the conv2
+        """
+        if isinstance(layers, str):
+            layers = [layers]
+        all_layers = self.layers
+        deepest = max(layers, key=all_layers.index)
+
+        def stop_hook(module, input, output):
+            raise _ForwardStop(output)
+
+        # The stop hook is registered after the hooks used to get activation,
+        # so it is the last one fired on the deepest module.
+        hook_handle = self.layer2module(deepest).register_forward_hook(stop_hook)
+        try:
+            yield self
+        finally:
+            hook_handle.remove()
+
+    def compute_activation(self, stimuli, dmask, pool_method=None, cuda=False,
+                           out_file=None, batch_size=8, n_worker=None,
+                           prefetch=2, pin_memory=None, resume=False, cache=False,
+                           n_proc=1, draft=True, layout=None, compression='gzip'):
         """
         Extract DNN activation
 
@@ -194,88 +570,443 @@ class DNN:
             pooling method, choices=(max, mean, median, L1, L2)
         cuda : bool
             use GPU or not
+        out_file : str
+            A .act.h5 file.
+            If is not None, streaming mode is used: the activation of each batch
+            is written into the file directly rather than held in memory,
+            so that the memory usage is bounded by the batch size.
+        batch_size : int
+            The number of stimuli per batch
+        n_worker : int
+            The number of subprocesses used to load stimuli.
+            If is None, it is chosen according to the CPU count.
+            See gen_data_loader in dnnbrain.dnn.base for details.
+        prefetch : int
+            The number of batches loaded in advance by each worker.
+        pin_memory : bool
+            Use pinned memory for the loaded stimuli or not.
+            If is None, it is the same as cuda.
+        resume : bool
+            Only used in the streaming mode.
+            If true and the out_file exists, continue the extraction recorded
+            in it from the last finished batch rather than start from zero.
+            The stimuli, DNN mask and pooling method must be the same as
+            the recorded ones.
+        cache : bool
+            Only used when out_file is None.
+            If true, activation of each layer is looked up in the activation
+            cache (see dnnbrain.dnn.cache) before running the model, and the
+            computed activation is put into the cache. The cache is keyed on
+            the model weights, test_transform, stimulus contents, layer, mask,
+            pooling method and the compiled mode. Hashes of the stimulus files
+            are memoized by their paths, sizes and modification times.
+        n_proc : int
+            The number of processes which extract activation in parallel on CPU.
+            If n_proc > 1, the stimuli are split into n_proc contiguous shards,
+            and each process extracts a shard into a part file. In the streaming
+            mode, the part files are named as <out_file>.part<i>.act.h5 and
+            out_file is written as virtual datasets which concatenate them,
+            so the part files must be kept with it.
+            The order of stimuli is preserved.
+        draft : bool
+            If true, JPEG images are decoded at the smallest scale which is
+            still not smaller than the input image size, which is much faster
+            for large images. Set it to false to decode images at the full
+            resolution as before, whose activation is bit-identical to the
+            previous versions. It is recorded in the activation file and
+            the cache key.
+        layout : str
+            Only used in the streaming mode.
+            Chunk layout of out_file, choices=(None, stim, chn).
+            See gen_chunks() in dnnbrain.io.fileio for details.
+        compression : str
+            Only used in the streaming mode.
+            Compression of out_file, choices=(gzip, lzf, None).
+            See gen_compression() in dnnbrain.io.fileio for details.
 
         Returns
         -------
         activation : Activation
             DNN activation
+            It is None in the streaming mode.
         """
+        if resume and out_file is None:
+            raise ValueError('resume is only supported in the streaming mode.')
+        if cache and out_file is None:
+            return self._compute_activation_cached(
+                stimuli, dmask, pool_method, cuda, batch_size=batch_size,
+                n_worker=n_worker, prefetch=prefetch, pin_memory=pin_memory,
+                n_proc=n_proc, draft=draft)
+        if n_proc > 1:
+            if cuda:
+                raise ValueError('Multi-process extraction only supports CPU.')
+            return self._compute_activation_parallel(
+                stimuli, dmask, pool_method, out_file, n_proc, resume=resume,
+                batch_size=batch_size, n_worker=n_worker, prefetch=prefetch, draft=draft,
+                layout=layout, compression=compression)
+
+        # prepare activation file in the streaming mode
+        n_stim = len(stimuli)
+        n_done = 0
+        act_file = None
+        if out_file is not None:
+            act_file = ActivationFile(out_file)
+            attrs = {'stimulus': hash_stimuli(stimuli),
+                     'pool': 'none' if pool_method is None else pool_method,
+                     'draft': int(draft)}
+            if resume and os.path.isfile(out_file):
+                act_file.open('a')
+                try:
+                    n_done = self._check_progress(act_file, attrs, dmask)
+                except ValueError:
+                    act_file.close()
+                    raise
+                stimuli = stimuli[n_done:]
+                print('Resume extraction from {0}/{1}'.format(n_done, n_stim))
+            else:
+                act_file.open('w', layout, compression)
+                act_file.write_attrs(attrs)
+
         # prepare stimuli loader
+        stim_set = self._gen_stim_set(stimuli, draft)
+        pin_memory = cuda if pin_memory is None else pin_memory
+        data_loader = gen_data_loader(stim_set, batch_size, False, n_worker,
+                                      prefetch, pin_memory, segment=True)
+
+        # -extract activation-
+        # Batches may be loaded out of order (see gen_data_loader),
+        # so their positions are taken from the batch sampler.
+        n_extracted = n_done
+        extractor = _ActivationExtractor(self, dmask, pool_method, cuda,
+                                         act_file, n_stim, n_done)
+        with torch.no_grad(), extractor:
+            for indices, (stims, _) in zip(iter_batch_indices(data_loader), data_loader):
+                # stimuli with shape as (n_stim, n_chn, height, width)
+                if cuda:
+                    stims = stims.to(torch.device('cuda'))
+                extractor.extract(indices, stims)
+                n_extracted += len(indices)
+                print('Extracted activation of {0}: {1}/{2}'.format(
+                    ', '.join(dmask.layers), n_extracted, n_stim))
+
+        if out_file is None:
+            activation = extractor.get_activation()
+        else:
+            act_file.close()
+            activation = None
+
+        return activation
+
+    def _gen_stim_set(self, stimuli, draft=True):
+        """
+        Generate the dataset which loads the stimuli with self.test_transform
+
+        Parameters
+        ----------
+        stimuli : Stimulus, ndarray
+            Input stimuli
+        draft : bool
+            Decode JPEG images in draft mode or not
+
+        Returns
+        -------
+        stim_set : ImageSet, VideoSet, PackSet, TarSet, ArraySet
+        """
         if isinstance(stimuli, np.ndarray):
-            stim_set = []
-            for arr in stimuli:
-                img = Image.fromarray(arr.transpose((1, 2, 0)))
-                stim_set.append((self.test_transform(img), 0))
+            stim_set = ArraySet(stimuli, transform=self.test_transform)
+        elif isinstance(stimuli, Stimulus) and stimuli.header['type'] == 'pack':
+            stim_set = PackSet(stimuli.header['path'],
+                               transform=gen_pack_transform(self.test_transform))
+            self._check_pack(stim_set)
         elif isinstance(stimuli, Stimulus):
-            if stimuli.header['type'] == 'image':
-                stim_set = ImageSet(stimuli.header['path'], stimuli.get('stimID'),
-                                    transform=self.test_transform)
-            elif stimuli.header['type'] == 'video':
-                stim_set = VideoSet(stimuli.header['path'], stimuli.get('stimID'),
-                                    transform=self.test_transform)
-            else:
-                raise TypeError('{} is not a supported stimulus type.'.format(stimuli.header['type']))
+            stim_set = _gen_file_set(stimuli, self.test_transform, draft=draft)
         else:
             raise TypeError('The input stimuli must be an instance of ndarray or Stimulus!')
-        data_loader = DataLoader(stim_set, 8, shuffle=False)
 
-        # -extract activation-
-        # prepare model
-        self.model.eval()
-        if cuda:
-            assert torch.cuda.is_available(), 'There is no CUDA available.'
-            self.model.to(torch.device('cuda'))
+        return stim_set
+
+    def _check_pack(self, pack_set):
+        """
+        Check the images in a stimulus pack match the input image size
+
+        Parameters
+        ----------
+        pack_set : PackSet
+        """
+        if self.img_size is not None and tuple(pack_set.shape[2:]) != tuple(self.img_size):
+            raise ValueError('The size of packed images {0} mismatches the input image '
+                             'size {1}. Please pack the stimuli for {2}.'.format(
+                              pack_set.shape[2:], self.img_size, self.__class__.__name__))
+
+    def _compute_activation_parallel(self, stimuli, dmask, pool_method, out_file,
+                                     n_proc, **kwargs):
+        """
+        Extract DNN activation by multiple processes.
+        Each process extracts a contiguous shard of the stimuli into a part file.
+
+        Parameters
+        ----------
+        stimuli : Stimulus, ndarray
+            Input stimuli
+        dmask : Mask
+            The mask includes layers/channels/rows/columns of interest.
+        pool_method : str
+            pooling method, choices=(max, mean, median, L1, L2)
+        out_file : str
+            A .act.h5 file.
+            If is None, the part files are written into a temporary directory
+            and the activation is returned in memory.
+        n_proc : int
+            The number of processes
+        kwargs : dict
+            Other keyword arguments passed to self.compute_activation()
+
+        Returns
+        -------
+        activation : Activation
+            DNN activation
+            It is None if out_file is not None.
+        """
+        # prepare the part files
+        if out_file is None:
+            tmp_dir = tempfile.mkdtemp(prefix='dnnbrain_')
+            fname = pjoin(tmp_dir, 'activation.act.h5')
+        else:
+            fname = out_file
+        # loading by subprocesses of each process is off by default
+        if kwargs.get('n_worker') is None:
+            kwargs['n_worker'] = 0
+
+        # start a process for each shard
+        # share CPU cores among the processes rather than oversubscribe them
+        n_thread = max(os.cpu_count() // n_proc, 1)
+        part_files = []
+        processes = []
+        try:
+            for part_idx, indices in enumerate(np.array_split(np.arange(len(stimuli)), n_proc)):
+                if len(indices) == 0:
+                    continue
+                part_file = fname[:-len('.act.h5')] + '.part{}.act.h5'.format(part_idx)
+                shard = stimuli[indices[0]:indices[-1]+1]
+                process = multiprocessing.Process(
+                    target=_extract_shard,
+                    args=(self, shard, dmask, pool_method, part_file, n_thread, kwargs))
+                process.start()
+                part_files.append(part_file)
+                processes.append(process)
+            for process in processes:
+                process.join()
+            for part_file, process in zip(part_files, processes):
+                if process.exitcode != 0:
+                    raise RuntimeError('Failed to extract activation into {}'.format(part_file))
+
+            # merge the part files
+            act_file = ActivationFile(fname)
+            act_file.write_virtual(part_files)
+            if out_file is None:
+                activation = Activation()
+                activation.load(fname)
+            else:
+                activation = None
+        except BaseException:
+            # don't leave the processes and part files of a failed extraction behind
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            if out_file is not None:
+                for part_file in part_files:
+                    if os.path.exists(part_file):
+                        os.remove(part_file)
+            raise
+        finally:
+            if out_file is None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return activation
+
+    def _compute_activation_cached(self, stimuli, dmask, pool_method, cuda, draft,
+                                   **kwargs):
+        """
+        Extract DNN activation through the activation cache.
+        Only layers missing in the cache are computed by the model.
 
-        n_stim = len(stim_set)
+        Parameters
+        ----------
+        stimuli : Stimulus, ndarray
+            Input stimuli
+        dmask : Mask
+            The mask includes layers/channels/rows/columns of interest.
+        pool_method : str
+            pooling method, choices=(max, mean, median, L1, L2)
+        cuda : bool
+            use GPU or not
+        draft : bool
+            Decode JPEG images in draft mode or not
+        kwargs : dict
+            Keyword arguments of the data loader passed to self.compute_activation()
+
+        Returns
+        -------
+        activation : Activation
+            DNN activation
+        """
+        # stimulus files are hashed again only if their sizes or modification times change
+        act_cache = ActivationCache()
+        file_hashes = act_cache.read_file_hashes()
+        factors = {'weights': hash_model(self.model),
+                   'transform': repr(self.test_transform),
+                   'stimulus': hash_stimuli(stimuli, True, file_hashes),
+                   'pool': pool_method}
+        act_cache.write_file_hashes(file_hashes)
+        if draft and isinstance(stimuli, Stimulus) and stimuli.header['type'] in ('image', 'tar'):
+            # the key of exact decoding is the same as before
+            factors['draft'] = True
+        if self.compiled:
+            # the compiled model's activation differs slightly from the eager one
+            factors['compiled'] = True
+
+        # look up the cache
+        keys = dict()
         activation = Activation()
+        dmask_miss = Mask()
         for layer in dmask.layers:
-            # prepare dnn activation hook
-            acts_holder = []
+            mask = dmask.get(layer)
+            keys[layer] = act_cache.gen_key(layer=layer, mask=mask, **factors)
+            data = act_cache.get(keys[layer])
+            if data is None:
+                dmask_miss.set(layer, channels=mask['chn'], rows=mask['row'],
+                               columns=mask['col'])
+            else:
+                activation.set(layer, data)
+                print('Loaded activation of {} from the cache'.format(layer))
+
+        # compute the missing layers and put them into the cache
+        if dmask_miss.layers:
+            activation_miss = self.compute_activation(stimuli, dmask_miss, pool_method,
+                                                      cuda, draft=draft, **kwargs)
+            for layer in dmask_miss.layers:
+                data = activation_miss.get(layer)
+                info = {'net': self.__class__.__name__, 'layer': layer,
+                        'mask': dmask.get(layer), 'pool': pool_method}
+                act_cache.set(keys[layer], data, info)
+                activation.set(layer, data)
+
+        # keep the order of layers
+        activation_ordered = Activation()
+        for layer in dmask.layers:
+            activation_ordered.set(layer, activation.get(layer))
 
-            def hook_act(module, input, output):
+        return activation_ordered
 
-                # copy activation
-                if cuda:
-                    acts = output.cpu().data.numpy().copy()
-                else:
-                    acts = output.detach().numpy().copy()
+    @staticmethod
+    def _mask2attrs(mask):
+        """
+        Convert a layer's mask to attributes of the activation file
 
-                # unify dimension number
-                if acts.ndim == 4:
-                    pass
-                elif acts.ndim == 2:
-                    acts = acts[:, :, None, None]
-                else:
-                    raise ValueError('Unexpected activation shape:', acts.shape)
+        Parameters
+        ----------
+        mask : dict
+            The mask of the layer with keys as ('chn', 'row', 'col')
 
-                # mask activation
-                mask = dmask.get(layer)
-                acts = dnn_mask(acts, mask.get('chn'),
-                                mask.get('row'), mask.get('col'))
+        Returns
+        -------
+        attrs : dict
+        """
+        attrs = dict()
+        for k, v in mask.items():
+            attrs[k] = v if isinstance(v, str) else np.asarray(v)
 
-                # pool activation
-                if pool_method is not None:
-                    acts = array_statistic(acts, pool_method, (2, 3), True)
+        return attrs
 
-                # hold activation
-                acts_holder.extend(acts)
+    def _check_progress(self, act_file, attrs, dmask):
+        """
+        Check an unfinished activation file is consistent with the extraction
+        and find where to resume it.
 
-            module = self.layer2module(layer)
-            hook_handle = module.register_forward_hook(hook_act)
+        Parameters
+        ----------
+        act_file : ActivationFile
+            The activation file opened by ActivationFile.open()
+        attrs : dict
+            Attributes of the file, including the stimulus hash and pooling method.
+        dmask : Mask
+            The mask includes layers/channels/rows/columns of interest.
 
-            # extract DNN activation
-            for stims, _ in data_loader:
-                # stimuli with shape as (n_stim, n_chn, height, width)
-                if cuda:
-                    stims = stims.to(torch.device('cuda'))
-                self.model(stims)
-                print('Extracted activation of {0}: {1}/{2}'.format(
-                    layer, len(acts_holder), n_stim))
-            activation.set(layer, np.asarray(acts_holder))
+        Returns
+        -------
+        n_done : int
+            Activation of the first n_done stimuli is finished for all layers.
+        """
+        attrs_file = act_file.read_attrs()
+        for k, v in attrs.items():
+            if attrs_file.get(k) != v:
+                raise ValueError("The {0} of {1} is different from the current "
+                                 "extraction.".format(k, act_file.fname))
 
-            hook_handle.remove()
+        n_dones = []
+        for layer in dmask.layers:
+            attrs_layer = act_file.read_attrs(layer)
+            for k, v in self._mask2attrs(dmask.get(layer)).items():
+                if k in attrs_layer and not np.array_equal(attrs_layer[k], v):
+                    raise ValueError("The mask of {0} in {1} is different from "
+                                     "the current extraction.".format(layer, act_file.fname))
+            n_dones.append(attrs_layer.get('n_done', 0))
 
-        return activation
+        return int(min(n_dones))
+
+    @staticmethod
+    def _gen_activation_hook(layer, mask, pool_method, batch_acts):
+        """
+        Generate a forward hook which holds the layer's activation
+
+        Parameters
+        ----------
+        layer : str
+            Layer name
+        mask : dict
+            The mask of the layer with keys as ('chn', 'row', 'col')
+        pool_method : str
+            pooling method, choices=(max, mean, median, L1, L2)
+        batch_acts : dict
+            The hooked activation of the current batch is set to
+            this dict with the layer name as its key.
+
+        Returns
+        -------
+        hook_act : callable
+            The forward hook
+        """
+        def hook_act(module, input, output):
+
+            # unify dimension number
+            acts = output.detach()
+            if acts.ndim == 4:
+                pass
+            elif acts.ndim == 2:
+                acts = acts[:, :, None, None]
+            else:
+                raise ValueError('Unexpected activation shape of {}:'.format(layer),
+                                 acts.shape)
+
+            # mask and pool activation on the device of the output,
+            # so that only the reduced activation is copied out
+            acts = dnn_mask(acts, mask.get('chn'),
+                            mask.get('row'), mask.get('col'))
+            if pool_method is not None:
+                acts = array_statistic(acts, pool_method, (2, 3), True)
+
+            # copy activation
+            # The output can't be shared since the following
+            # layers may modify it in place, e.g. ReLU(inplace=True).
+            if acts.device.type == 'cpu' and acts.data_ptr() == output.data_ptr():
+                acts = acts.clone()
+            acts = acts.cpu().numpy()
+
+            # hold activation
+            batch_acts[layer] = acts
+
+        return hook_act
 
     def get_kernel(self, layer, kernels=None):
         """
@@ -309,6 +1040,225 @@ class DNN:
 
         return weights
 
+    def compile(self, enable=True, cache=True):
+        """
+        Compiled inference mode.
+        The model is traced by TorchScript and frozen, which folds convolution
+        and batch normalization (e.g. in Vgg19_bn and Resnet152) and removes
+        the computation after the layers of interest. In the mode,
+        self.compute_activation() runs the frozen graph, in which activation
+        of the layers of interest are extra outputs rather than taken by hooks.
+        Calling the DNN without gradients runs it too, unless hooks are
+        registered on the model, which only work on the eager modules.
+        Training and methods which need gradients still use the eager modules.
+
+        Parameters
+        ----------
+        enable : bool
+            Enable or disable the compiled inference mode
+        cache : bool
+            If true, frozen graphs are saved into the directory of model
+            weights ($DNNBRAIN_DATA/models) and loaded next time.
+            They are keyed on the model weights, layers, device and PyTorch version.
+
+        Returns
+        -------
+        self : DNN
+        """
+        self.compiled = enable
+        self._compile_cache = cache
+        self._traced = dict()
+
+        return self
+
+    def _get_traced(self, layers):
+        """
+        Get the frozen TorchScript module of the model,
+        which is traced on the device of the model in eval mode.
+
+        Parameters
+        ----------
+        layers : list
+            Layer names
+            The module outputs a tuple of their activation.
+            If is empty, the module outputs the output of the model.
+
+        Returns
+        -------
+        traced : ScriptModule
+        """
+        # the weights are modified in place by loading and training,
+        # which increases versions of the tensors
+        # quantized weights are packed, and are replaced rather than modified
+        tensors = [v for v in self.model.state_dict(keep_vars=True).values()
+                   if isinstance(v, torch.Tensor)]
+        device = tensors[0].device
+        weights = [id(self.model)] + [(v.data_ptr(), v._version) for v in tensors
+                                      if not v.is_quantized]
+        key = (tuple(layers), str(device))
+        if key in self._traced and self._traced[key][0] == weights:
+            return self._traced[key][1]
+
+        fname = None
+        if self._compile_cache:
+            name = ActivationCache.gen_key(
+                net=self.__class__.__name__, weights=hash_model(self.model),
+                layers=list(layers), img_size=self.img_size,
+                device=device.type, torch=torch.__version__)
+            model_dir = get_model_dir()
+            fname = pjoin(model_dir, '{0}_{1}.jit.pt'.format(
+                self.__class__.__name__.lower(), name[:16]))
+
+        if fname is not None and os.path.isfile(fname):
+            traced = torch.jit.load(fname, map_location=device)
+        else:
+            self.model.eval()
+            module = _LayerOutputs(self.model, [self.layer2module(layer) for layer in layers])
+            inputs = torch.zeros((2, 3, *self.img_size), device=device)
+            with torch.no_grad(), warnings.catch_warnings():
+                warnings.simplefilter('ignore', torch.jit.TracerWarning)
+                traced = torch.jit.freeze(torch.jit.trace(module.eval(), inputs))
+            if fname is not None:
+                # write a temporary file first, so that readers never see a partial file
+                fname_tmp = '{0}.{1}.tmp'.format(fname, os.getpid())
+                try:
+                    if not os.path.isdir(model_dir):
+                        os.makedirs(model_dir)
+                    torch.jit.save(traced, fname_tmp)
+                    os.replace(fname_tmp, fname)
+                except OSError:
+                    warnings.warn('Failed to save the compiled model into ' + fname)
+        self._traced[key] = (weights, traced)
+
+        return traced
+
+    def quantize(self, enable=True, conv=False, stimuli=None, n_calib=64,
+                 batch_size=8, draft=True):
+        """
+        Quantized inference mode.
+        Weights of fully connected layers are quantized to int8, and their
+        inputs are quantized dynamically batch by batch. If conv is true,
+        convolutional layers are quantized statically too, whose input ranges
+        are calibrated on the first n_calib stimuli. Outputs of the quantized
+        layers are still float, so activation is extracted as before.
+        It is much faster on CPU, especially for the convolutional layers,
+        at the cost of errors in activation, which can be measured by
+        self.quantization_error(). Quantized models only run on CPU.
+        The fp32 model is kept and restored by self.quantize(False).
+
+        Parameters
+        ----------
+        enable : bool
+            Enable or disable the quantized inference mode
+        conv : bool
+            Quantize convolutional layers or not
+        stimuli : Stimulus, ndarray
+            Stimuli used to calibrate the convolutional layers.
+            It is required if conv is true.
+        n_calib : int
+            The number of stimuli used to calibrate
+        batch_size : int
+            The number of stimuli per batch in the calibration
+        draft : bool
+            Decode JPEG images in draft mode or not
+
+        Returns
+        -------
+        self : DNN
+        """
+        if self.quantized:
+            self.model = self._model_fp32
+            self._model_fp32 = None
+            self.quantized = False
+        if not enable:
+            return self
+        if conv and stimuli is None:
+            raise ValueError('Stimuli are required to calibrate the convolutional layers.')
+
+        model = copy.deepcopy(self.model).cpu().eval()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            warnings.filterwarnings('ignore', 'Please use quant_min and quant_max')
+            warnings.filterwarnings('ignore', 'torch.quantize_per_tensor')
+            if conv:
+                # Each convolutional layer is wrapped by quantization of its
+                # input and dequantization of its output, so that the paths
+                # of modules and their hooks are kept.
+                qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+                for module in list(model.modules()):
+                    for name, child in list(module.named_children()):
+                        if isinstance(child, nn.Conv2d):
+                            child = quantization.QuantWrapper(child)
+                            child.qconfig = qconfig
+                            setattr(module, name, child)
+                quantization.prepare(model, inplace=True)
+
+                # calibrate
+                stim_set = self._gen_stim_set(stimuli, draft)
+                stim_set = Subset(stim_set, range(min(n_calib, len(stim_set))))
+                with torch.no_grad():
+                    for stims, _ in gen_data_loader(stim_set, batch_size):
+                        model(stims)
+                quantization.convert(model, inplace=True)
+            model = quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+        self._model_fp32 = self.model
+        self.model = model
+        self.quantized = True
+
+        return self
+
+    def quantization_error(self, stimuli, dmask, pool_method=None, batch_size=8,
+                           n_worker=None, draft=True):
+        """
+        Compare activation of the quantized model with that of the fp32 model
+
+        Parameters
+        ----------
+        stimuli : Stimulus, ndarray
+            Input stimuli
+        dmask : Mask
+            The mask includes layers/channels/rows/columns of interest.
+        pool_method : str
+            pooling method, choices=(max, mean, median, L1, L2)
+        batch_size : int
+            The number of stimuli per batch
+        n_worker : int
+            The number of subprocesses used to load stimuli.
+        draft : bool
+            Decode JPEG images in draft mode or not
+
+        Returns
+        -------
+        errors : dict
+            Map layer name to a dict of its errors:
+            rel_err: the norm of the error relative to the norm of fp32 activation
+            max_err: the max absolute error
+            r: Pearson correlation between the quantized and fp32 activation
+        """
+        assert self.quantized, 'The quantized inference mode is disabled.'
+        kwargs = {'pool_method': pool_method, 'batch_size': batch_size,
+                  'n_worker': n_worker, 'draft': draft}
+        act_quant = self.compute_activation(stimuli, dmask, **kwargs)
+        model_quant = self.model
+        self.model = self._model_fp32
+        try:
+            act_fp32 = self.compute_activation(stimuli, dmask, **kwargs)
+        finally:
+            self.model = model_quant
+
+        errors = dict()
+        for layer in dmask.layers:
+            data_quant = act_quant.get(layer).astype(np.float64).ravel()
+            data_fp32 = act_fp32.get(layer).astype(np.float64).ravel()
+            diff = data_quant - data_fp32
+            errors[layer] = {
+                'rel_err': np.linalg.norm(diff) / np.linalg.norm(data_fp32),
+                'max_err': np.max(np.abs(diff)),
+                'r': np.corrcoef(data_quant, data_fp32)[0, 1]}
+
+        return errors
+
     def ablate(self, layer, channels=None):
         """
         Ablate DNN kernels' weights
@@ -331,8 +1281,12 @@ class DNN:
             channels = [chn - 1 for chn in channels]
             module.weight.data[channels] = 0
 
+        # modifying .data doesn't increase the version of the weights
+        self._traced = dict()
+
     def train(self, data, n_epoch, task, optimizer=None, method='tradition', target=None,
-              data_train=False, data_validation=None):
+              data_train=False, data_validation=None, batch_size=64, n_worker=None,
+              prefetch=2, pin_memory=None):
         """
         Train the DNN model
 
@@ -369,6 +1323,17 @@ class DNN:
         data_validation : Stimulus, ndarray
             Validation data.
             If is not None, test model performance on the validation data.
+        batch_size : int
+            The number of stimuli per batch
+        n_worker : int
+            The number of subprocesses used to load stimuli.
+            If is None, it is chosen according to the CPU count.
+            See gen_data_loader in dnnbrain.dnn.base for details.
+        prefetch : int
+            The number of batches loaded in advance by each worker.
+        pin_memory : bool
+            Use pinned memory for the loaded stimuli or not.
+            If is None, it is the same as whether CUDA is available.
 
         Returns
         -------
@@ -391,8 +1356,7 @@ class DNN:
         """
         # prepare data loader
         if isinstance(data, np.ndarray):
-            stim_set = [Image.fromarray(arr.transpose((1, 2, 0))) for arr in data]
-            stim_set = [(self.train_transform(img), trg) for img, trg in zip(stim_set, target)]
+            stim_set = ArraySet(data, target, self.train_transform)
         elif isinstance(data, Stimulus):
             if data.header['type'] == 'image':
                 stim_set = ImageSet(data.header['path'], data.get('stimID'),
@@ -400,6 +1364,14 @@ class DNN:
             elif data.header['type'] == 'video':
                 stim_set = VideoSet(data.header['path'], data.get('stimID'),
                                     data.get('label'), transform=self.train_transform)
+            elif data.header['type'] == 'tar':
+                stim_set = TarSet(data.header['path'], data.get('stimID'),
+                                  data.get('label'), transform=self.train_transform)
+            elif data.header['type'] == 'pack':
+                # random augmentations are applied to the packed images
+                stim_set = PackSet(data.header['path'], data.get('label'),
+                                   transform=gen_pack_transform(self.train_transform, False))
+                self._check_pack(stim_set)
             else:
                 raise TypeError(f"{data.header['type']} is not a supported stimulus type.")
 
@@ -409,7 +1381,10 @@ class DNN:
                 stim_set = [(img, trg) for img, trg in zip(stim_set[:][0], target)]
         else:
             raise TypeError('The input data must be an instance of ndarray or Stimulus!')
-        data_loader = DataLoader(stim_set, 64, shuffle=True)
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        data_loader = gen_data_loader(stim_set, batch_size, True, n_worker,
+                                      prefetch, pin_memory)
 
         # prepare criterion
         if task == 'classification':
@@ -473,12 +1448,16 @@ class DNN:
 
             # test performance
             if data_train:
-                test_dict = self.test(data, task, target, torch.cuda.is_available())
+                test_dict = self.test(data, task, target, torch.cuda.is_available(),
+                                      n_worker=n_worker, prefetch=prefetch,
+                                      pin_memory=pin_memory)
                 print(f"Score_on_train: {test_dict['score']}")
                 train_dict['score_train'].append(test_dict['score'])
                 self.model.train()
             if data_validation is not None:
-                test_dict = self.test(data_validation, task, target, torch.cuda.is_available())
+                test_dict = self.test(data_validation, task, target, torch.cuda.is_available(),
+                                      n_worker=n_worker, prefetch=prefetch,
+                                      pin_memory=pin_memory)
                 print(f"Score_on_test: {test_dict['score']}")
                 train_dict['score_validation'].append(test_dict['score'])
                 self.model.train()
@@ -494,7 +1473,8 @@ class DNN:
         self.model.to(torch.device('cpu'))
         return train_dict
 
-    def test(self, data, task, target=None, cuda=False):
+    def test(self, data, task, target=None, cuda=False, batch_size=8,
+             n_worker=None, prefetch=2, pin_memory=None, draft=True):
         """
         Test the DNN model
 
@@ -517,6 +1497,20 @@ class DNN:
             Note, n_feat is the number of features of the last layer.
         cuda : bool
             Use GPU or not
+        batch_size : int
+            The number of stimuli per batch
+        n_worker : int
+            The number of subprocesses used to load stimuli.
+            If is None, it is chosen according to the CPU count.
+            See gen_data_loader in dnnbrain.dnn.base for details.
+        prefetch : int
+            The number of batches loaded in advance by each worker.
+        pin_memory : bool
+            Use pinned memory for the loaded stimuli or not.
+            If is None, it is the same as cuda.
+        draft : bool
+            Decode JPEG images at a reduced scale or not.
+            See self.compute_activation() for details.
 
         Returns
         -------
@@ -543,17 +1537,27 @@ class DNN:
             |                |    score    |     float     | Prediction accuracy.                     |
             +----------------+-------------+---------------+------------------------------------------+
         """
+        from scipy.stats import pearsonr
+
         # prepare data loader
         if isinstance(data, np.ndarray):
-            stim_set = [Image.fromarray(arr.transpose((1, 2, 0))) for arr in data]
-            stim_set = [(self.test_transform(img), trg) for img, trg in zip(stim_set, target)]
+            stim_set = ArraySet(data, target, self.test_transform)
         elif isinstance(data, Stimulus):
             if data.header['type'] == 'image':
                 stim_set = ImageSet(data.header['path'], data.get('stimID'),
-                                    data.get('label'), transform=self.test_transform)
+                                    data.get('label'), transform=self.test_transform,
+                                    draft=draft)
             elif data.header['type'] == 'video':
                 stim_set = VideoSet(data.header['path'], data.get('stimID'),
                                     data.get('label'), transform=self.test_transform)
+            elif data.header['type'] == 'tar':
+                stim_set = TarSet(data.header['path'], data.get('stimID'),
+                                  data.get('label'), transform=self.test_transform,
+                                  draft=draft)
+            elif data.header['type'] == 'pack':
+                stim_set = PackSet(data.header['path'], data.get('label'),
+                                   transform=gen_pack_transform(self.test_transform))
+                self._check_pack(stim_set)
             else:
                 raise TypeError(f"{data.header['type']} is not a supported stimulus type.")
 
@@ -563,7 +1567,9 @@ class DNN:
                 stim_set = [(img, trg) for img, trg in zip(stim_set[:][0], target)]
         else:
             raise TypeError('The input data must be an instance of ndarray or Stimulus!')
-        data_loader = DataLoader(stim_set, 8, shuffle=False)
+        pin_memory = cuda if pin_memory is None else pin_memory
+        data_loader = gen_data_loader(stim_set, batch_size, False, n_worker,
+                                      prefetch, pin_memory)
 
         # start test
         self.model.eval()
@@ -619,20 +1625,148 @@ class DNN:
         outputs : Tensor
             Output of the model, usually with shape as (n_stim, n_feat).
             n_feat is the number of out features in the last layer of the model.
+            In the truncated execution mode, it is the output of the layer
+            where the forward pass stops.
+            In the compiled inference mode without gradients and hooks,
+            it is computed by the frozen graph (see self.compile()).
         """
-        outputs = self.model(inputs)
+        if self.compiled and not torch.is_grad_enabled() and \
+                not any(module._forward_hooks or module._forward_pre_hooks
+                        for module in self.model.modules()):
+            return self._get_traced([])(inputs)
+
+        try:
+            outputs = self.model(inputs)
+        except _ForwardStop as stop:
+            outputs = stop.output
 
         return outputs
 
 
+def compute_activations(dnns, stimuli, dmasks, pool_method=None, cuda=False,
+                        out_files=None, batch_size=8, n_worker=None, prefetch=2,
+                        pin_memory=None, draft=True, layout=None, compression='gzip'):
+    """
+    Extract activation of several DNNs in one pass over the stimuli.
+    Each stimulus is decoded once and transformed by the test_transform
+    of each DNN, and DNNs with the same test_transform share the transformed
+    stimulus. Then each DNN runs on its own stimuli.
+
+    Parameters
+    ----------
+    dnns : list
+        DNN objects
+    stimuli : Stimulus, ndarray
+        Input stimuli
+        Stimuli which needn't decoding, i.e. ndarray and stimulus packs,
+        are extracted DNN by DNN with DNN.compute_activation().
+    dmasks : list
+        The mask of each DNN, which includes layers/channels/rows/columns of interest.
+    pool_method : str
+        pooling method, choices=(max, mean, median, L1, L2)
+    cuda : bool
+        use GPU or not
+    out_files : list
+        The .act.h5 file of each DNN.
+        If is not None, streaming mode is used. See DNN.compute_activation().
+    batch_size : int
+        The number of stimuli per batch
+    n_worker : int
+        The number of subprocesses used to load stimuli.
+        If is None, it is chosen according to the CPU count.
+    prefetch : int
+        The number of batches loaded in advance by each worker.
+    pin_memory : bool
+        Use pinned memory for the loaded stimuli or not.
+        If is None, it is the same as cuda.
+    draft : bool
+        Decode JPEG images at a reduced scale or not.
+        The scale is large enough for all the DNNs.
+        See DNN.compute_activation() for details.
+    layout : str
+        Only used in the streaming mode.
+        Chunk layout of out_files, choices=(None, stim, chn).
+    compression : str
+        Only used in the streaming mode.
+        Compression of out_files, choices=(gzip, lzf, None).
+
+    Returns
+    -------
+    activations : list
+        Activation of each DNN
+        It is None in the streaming mode.
+    """
+    if len(dmasks) != len(dnns):
+        raise ValueError('The number of DNN masks must be the same as DNNs.')
+    if out_files is not None and len(out_files) != len(dnns):
+        raise ValueError('The number of output files must be the same as DNNs.')
+
+    # stimuli which needn't decoding
+    if isinstance(stimuli, np.ndarray) or \
+            (isinstance(stimuli, Stimulus) and stimuli.header['type'] == 'pack'):
+        activations = []
+        for idx, dnn in enumerate(dnns):
+            out_file = None if out_files is None else out_files[idx]
+            activations.append(dnn.compute_activation(
+                stimuli, dmasks[idx], pool_method, cuda, out_file, batch_size,
+                n_worker, prefetch, pin_memory, draft=draft, layout=layout,
+                compression=compression))
+        return activations
+    if not isinstance(stimuli, Stimulus):
+        raise TypeError('The input stimuli must be an instance of ndarray or Stimulus!')
+
+    # prepare stimuli loader
+    # the stimuli are a tuple of batches, one per distinct transform
+    transform = TransformGroup([dnn.test_transform for dnn in dnns])
+    stim_set = _gen_file_set(stimuli, transform, draft=draft)
+    pin_memory = cuda if pin_memory is None else pin_memory
+    data_loader = gen_data_loader(stim_set, batch_size, False, n_worker,
+                                  prefetch, pin_memory, segment=True)
+
+    # prepare activation extractors
+    n_stim = len(stimuli)
+    extractors = []
+    for idx, dnn in enumerate(dnns):
+        act_file = None
+        if out_files is not None:
+            act_file = ActivationFile(out_files[idx])
+            act_file.open('w', layout, compression)
+            act_file.write_attrs({'stimulus': hash_stimuli(stimuli),
+                                  'pool': 'none' if pool_method is None else pool_method,
+                                  'draft': int(draft)})
+        extractors.append(_ActivationExtractor(dnn, dmasks[idx], pool_method,
+                                               cuda, act_file, n_stim))
+
+    # extract DNN activation
+    n_extracted = 0
+    with torch.no_grad(), ExitStack() as stack:
+        for extractor in extractors:
+            stack.enter_context(extractor)
+        for indices, (stims, _) in zip(iter_batch_indices(data_loader), data_loader):
+            if cuda:
+                stims = [batch.to(torch.device('cuda')) for batch in stims]
+            for extractor, trans_idx in zip(extractors, transform.indices):
+                extractor.extract(indices, stims[trans_idx])
+            n_extracted += len(indices)
+            print('Extracted activation of {0} DNNs: {1}/{2}'.format(
+                len(dnns), n_extracted, n_stim))
+
+    activations = []
+    for extractor in extractors:
+        if extractor.act_file is None:
+            activations.append(extractor.get_activation())
+        else:
+            extractor.act_file.close()
+            activations.append(None)
+
+    return activations
+
+
 class AlexNet(DNN):
 
     def __init__(self, pretrained=True):
         super(AlexNet, self).__init__()
-        self.model = tv_models.alexnet()
-        if pretrained:
-            self.model.load_state_dict(torch.load(
-                pjoin(DNNBRAIN_MODEL, 'alexnet.pth')))
+        self.weight_file = pjoin(get_model_dir(), 'alexnet.pth') if pretrained else None
         self.layer2loc = {'conv1':          ('features', '0'),
                           'conv1_relu':     ('features', '1'),
                           'conv1_maxpool':  ('features', '2'),
@@ -666,6 +1800,16 @@ class AlexNet(DNN):
             normalize
         ])
 
+    def gen_model(self):
+        """
+        Generate the model's architecture without loading weights
+
+        Returns
+        -------
+        model : nn.Module
+        """
+        return tv_models.alexnet()
+
     @property
     def layers(self):
         """
@@ -704,10 +1848,7 @@ class VggFace(DNN):
     def __init__(self, pretrained=True):
         super(VggFace, self).__init__()
 
-        self.model = VggFaceModel()
-        if pretrained:
-            self.model.load_state_dict(torch.load(
-                pjoin(DNNBRAIN_MODEL, 'vgg_face_dag.pth')))
+        self.weight_file = pjoin(get_model_dir(), 'vgg_face_dag.pth') if pretrained else None
         self.layer2loc = {'conv1_1': ('conv1_1',),
                           'relu1_1': ('relu1_1',),
                           'conv1_2': ('conv1_2',),
@@ -755,6 +1896,16 @@ class VggFace(DNN):
             transforms.ToTensor()
         ])
 
+    def gen_model(self):
+        """
+        Generate the model's architecture without loading weights
+
+        Returns
+        -------
+        model : nn.Module
+        """
+        return VggFaceModel()
+
     @property
     def layers(self):
         """
@@ -793,10 +1944,7 @@ class Vgg11(DNN):
     def __init__(self, pretrained=True):
         super(Vgg11, self).__init__()
 
-        self.model = tv_models.vgg11()
-        if pretrained:
-            self.model.load_state_dict(torch.load(
-                pjoin(DNNBRAIN_MODEL, 'vgg11.pth')))
+        self.weight_file = pjoin(get_model_dir(), 'vgg11.pth') if pretrained else None
         self.layer2loc = {'conv1':          ('features', '0'),
                           'conv1_relu':     ('features', '1'),
                           'conv1_maxpool':  ('features', '2'),
@@ -838,6 +1986,16 @@ class Vgg11(DNN):
             normalize
         ])
 
+    def gen_model(self):
+        """
+        Generate the model's architecture without loading weights
+
+        Returns
+        -------
+        model : nn.Module
+        """
+        return tv_models.vgg11()
+
     @property
     def layers(self):
         """
@@ -874,10 +2032,7 @@ class Vgg11(DNN):
 class Vgg19_bn(DNN):
     def __init__(self, pretrained=True):
         super(Vgg19_bn, self).__init__()
-        self.model = tv_models.vgg19_bn()
-        if pretrained:
-            self.model.load_state_dict(torch.load(
-                pjoin(DNNBRAIN_MODEL, 'vgg19_bn.pth')))
+        self.weight_file = pjoin(get_model_dir(), 'vgg19_bn.pth') if pretrained else None
         self.layer2loc = {'conv1':          ('features', '0'),
                           'conv1_relu':     ('features', '1'),
                           'conv1_bn':       ('features', '2'),
@@ -951,6 +2106,16 @@ class Vgg19_bn(DNN):
             normalize
         ])
 
+    def gen_model(self):
+        """
+        Generate the model's architecture without loading weights
+
+        Returns
+        -------
+        model : nn.Module
+        """
+        return tv_models.vgg19_bn()
+
     @property
     def layers(self):
         return list(self.layer2loc.keys())
@@ -979,10 +2144,7 @@ class Vgg19_bn(DNN):
 class Googlenet(DNN):
     def __init__(self, pretrained=True):
         super(Googlenet, self).__init__()
-        self.model = tv_models.googlenet()
-        if pretrained:
-            self.model.load_state_dict(torch.load(
-                pjoin(DNNBRAIN_MODEL, 'googlenet.pth')))
+        self.weight_file = pjoin(get_model_dir(), 'googlenet.pth') if pretrained else None
         self.layer2loc = {'conv1':       ('conv1',),
                           'maxpool1':    ('maxpool1',),
                           'conv2':       ('conv2',),
@@ -1015,6 +2177,16 @@ class Googlenet(DNN):
             normalize
         ])
 
+    def gen_model(self):
+        """
+        Generate the model's architecture without loading weights
+
+        Returns
+        -------
+        model : nn.Module
+        """
+        return tv_models.googlenet()
+
     @property
     def layers(self):
         """
@@ -1051,10 +2223,7 @@ class Googlenet(DNN):
 class Resnet152(DNN):
     def __init__(self, pretrained=True):
         super(Resnet152, self).__init__()
-        self.model = tv_models.resnet152()
-        if pretrained:
-            self.model.load_state_dict(torch.load(
-                pjoin(DNNBRAIN_MODEL, 'resnet152.pth')))
+        self.weight_file = pjoin(get_model_dir(), 'resnet152.pth') if pretrained else None
         self.layer2loc = {'conv': ('conv1',),
                           'bn': ('bn1',),
                           'relu': ('relu',),
@@ -1125,6 +2294,16 @@ class Resnet152(DNN):
             normalize
         ])
 
+    def gen_model(self):
+        """
+        Generate the model's architecture without loading weights
+
+        Returns
+        -------
+        model : nn.Module
+        """
+        return tv_models.resnet152()
+
     @property
     def layers(self):
         return list(self.layer2loc.keys())
@@ -1148,3 +2327,10 @@ class Resnet152(DNN):
             module = module._modules[k]
 
         return module
+
+
+# Map DNN names to their classes. Instantiating them is cheap and gives
+# layer2loc, img_size and transforms, since models are built and loaded
+# with weights when they are first used.
+DNN_REGISTRY = dict((cls.__name__, cls) for cls in
+                    (AlexNet, VggFace, Vgg11, Vgg19_bn, Googlenet, Resnet152))
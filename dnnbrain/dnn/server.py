@@ -0,0 +1,593 @@
+"""
+A local server which keeps DNNs resident and extracts activation for
+requests over a Unix socket. Concurrent requests for the same DNN are
+batched into shared forward passes.
+
+The client side only needs the standard library and numpy, so that CLIs
+delegating to a running server start fast. Modules of the server side,
+which import PyTorch, are imported when a server is created.
+"""
+
+import io
+import os
+import json
+import time
+import queue
+import socket
+import struct
+import tempfile
+import threading
+import socketserver
+import numpy as np
+
+from concurrent.futures import Future
+from os.path import join as pjoin
+
+
+def gen_socket_path():
+    """
+    Get the default path of the server's socket
+
+    Returns
+    -------
+    socket_path : str
+        $DNNBRAIN_SOCKET if set, otherwise dnnbrain-<uid>.sock
+        in the temporary directory.
+    """
+    return os.environ.get('DNNBRAIN_SOCKET', pjoin(
+        tempfile.gettempdir(), 'dnnbrain-{}.sock'.format(os.getuid())))
+
+
+def _to_json(obj):
+    """
+    Convert numpy objects, which are not JSON serializable, to Python objects
+    """
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError('{} is not JSON serializable'.format(type(obj)))
+
+
+def _recv_exact(sock, size):
+    """
+    Receive exactly size bytes from the socket
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while size > 0:
+        n_byte = sock.recv_into(view, size)
+        if n_byte == 0:
+            raise ConnectionError('The connection is closed.')
+        view = view[n_byte:]
+        size -= n_byte
+
+    return buf
+
+
+def send_message(sock, header, arrays=()):
+    """
+    Send a message which consists of a JSON header and arrays in .npy format.
+    Each part is prefixed with its size.
+
+    Parameters
+    ----------
+    sock : socket
+    header : dict
+        JSON serializable information
+    arrays : list
+        ndarrays
+    """
+    header = dict(header, n_array=len(arrays))
+    data = json.dumps(header, default=_to_json).encode()
+    sock.sendall(struct.pack('<Q', len(data)) + data)
+    for array in arrays:
+        buf = io.BytesIO()
+        np.save(buf, array)
+        sock.sendall(struct.pack('<Q', buf.tell()) + buf.getvalue())
+
+
+def recv_message(sock):
+    """
+    Receive a message sent by send_message()
+
+    Parameters
+    ----------
+    sock : socket
+
+    Returns
+    -------
+    header : dict
+    arrays : list
+    """
+    size = struct.unpack('<Q', _recv_exact(sock, 8))[0]
+    header = json.loads(_recv_exact(sock, size).decode())
+    arrays = []
+    for _ in range(header.pop('n_array')):
+        size = struct.unpack('<Q', _recv_exact(sock, 8))[0]
+        arrays.append(np.load(io.BytesIO(_recv_exact(sock, size))))
+
+    return header, arrays
+
+
+def request(header, arrays=(), socket_path=None):
+    """
+    Send a request to the server and wait for its response
+
+    Parameters
+    ----------
+    header : dict
+        The request. Its 'op' is one of ('act', 'ping', 'stop').
+    arrays : list
+        ndarrays sent with the request
+    socket_path : str
+        The path of the server's socket.
+        Default is gen_socket_path().
+
+    Returns
+    -------
+    header : dict
+    arrays : list
+    """
+    socket_path = gen_socket_path() if socket_path is None else socket_path
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        send_message(sock, header, arrays)
+        header, arrays = recv_message(sock)
+    if header.get('error') is not None:
+        raise RuntimeError('The server failed: ' + header['error'])
+
+    return header, arrays
+
+
+def server_running(socket_path=None, cuda=None, compiled=None):
+    """
+    Check whether a server is listening on the socket
+
+    Parameters
+    ----------
+    socket_path : str
+        The path of the server's socket.
+        Default is gen_socket_path().
+    cuda : bool
+        If not None, the server must use GPU or not as it says.
+    compiled : bool
+        If not None, the server must run DNNs in the compiled
+        inference mode or not as it says.
+
+    Returns
+    -------
+    running : bool
+    """
+    socket_path = gen_socket_path() if socket_path is None else socket_path
+    if not os.path.exists(socket_path):
+        return False
+    try:
+        header, _ = request({'op': 'ping'}, socket_path=socket_path)
+    except (OSError, RuntimeError):
+        return False
+    if cuda is not None and header['cuda'] != cuda:
+        return False
+    if compiled is not None and header['compiled'] != compiled:
+        return False
+
+    return True
+
+
+def compute_activation(net, stimuli, dmask, pool_method=None, draft=True,
+                       batch_size=None, socket_path=None):
+    """
+    Extract DNN activation by the server
+
+    Parameters
+    ----------
+    net : str
+        DNN name in DNN_REGISTRY of dnnbrain.dnn.models
+    stimuli : Stimulus, ndarray, str
+        Input stimuli.
+        If is str, it is a .stim.csv file which is loaded by the server.
+    dmask : Mask, str
+        The mask includes layers/channels/rows/columns of interest.
+        If is str, it is a .dmask.csv file which is loaded by the server.
+    pool_method : str
+        pooling method, choices=(max, mean, median, L1, L2)
+    draft : bool
+        Decode JPEG images in draft mode or not
+    batch_size : int
+        The number of stimuli per batch loaded by the server.
+        Default is the server's batch size.
+    socket_path : str
+        The path of the server's socket.
+        Default is gen_socket_path().
+
+    Returns
+    -------
+    activation : Activation
+        DNN activation
+    """
+    from dnnbrain.dnn.core import Activation
+
+    header = {'op': 'act', 'net': net, 'pool': pool_method, 'draft': draft,
+              'batch_size': batch_size}
+    arrays = []
+    if isinstance(stimuli, np.ndarray):
+        arrays.append(stimuli)
+    elif isinstance(stimuli, str):
+        header['stim'] = os.path.abspath(stimuli)
+    else:
+        header['stim'] = {'header': stimuli.header,
+                          'data': dict((k, stimuli.get(k)) for k in stimuli.items)}
+    if isinstance(dmask, str):
+        header['dmask'] = os.path.abspath(dmask)
+    else:
+        header['mask'] = dict((layer, dmask.get(layer)) for layer in dmask.layers)
+
+    header, arrays = request(header, arrays, socket_path)
+    activation = Activation()
+    for layer, data in zip(header['layers'], arrays):
+        activation.set(layer, data)
+
+    return activation
+
+
+class _Batcher:
+    """
+    Run forward passes of a DNN in a thread.
+    Batches submitted by concurrent requests are concatenated into shared
+    forward passes, which hold up to about max_batch stimuli.
+    """
+    def __init__(self, dnn, max_batch=32, max_wait=0.01, cuda=False):
+        """
+        Parameters
+        ----------
+        dnn : DNN
+        max_batch : int
+            The max number of stimuli per forward pass
+        max_wait : float
+            The max time in seconds to wait for other batches
+            before a forward pass starts.
+        cuda : bool
+            use GPU or not
+        """
+        self.dnn = dnn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cuda = cuda
+        self.n_forward = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, stims, layers):
+        """
+        Submit a batch
+
+        Parameters
+        ----------
+        stims : tensor
+            Stimuli with shape as (n_stim, n_chn, height, width)
+        layers : list
+            Layer names
+
+        Returns
+        -------
+        future : Future
+            Its result is a dict which maps the layers to their outputs.
+        """
+        future = Future()
+        self._queue.put((stims, layers, future))
+
+        return future
+
+    def _run(self):
+        while True:
+            # gather batches until the forward pass is full or the wait is over
+            jobs = [self._queue.get()]
+            n_stim = len(jobs[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while n_stim < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    jobs.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                n_stim += len(jobs[-1][0])
+
+            try:
+                outputs = self._forward([job[0] for job in jobs],
+                                        [job[1] for job in jobs])
+            except Exception as exc:
+                for job in jobs:
+                    job[2].set_exception(exc)
+            else:
+                for job, output in zip(jobs, outputs):
+                    job[2].set_result(output)
+
+    def _forward(self, stims_list, layers_list):
+        """
+        Run a forward pass on the concatenated batches
+
+        Returns
+        -------
+        outputs : list
+            Outputs of the layers for each batch
+        """
+        import torch
+        from contextlib import ExitStack
+        from functools import partial
+        from dnnbrain.dnn.models import _store_output
+
+        all_layers = self.dnn.layers
+        layers = sorted(set(sum(layers_list, [])), key=all_layers.index)
+        stims = torch.cat(stims_list)
+        if self.cuda:
+            stims = stims.to(torch.device('cuda'))
+        with torch.no_grad():
+            if self.dnn.compiled:
+                layer_outputs = self.dnn._get_traced(layers)(stims)
+            else:
+                layer_outputs = [None] * len(layers)
+                with ExitStack() as stack:
+                    for idx, layer in enumerate(layers):
+                        hook = partial(_store_output, layer_outputs, idx)
+                        module = self.dnn.layer2module(layer)
+                        stack.callback(module.register_forward_hook(hook).remove)
+                    stack.enter_context(self.dnn.truncate(layers))
+                    self.dnn(stims)
+        self.n_forward += 1
+
+        outputs = []
+        start = 0
+        for batch, batch_layers in zip(stims_list, layers_list):
+            stop = start + len(batch)
+            outputs.append(dict((layer, layer_outputs[layers.index(layer)][start:stop])
+                                for layer in batch_layers))
+            start = stop
+
+        return outputs
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        model_server = self.server.model_server
+        try:
+            header, arrays = recv_message(self.request)
+        except (ConnectionError, ValueError):
+            return
+        try:
+            header, arrays = model_server.handle(header, arrays)
+        except Exception as exc:
+            header, arrays = {'error': '{0}: {1}'.format(type(exc).__name__, exc)}, []
+        try:
+            send_message(self.request, header, arrays)
+        except OSError:
+            # the client has gone
+            pass
+        if model_server.stopping:
+            threading.Thread(target=self.server.shutdown).start()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ModelServer:
+    """
+    A server which keeps DNNs resident, and extracts their activation
+    for requests over a Unix socket. Stimuli of each request are loaded by
+    its own thread, and batches of concurrent requests for the same DNN are
+    run in shared forward passes.
+    """
+    def __init__(self, socket_path=None, dnns=None, batch_size=8, max_batch=32,
+                 max_wait=0.01, cuda=False, compiled=False):
+        """
+        Parameters
+        ----------
+        socket_path : str
+            The path of the socket.
+            Default is gen_socket_path().
+        dnns : dict
+            Map DNN names to DNN objects served at first.
+            Other DNNs in DNN_REGISTRY are created when they are first requested.
+        batch_size : int
+            The number of stimuli per batch loaded by a request
+        max_batch : int
+            The max number of stimuli per forward pass
+        max_wait : float
+            The max time in seconds to wait for batches of other requests
+            before a forward pass starts.
+        cuda : bool
+            use GPU or not
+        compiled : bool
+            Run DNNs in the compiled inference mode or not.
+            See DNN.compile() in dnnbrain.dnn.models.
+        """
+        from dnnbrain.dnn import models as db_models
+
+        self.socket_path = gen_socket_path() if socket_path is None else socket_path
+        self.batch_size = batch_size
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cuda = cuda
+        self.compiled = compiled
+        self.stopping = False
+        self._registry = db_models.DNN_REGISTRY
+        self._lock = threading.Lock()
+        self._batchers = dict()
+        if dnns is not None:
+            for name, dnn in dnns.items():
+                self._add_dnn(name, dnn)
+        self._server = None
+
+    def _add_dnn(self, name, dnn):
+        dnn.model.eval()
+        if self.cuda:
+            dnn.model.cuda()
+        if self.compiled:
+            dnn.compile()
+        self._batchers[name] = _Batcher(dnn, self.max_batch, self.max_wait, self.cuda)
+
+    def get_batcher(self, net):
+        """
+        Get the batcher of a DNN, which is created at the first time
+
+        Parameters
+        ----------
+        net : str
+            DNN name
+
+        Returns
+        -------
+        batcher : _Batcher
+        """
+        with self._lock:
+            if net not in self._batchers:
+                if net not in self._registry:
+                    raise ValueError('Unsupported DNN: {}'.format(net))
+                self._add_dnn(net, self._registry[net]())
+
+        return self._batchers[net]
+
+    def compute_activation(self, net, stimuli, dmask, pool_method=None, draft=True,
+                           batch_size=None):
+        """
+        Extract DNN activation through the shared forward passes
+
+        Parameters
+        ----------
+        net : str
+            DNN name
+        stimuli : Stimulus, ndarray
+            Input stimuli
+        dmask : Mask
+            The mask includes layers/channels/rows/columns of interest.
+        pool_method : str
+            pooling method, choices=(max, mean, median, L1, L2)
+        draft : bool
+            Decode JPEG images in draft mode or not
+        batch_size : int
+            The number of stimuli per batch loaded by the request.
+            Default is self.batch_size.
+
+        Returns
+        -------
+        activation : Activation
+            DNN activation
+        """
+        from dnnbrain.dnn.core import Activation
+        from dnnbrain.dnn.base import gen_data_loader
+
+        if batch_size is None:
+            batch_size = self.batch_size
+
+        batcher = self.get_batcher(net)
+        dnn = batcher.dnn
+        # stimuli are loaded in this thread, since forking loader
+        # workers in a multi-threaded server isn't safe
+        stim_set = dnn._gen_stim_set(stimuli, draft)
+        data_loader = gen_data_loader(stim_set, batch_size, n_worker=0)
+        hooks = dict()
+        batch_acts = dict()
+        acts = dict((layer, []) for layer in dmask.layers)
+        for layer in dmask.layers:
+            hooks[layer] = dnn._gen_activation_hook(layer, dmask.get(layer),
+                                                    pool_method, batch_acts)
+        for stims, _ in data_loader:
+            outputs = batcher.submit(stims, dmask.layers).result()
+            for layer in dmask.layers:
+                hooks[layer](None, None, outputs[layer])
+                acts[layer].append(batch_acts[layer])
+
+        activation = Activation()
+        for layer in dmask.layers:
+            activation.set(layer, np.concatenate(acts[layer]))
+
+        return activation
+
+    def handle(self, header, arrays):
+        """
+        Handle a request
+
+        Parameters
+        ----------
+        header : dict
+            The request
+        arrays : list
+            ndarrays sent with the request
+
+        Returns
+        -------
+        header : dict
+            The response
+        arrays : list
+            ndarrays sent with the response
+        """
+        from dnnbrain.dnn.core import Stimulus, Mask
+        from dnnbrain.utils.util import gen_dmask
+
+        op = header.get('op')
+        if op == 'ping':
+            return {'nets': list(self._batchers.keys()), 'cuda': self.cuda,
+                    'compiled': self.compiled, 'batch_size': self.batch_size}, []
+        elif op == 'stop':
+            self.stopping = True
+            return {}, []
+        elif op != 'act':
+            raise ValueError('Unsupported operation: {}'.format(op))
+
+        # prepare stimuli
+        if len(arrays) == 1:
+            stimuli = arrays[0]
+        elif isinstance(header['stim'], str):
+            stimuli = Stimulus()
+            stimuli.load(header['stim'])
+        else:
+            data = dict((k, np.asarray(v)) for k, v in header['stim']['data'].items())
+            stimuli = Stimulus(header['stim']['header'], data)
+
+        # prepare DNN mask
+        if 'mask' in header:
+            dmask = Mask()
+            for layer, mask in header['mask'].items():
+                dmask.set(layer, channels=mask['chn'], rows=mask['row'],
+                          columns=mask['col'])
+        else:
+            dmask = gen_dmask(header.get('layer'), header.get('chn', 'all'),
+                              header.get('dmask'))
+
+        activation = self.compute_activation(header['net'], stimuli, dmask,
+                                             header.get('pool'), header.get('draft', True),
+                                             header.get('batch_size'))
+        if header.get('out') is None:
+            return {'layers': activation.layers}, [activation.get(layer) for layer
+                                                   in activation.layers]
+        activation.save(header['out'], header.get('dtype'), header.get('layout'),
+                        header.get('compress', 'gzip'))
+
+        return {'layers': activation.layers}, []
+
+    def serve_forever(self):
+        """
+        Listen on the socket until a 'stop' request comes or shutdown() is called
+        """
+        if os.path.exists(self.socket_path):
+            if server_running(self.socket_path):
+                raise RuntimeError('A server is running on ' + self.socket_path)
+            # left by a server which was killed
+            os.remove(self.socket_path)
+        self._server = _UnixServer(self.socket_path, _RequestHandler)
+        self._server.model_server = self
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        """
+        Stop serving, which is called from another thread
+        """
+        if self._server is not None:
+            self._server.shutdown()
@@ -2,6 +2,7 @@ import os
 import cv2
 import copy
 import torch
+import pickle
 import pytest
 import numpy as np
 
@@ -161,6 +162,385 @@ class TestVideoSet:
             tmp = transform(frame)
             assert torch.equal(tmp, tmpvi[ii])
 
+    def test_read(self):
+
+        # prepare a video whose frames are different from each other
+        vid_file = pjoin(TMP_DIR, 'test_read.avi')
+        writer = cv2.VideoWriter(vid_file, cv2.VideoWriter_fourcc(*'MJPG'), 10, (32, 24))
+        for _ in range(60):
+            frame = np.random.randint(0, 256, (24, 32, 3), np.uint8)
+            writer.write(frame)
+        writer.release()
+
+        # ground truth by reading all frames one by one
+        cap = cv2.VideoCapture(vid_file)
+        frames_true = [cap.read()[1] for _ in range(60)]
+        cap.release()
+
+        # forward gaps are grabbed, backward or large gaps are sought
+        frame_nums = [1, 2, 5, 6, 20, 3, 3, 60, 58, 59]
+        dataset = db_base.VideoSet(vid_file, frame_nums, max_grab=10)
+        for frame_num in frame_nums:
+            np.testing.assert_equal(dataset._read(frame_num), frames_true[frame_num-1])
+
+    def test_pickle(self):
+
+        vid_file = pjoin(TMP_DIR, 'test_pickle.avi')
+        writer = cv2.VideoWriter(vid_file, cv2.VideoWriter_fourcc(*'MJPG'), 10, (32, 24))
+        writer.write(np.random.randint(0, 256, (24, 32, 3), np.uint8))
+        writer.release()
+        dataset = db_base.VideoSet(vid_file, [1])
+        frame = dataset._read(1)
+
+        # the video capture is reopened after unpickling
+        dataset_new = pickle.loads(pickle.dumps(dataset))
+        assert dataset_new._vid_cap is None
+        np.testing.assert_equal(dataset_new._read(1), frame)
+
+
+def _collate_n_thread(batch):
+    return db_base.gen_n_thread()
+
+
+def test_gen_n_thread():
+
+    assert db_base.gen_n_thread(3) == 3
+    assert db_base.gen_n_thread() == os.cpu_count()
+
+    # DataLoader workers share the CPU cores
+    data_loader = torch.utils.data.DataLoader(list(range(4)), num_workers=2,
+                                              collate_fn=_collate_n_thread)
+    assert list(data_loader) == [max(os.cpu_count() // 2, 1)] * 4
+
+
+def test_assemble_batch():
+
+    items = [np.full((2, 3), idx, np.float32) for idx in range(20)]
+    for n_thread in (1, 4):
+        data = db_base.assemble_batch(iter(items), torch.from_numpy, 20, n_thread)
+        assert data.shape == (20, 2, 3)
+        np.testing.assert_equal(data.numpy(), np.asarray(items))
+    assert db_base.assemble_batch([], torch.from_numpy, 0).shape == (0,)
+
+    # ImageSet and VideoSet get multiple stimuli in the same way as one by one
+    img_dir = pjoin(TMP_DIR, 'assemble_batch')
+    if not os.path.isdir(img_dir):
+        os.makedirs(img_dir)
+    vid_file = pjoin(img_dir, 'video.avi')
+    writer = cv2.VideoWriter(vid_file, cv2.VideoWriter_fourcc(*'MJPG'), 10, (32, 24))
+    img_ids = []
+    for idx in range(12):
+        arr = np.random.randint(0, 256, (24, 32, 3), np.uint8)
+        Image.fromarray(arr).save(pjoin(img_dir, '{}.png'.format(idx)))
+        img_ids.append('{}.png'.format(idx))
+        writer.write(arr)
+    writer.release()
+    for dataset in (db_base.ImageSet(img_dir, img_ids, n_thread=4),
+                    db_base.VideoSet(vid_file, list(range(1, 13)), n_thread=4)):
+        data, _ = dataset[2:10]
+        data_list, _ = dataset[[9, 3, 5]]
+        for idx in range(8):
+            assert torch.equal(data[idx], dataset[idx+2][0])
+        for idx, stim_idx in enumerate([9, 3, 5]):
+            assert torch.equal(data_list[idx], dataset[stim_idx][0])
+
+
+class TestPackSet:
+
+    def test_getitem(self):
+
+        pack_file = pjoin(TMP_DIR, 'test_getitem.pack.npy')
+        pack = np.random.randint(0, 256, (6, 3, 8, 8), np.uint8)
+        np.save(pack_file, pack)
+        dataset = db_base.PackSet(pack_file, [0, 1, 2, 3, 4, 5])
+        pack = torch.from_numpy(pack).float() / 255
+
+        assert len(dataset) == 6
+        data, label = dataset[2]
+        assert torch.equal(data, pack[2])
+        assert label == 2
+        for indices in (slice(1, 4), [1, 2, 3], [4, 0]):
+            data, labels = dataset[indices]
+            assert torch.equal(data, pack[indices])
+            assert list(labels) == list(range(6)[indices]) \
+                if isinstance(indices, slice) else list(labels) == indices
+
+        # the memory map is reopened after unpickling
+        dataset_new = pickle.loads(pickle.dumps(dataset))
+        assert dataset_new._pack is None
+        assert torch.equal(dataset_new[1:3][0], pack[1:3])
+
+        # read batch by batch
+        data_loader = db_base.gen_data_loader(dataset, 4)
+        assert [list(indices) for indices in db_base.iter_batch_indices(data_loader)] == \
+            [[0, 1, 2, 3], [4, 5]]
+        assert torch.equal(torch.cat([data for data, _ in data_loader]), pack)
+        data_loader = db_base.gen_data_loader(dataset, 5)
+        assert [data.shape[0] for data, _ in data_loader] == [5, 1]
+
+
+def test_gen_draft_size():
+
+    to_tensor = transforms.ToTensor()
+    assert db_base.gen_draft_size(transforms.Compose([transforms.Resize((224, 200)),
+                                                      to_tensor])) == (200, 224)
+    assert db_base.gen_draft_size(transforms.Compose([transforms.Resize(224),
+                                                      to_tensor])) == (224, 224)
+    assert db_base.gen_draft_size(transforms.Compose([transforms.RandomResizedCrop(224),
+                                                      to_tensor])) is None
+    assert db_base.gen_draft_size(transforms.Compose([to_tensor])) is None
+
+
+def test_transform_group():
+
+    transform1 = transforms.Compose([transforms.Resize((16, 12)), transforms.ToTensor()])
+    transform2 = transforms.Compose([transforms.Resize((8, 20)), transforms.ToTensor()])
+    transform3 = transforms.Compose([transforms.Resize((16, 12)), transforms.ToTensor()])
+    group = db_base.TransformGroup([transform1, transform2, transform3])
+    assert group.transforms == [transform1, transform2]
+    assert group.indices == [0, 1, 0]
+    assert db_base.gen_draft_size(group) == (20, 16)
+
+    # each image is transformed by the distinct transforms
+    image = Image.fromarray(np.random.randint(0, 256, (40, 30, 3), np.uint8))
+    data1, data2 = group(image)
+    assert torch.equal(data1, transform1(image))
+    assert torch.equal(data2, transform2(image))
+    data = db_base.assemble_batch([image] * 3, group, 3, 2)
+    assert data[0].shape == (3, 3, 16, 12)
+    assert data[1].shape == (3, 3, 8, 20)
+    assert torch.equal(db_base.index_batch(data, 1)[1], data2)
+
+
+def test_image_set_draft():
+
+    # prepare a large JPEG image
+    img_dir = pjoin(TMP_DIR, 'image_set_draft')
+    if not os.path.isdir(img_dir):
+        os.makedirs(img_dir)
+    arr = cv2.resize(np.random.randint(0, 256, (60, 80, 3), np.uint8), (1000, 900))
+    Image.fromarray(arr).save(pjoin(img_dir, 'large.jpg'), quality=95)
+
+    transform = transforms.Compose([transforms.Resize((224, 200)), transforms.ToTensor()])
+    image_set = db_base.ImageSet(img_dir, ['large.jpg'], transform=transform)
+    image_set_draft = db_base.ImageSet(img_dir, ['large.jpg'], transform=transform, draft=True)
+    assert image_set.draft is None
+    assert image_set_draft.draft == (200, 224)
+
+    # the exact output is the same as before
+    image = Image.open(pjoin(img_dir, 'large.jpg')).convert('RGB')
+    assert torch.equal(image_set[0][0], transform(image))
+
+    # the image is decoded at 1/4 scale, which is not smaller than the target size
+    image = Image.open(pjoin(img_dir, 'large.jpg'))
+    image.draft(None, image_set_draft.draft)
+    assert image.size == (250, 225)
+    data, data_draft = image_set[0][0], image_set_draft[0][0]
+    assert data_draft.shape == data.shape
+    assert (data_draft - data).abs().mean() < 0.02
+
+
+class TestArraySet:
+
+    def test_getitem(self):
+
+        arrays = np.random.randint(0, 256, (5, 3, 40, 30), np.uint8)
+        images = [Image.fromarray(arr.transpose((1, 2, 0))) for arr in arrays]
+
+        # the batch is transformed at once in the same way as PIL images
+        transform = transforms.Compose([transforms.Resize((24, 20)), transforms.ToTensor(),
+                                        transforms.Normalize([0.5] * 3, [0.5] * 3)])
+        dataset = db_base.ArraySet(arrays, [1, 2, 3, 4, 5], transform)
+        assert dataset.batched
+        assert len(dataset) == 5
+        data, labels = dataset[1:4]
+        data_pil = torch.stack([transform(img) for img in images[1:4]])
+        # at most one intensity level differs
+        np.testing.assert_allclose(data, data_pil, atol=2 / 255 + 1e-6)
+        assert list(labels) == [2, 3, 4]
+        data, label = dataset[0]
+        assert data.shape == (3, 24, 20)
+        assert label == 1
+        assert dataset[[2]][0].shape == (1, 3, 24, 20)
+
+        # random transforms are applied image by image
+        transform = transforms.Compose([transforms.RandomResizedCrop(16),
+                                        transforms.RandomHorizontalFlip(),
+                                        transforms.ToTensor()])
+        dataset = db_base.ArraySet(arrays, transform=transform)
+        assert not dataset.batched
+        assert dataset[[0, 3]][0].shape == (2, 3, 16, 16)
+
+        with pytest.raises(TypeError):
+            db_base.ArraySet(np.float32(arrays))
+
+
+def test_tensor_resize():
+
+    arrays = np.random.randint(0, 256, (2, 3, 40, 30), np.uint8)
+    for size in (20, (20,), (28, 50)):
+        resize = transforms.Resize(size)
+        data = db_base.TensorResize(resize)(torch.from_numpy(arrays))
+        data_pil = [np.asarray(resize(Image.fromarray(arr.transpose((1, 2, 0)))))
+                    for arr in arrays]
+        data_pil = np.array(data_pil).transpose((0, 3, 1, 2))
+        assert data.dtype == torch.uint8
+        assert data.shape == data_pil.shape
+        assert np.abs(data.numpy().astype(int) - data_pil).max() <= 1
+
+
+class TestTarSet:
+
+    def test_getitem(self):
+
+        from dnnbrain.dnn.core import Stimulus
+
+        # prepare images
+        img_dir = pjoin(TMP_DIR, 'tar_set_images')
+        if not os.path.isdir(img_dir):
+            os.makedirs(img_dir)
+        img_ids = []
+        for idx in range(8):
+            arr = np.random.randint(0, 256, (20 + idx, 30, 3), np.uint8)
+            Image.fromarray(arr).save(pjoin(img_dir, '{}.png'.format(idx)))
+            img_ids.append('{}.png'.format(idx))
+        img_ids.append('3.png')  # repeated stimulus is stored once
+        stimuli = Stimulus(header={'type': 'image', 'path': img_dir})
+        stimuli.set('stimID', img_ids)
+
+        # store them into shards with about 3 images per shard
+        tar_dir = pjoin(TMP_DIR, 'tar_set.shards')
+        shard_size = 3 * os.path.getsize(pjoin(img_dir, '7.png'))
+        stimuli_tar = stimuli.shard(tar_dir, shard_size)
+        assert stimuli_tar.header == {'type': 'tar', 'path': os.path.abspath(tar_dir)}
+        index = db_base.read_tar_index(tar_dir)
+        assert len(index) == 8
+        assert len(set(shard for shard, _, _ in index.values())) > 1
+
+        # assert
+        transform = transforms.Compose([transforms.Resize((16, 16)), transforms.ToTensor()])
+        image_set = db_base.ImageSet(img_dir, img_ids, transform=transform)
+        tar_set = db_base.TarSet(tar_dir, img_ids, list(range(9)), transform, max_gap=0)
+        assert len(tar_set) == 9
+        data, label = tar_set[3]
+        assert torch.equal(data, image_set[3][0])
+        assert label == 3
+        for indices in (slice(1, 9), [8, 0, 5, 3]):
+            data, labels = tar_set[indices]
+            assert torch.equal(data, image_set[indices][0])
+        assert list(tar_set[[8, 0]][1]) == [8, 0]
+        assert tar_set[[2]][0].shape == (1, 3, 16, 16)
+
+        # the shards are reopened after unpickling
+        tar_set_new = pickle.loads(pickle.dumps(tar_set))
+        assert tar_set_new._files == dict()
+        assert torch.equal(tar_set_new[:][0], image_set[:][0])
+
+        # read batch by batch
+        data_loader = db_base.gen_data_loader(tar_set, 4, n_worker=2)
+        assert torch.equal(torch.cat([data for data, _ in data_loader]), image_set[:][0])
+
+        # the images must be in the shards
+        with pytest.raises(ValueError):
+            db_base.TarSet(tar_dir, ['8.png'])
+
+
+def test_gen_pack_transform():
+
+    normalize = transforms.Normalize([0.5, 0.4, 0.3], [0.2, 0.3, 0.4])
+    transform = transforms.Compose([transforms.Resize((16, 12)),
+                                    transforms.ToTensor(), normalize])
+    image = Image.fromarray(np.random.randint(0, 256, (40, 30, 3), np.uint8))
+
+    # packed images are transformed in the same way
+    pil_transform = db_base.gen_pil_transform(transform)
+    image_pack = pil_transform(image)
+    assert image_pack.dtype == torch.uint8
+    pack_transform = db_base.gen_pack_transform(transform)
+    assert torch.equal(pack_transform(image_pack), transform(image))
+
+    # the transforms before ToTensor are kept for unpacked tensors
+    pack_transform = db_base.gen_pack_transform(transform, False)
+    assert pack_transform(transforms.PILToTensor()(image)).shape == (3, 16, 12)
+
+    with pytest.raises(ValueError):
+        db_base.gen_pack_transform(transforms.Compose([normalize]))
+
+
+def test_gen_segments():
+
+    assert db_base.gen_segments(10, 3) == [(0, 4), (4, 7), (7, 10)]
+    assert db_base.gen_segments(10, 3, 4) == [(0, 4), (4, 8), (8, 10)]
+    assert db_base.gen_segments(2, 3) == [(0, 1), (1, 2)]
+    assert db_base.gen_segments(0, 3) == []
+
+
+def test_segment_batch_sampler():
+
+    sampler = db_base.SegmentBatchSampler([(0, 4), (4, 8), (8, 10)], 2)
+    batches = list(sampler)
+    assert len(sampler) == len(batches) == 5
+    assert batches == [[0, 1], [4, 5], [8, 9], [2, 3], [6, 7]]
+
+
+def test_array_statistic():
+
+    arr = np.random.randn(2, 3, 5, 4).astype(np.float32)
+    tensor = torch.from_numpy(arr)
+    for method in ('max', 'mean', 'median', 'L1', 'L2'):
+        for axis in ((2, 3), 1, -1):
+            for keepdims in (True, False):
+                arr_np = db_base.array_statistic(arr, method, axis, keepdims)
+                arr_torch = db_base.array_statistic(tensor, method, axis, keepdims)
+                assert isinstance(arr_torch, torch.Tensor)
+                np.testing.assert_allclose(arr_torch.numpy(), arr_np, 1e-5, 1e-5)
+    for method in ('max', 'mean', 'median'):
+        np.testing.assert_allclose(db_base.array_statistic(tensor, method).numpy(),
+                                   db_base.array_statistic(arr, method), 1e-5)
+
+
+def test_dnn_mask():
+
+    arr = np.random.randn(2, 5, 4, 3)
+    tensor = torch.from_numpy(arr)
+    mask = {'channels': [1, 3], 'rows': 'all', 'columns': [2]}
+    np.testing.assert_equal(db_base.dnn_mask(tensor, **mask).numpy(),
+                            db_base.dnn_mask(arr, **mask))
+
+
+def test_gen_data_loader():
+
+    # prepare images on the disk
+    img_dir = pjoin(TMP_DIR, 'data_loader')
+    if not os.path.isdir(img_dir):
+        os.makedirs(img_dir)
+    img_ids = []
+    for idx in range(10):
+        img_id = 'img{}.png'.format(idx)
+        arr = np.random.randint(0, 256, (32, 32, 3), np.uint8)
+        Image.fromarray(arr).save(pjoin(img_dir, img_id))
+        img_ids.append(img_id)
+    dataset = db_base.ImageSet(img_dir, img_ids)
+
+    # default number of workers, which is not more than the number of batches
+    data_loader = db_base.gen_data_loader(dataset, 1)
+    assert data_loader.num_workers == min(os.cpu_count(), 10)
+    data_loader = db_base.gen_data_loader(dataset, 8)
+    assert data_loader.num_workers == min(os.cpu_count(), 2)
+    data_loader = db_base.gen_data_loader(db_base.VideoSet('', [1]))
+    assert data_loader.num_workers == 1
+    data_loader = db_base.gen_data_loader([(torch.zeros(3), 0)])
+    assert data_loader.num_workers == 0
+
+    # loading with workers keeps the order of stimuli
+    data_loader0 = db_base.gen_data_loader(dataset, 4, n_worker=0)
+    data_loader2 = db_base.gen_data_loader(dataset, 4, n_worker=2, prefetch=1)
+    batches0 = [data for data, _ in data_loader0]
+    batches2 = [data for data, _ in data_loader2]
+    assert [len(data) for data in batches0] == [4, 4, 2]
+    for data0, data2 in zip(batches0, batches2):
+        assert torch.equal(data0, data2)
+
 
 class TestImageProcessor:
 
@@ -0,0 +1,136 @@
+import os
+import time
+import pytest
+import numpy as np
+
+from os.path import join as pjoin
+from dnnbrain.dnn import core as dcore
+from dnnbrain.dnn import models as db_models
+from dnnbrain.dnn.cache import ActivationCache, hash_stimuli, hash_file
+
+TMP_DIR = pjoin(os.path.expanduser('~'), '.dnnbrain_tmp')
+if not os.path.isdir(TMP_DIR):
+    os.makedirs(TMP_DIR)
+
+
+def test_hash_stimuli():
+
+    stimuli = np.random.randint(0, 256, (3, 3, 8, 8), np.uint8)
+    assert hash_stimuli(stimuli) == hash_stimuli(stimuli.copy())
+    assert hash_stimuli(stimuli) != hash_stimuli(stimuli[::-1])
+
+    # the contents of image files are hashed
+    img_dir = pjoin(TMP_DIR, 'hash_stimuli')
+    if not os.path.isdir(img_dir):
+        os.makedirs(img_dir)
+    with open(pjoin(img_dir, 'img.png'), 'wb') as wf:
+        wf.write(b'0')
+    stim = dcore.Stimulus(header={'type': 'image', 'path': img_dir})
+    stim.set('stimID', ['img.png'])
+    hash1 = hash_stimuli(stim, content=True)
+    with open(pjoin(img_dir, 'img.png'), 'wb') as wf:
+        wf.write(b'1')
+    assert hash_stimuli(stim) == hash_stimuli(stim)
+    assert hash_stimuli(stim, content=True) != hash1
+
+    # the hashes of files are memoized until their sizes or modification times change
+    file_hashes = dict()
+    hash2 = hash_stimuli(stim, True, file_hashes)
+    assert len(file_hashes) == 1
+    memo_key = list(file_hashes.keys())[0]
+    file_hashes[memo_key][2] = 'memoized'
+    assert hash_stimuli(stim, True, file_hashes) != hash2
+    with open(pjoin(img_dir, 'img.png'), 'wb') as wf:
+        wf.write(b'22')
+    assert hash_stimuli(stim, True, file_hashes) == hash_stimuli(stim, content=True)
+    assert file_hashes[memo_key][2] == hash_file(pjoin(img_dir, 'img.png'))
+
+
+class TestActivationCache:
+
+    def test_get_set(self):
+
+        act_cache = ActivationCache(pjoin(TMP_DIR, 'cache_get_set'))
+        act_cache.clear()
+        key = act_cache.gen_key(layer='conv1', mask={'chn': [1, 2]}, pool=None)
+        assert act_cache.get(key) is None
+
+        data = np.random.randn(2, 3, 4, 4).astype(np.float32)
+        act_cache.set(key, data, {'layer': 'conv1'})
+        np.testing.assert_equal(act_cache.get(key), data)
+        entries = act_cache.entries()
+        assert [entry['key'] for entry in entries] == [key]
+        assert entries[0]['info'] == {'layer': 'conv1', 'shape': [2, 3, 4, 4]}
+
+    def test_prune(self):
+
+        act_cache = ActivationCache(pjoin(TMP_DIR, 'cache_prune'))
+        act_cache.clear()
+        data = np.zeros((10, 10), np.float32)
+        keys = [act_cache.gen_key(idx=idx) for idx in range(3)]
+        for key in keys:
+            act_cache.set(key, data)
+            time.sleep(0.01)
+        size = act_cache.entries()[0]['size']
+
+        # the least recently used entry is evicted first
+        time.sleep(0.01)
+        act_cache.get(keys[0])
+        assert act_cache.prune(size * 2) == [keys[1]]
+        assert act_cache.get(keys[1]) is None
+
+        # the max_size is kept when setting
+        act_cache.max_size = size
+        act_cache.set(keys[1], data)
+        assert [entry['key'] for entry in act_cache.entries()] == [keys[1]]
+
+
+def test_compute_activation_cache(monkeypatch):
+
+    monkeypatch.setenv('DNNBRAIN_DATA', TMP_DIR)
+    act_cache = ActivationCache()
+    act_cache.clear()
+
+    # prepare stimuli and DNN
+    # count forward passes of the model
+    dnn = db_models.AlexNet(False)
+    n_forward = []
+    dnn.model.register_forward_pre_hook(lambda m, i: n_forward.append(1))
+    stimuli = np.random.randint(0, 256, (4, 3, 224, 224), np.uint8)
+    dmask = dcore.Mask()
+    dmask.set('conv5', channels=[1, 2])
+    dmask.set('fc3')
+    activation = dnn.compute_activation(stimuli, dmask)
+    n_forward.clear()
+
+    # the first call fills the cache and the second one is served from it
+    activation1 = dnn.compute_activation(stimuli, dmask, cache=True)
+    assert len(act_cache.entries()) == 2
+    assert len(n_forward) == 1
+    activation2 = dnn.compute_activation(stimuli, dmask, cache=True)
+    assert len(n_forward) == 1
+    for layer in dmask.layers:
+        np.testing.assert_equal(activation.get(layer), activation1.get(layer))
+        np.testing.assert_equal(activation.get(layer), activation2.get(layer))
+
+    # only the missing layer is computed
+    dmask.set('conv1')
+    activation3 = dnn.compute_activation(stimuli, dmask, cache=True)
+    assert activation3.layers == ['conv5', 'fc3', 'conv1']
+    assert len(act_cache.entries()) == 3
+
+    # changes of the mask or stimuli miss the cache
+    dmask.set('conv5', channels=[1])
+    dnn.compute_activation(stimuli, dmask, cache=True)
+    assert len(act_cache.entries()) == 4
+    dnn.compute_activation(stimuli[:2], dmask, cache=True)
+    assert len(act_cache.entries()) == 7
+
+    # the compiled model misses the cache of the eager one
+    dnn.compile()
+    dnn.compute_activation(stimuli[:2], dmask, cache=True)
+    assert len(act_cache.entries()) == 10
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -1,7 +1,9 @@
 import os
+import sys
 import copy
 import h5py
 import pytest
+import subprocess
 import numpy as np
 
 from os.path import join as pjoin
@@ -227,6 +229,30 @@ class TestActivation:
             np.testing.assert_equal(data_true, activation._activation[layer])
         rf.close()
 
+    def test_load_lazy(self):
+
+        # prepare
+        fname = pjoin(TMP_DIR, 'test_load_lazy.act.h5')
+        activation = dcore.Activation()
+        activation._activation = self.activation_true
+        activation.save(fname)
+        dmask = dcore.Mask()
+        dmask.set('conv5', channels=[1, 3], rows=[4, 5, 6])
+
+        # assert
+        activation_lazy = dcore.Activation()
+        activation_lazy.load(fname, lazy=True)
+        assert isinstance(activation_lazy.get('fc3'), fio.LazyArray)
+        activation_mask = activation_lazy.mask(dmask)
+        assert isinstance(activation_mask.get('conv5'), fio.LazyArray)
+        np.testing.assert_equal(np.asarray(activation_mask.get('conv5')),
+                                activation.mask(dmask).get('conv5'))
+        np.testing.assert_equal(activation_lazy[[3, 1]].get('conv5'),
+                                activation[[3, 1]].get('conv5'))
+        for layer in activation.layers:
+            np.testing.assert_equal(activation_lazy.pool('max').get(layer),
+                                    activation.pool('max').get(layer))
+
     def test_save(self):
 
         # save by Activation.save()
@@ -241,6 +267,14 @@ class TestActivation:
             np.testing.assert_equal(data, np.asarray(rf[layer]))
         rf.close()
 
+        # save as float16 and load as float32
+        activation.save(fname, 'float16')
+        activation_file = dcore.Activation()
+        activation_file.load(fname, dtype='float32')
+        for layer, data in self.activation_true.items():
+            assert activation_file.get(layer).dtype == np.float32
+            np.testing.assert_allclose(activation_file.get(layer), data, 1e-3, 1e-3)
+
     def test_get(self):
         pass
 
@@ -626,5 +660,21 @@ class TestDnnProbe:
             assert v1['conf_m'].shape == (n_chn, n_beh, cv)
 
 
+def test_import():
+
+    # importing modules which only handle files doesn't import heavy
+    # dependencies or read DNNBRAIN_DATA
+    code = 'import sys\n' \
+           'import dnnbrain.dnn.core, dnnbrain.dnn.cache\n' \
+           'import dnnbrain.utils.util, dnnbrain.brain.core\n' \
+           "print(' '.join(m for m in ('torch', 'torchvision', 'sklearn', 'scipy.signal', 'cv2')\n" \
+           "               if m in sys.modules))"
+    env = os.environ.copy()
+    env.pop('DNNBRAIN_DATA')
+    output = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                            stdout=subprocess.PIPE).stdout
+    assert output.decode().strip() == ''
+
+
 if __name__ == '__main__':
     pytest.main()
@@ -1,13 +1,16 @@
 import os
+import cv2
 import h5py
 import torch
 import pytest
+import tempfile
 import numpy as np
 
 from PIL import Image
 from os.path import join as pjoin
 from dnnbrain.dnn import core as dcore
 from dnnbrain.dnn import models as db_models
+from dnnbrain.dnn.base import array_statistic
 
 DNNBRAIN_TEST = pjoin(os.environ['DNNBRAIN_DATA'], 'test')
 TMP_DIR = pjoin(os.path.expanduser('~'), '.dnnbrain_tmp')
@@ -67,6 +70,376 @@ class TestAlexNet:
 
         rf.close()
 
+    def test_compute_activation_layers(self):
+
+        # prepare stimuli and DNN
+        torch.manual_seed(0)
+        dnn = db_models.AlexNet(False)
+        stimuli = np.random.randint(0, 256, (5, 3, 224, 224), np.uint8)
+
+        # extract all layers of interest at once
+        dmask = dcore.Mask()
+        dmask.set('conv1')
+        dmask.set('conv1_relu', channels=[1, 3])
+        dmask.set('fc2', channels=[2, 4, 8])
+        activation = dnn.compute_activation(stimuli, dmask)
+
+        # assert with extracting layer by layer
+        for layer in dmask.layers:
+            dmask_layer = dcore.Mask()
+            dmask_layer.set(layer, channels=dmask.get(layer)['chn'])
+            activ_layer = dnn.compute_activation(stimuli, dmask_layer)
+            np.testing.assert_equal(activation.get(layer), activ_layer.get(layer))
+        assert activation.get('conv1').shape == (5, 64, 55, 55)
+        assert activation.get('conv1_relu').shape == (5, 2, 55, 55)
+        assert activation.get('fc2').shape == (5, 3, 1, 1)
+
+    def test_compute_activation_pool(self):
+
+        # prepare stimuli and DNN
+        dnn = db_models.AlexNet(False)
+        stimuli = np.random.randint(0, 256, (3, 3, 224, 224), np.uint8)
+        dmask = dcore.Mask()
+        dmask.set('conv1')
+        dmask.set('conv2', channels=[2, 4], rows=[3, 5, 7])
+        activation = dnn.compute_activation(stimuli, dmask)
+
+        # the output of conv1 is kept before the in-place ReLU
+        assert np.any(activation.get('conv1') < 0)
+
+        # pooling in the hook is the same as pooling afterwards
+        for method in ('max', 'mean', 'median', 'L1', 'L2'):
+            activation_pool = dnn.compute_activation(stimuli, dmask, method)
+            for layer in dmask.layers:
+                data = array_statistic(activation.get(layer), method, (2, 3), True)
+                np.testing.assert_allclose(activation_pool.get(layer), data, 1e-4, 1e-5)
+
+    def test_compute_activation_video(self):
+
+        # prepare a video
+        vid_file = pjoin(TMP_DIR, 'test_compute_activation.avi')
+        writer = cv2.VideoWriter(vid_file, cv2.VideoWriter_fourcc(*'MJPG'), 10, (64, 48))
+        for _ in range(30):
+            writer.write(np.random.randint(0, 256, (48, 64, 3), np.uint8))
+        writer.release()
+        stimuli = dcore.Stimulus(header={'type': 'video', 'path': vid_file})
+        stimuli.set('stimID', list(range(1, 30, 2)))
+
+        # prepare DNN
+        dnn = db_models.AlexNet(False)
+        dmask = dcore.Mask()
+        dmask.set('conv3', channels=[1, 2])
+        dmask.set('fc3')
+
+        # each worker decodes a segment of frames
+        activation = dnn.compute_activation(stimuli, dmask, batch_size=2, n_worker=0)
+        activation1 = dnn.compute_activation(stimuli, dmask, batch_size=2, n_worker=3)
+        fname = pjoin(TMP_DIR, 'test_video.act.h5')
+        dnn.compute_activation(stimuli, dmask, out_file=fname, batch_size=2, n_worker=3)
+        activation2 = dcore.Activation()
+        activation2.load(fname)
+        with h5py.File(fname, 'r') as rf:
+            assert rf['fc3'].attrs['n_done'] == 15
+        for layer in dmask.layers:
+            np.testing.assert_equal(activation.get(layer), activation1.get(layer))
+            np.testing.assert_equal(activation.get(layer), activation2.get(layer))
+
+    def test_compute_activation_pack(self):
+
+        # prepare images
+        img_dir = pjoin(TMP_DIR, 'compute_activation_pack')
+        if not os.path.isdir(img_dir):
+            os.makedirs(img_dir)
+        img_ids = []
+        for idx in range(10):
+            arr = np.random.randint(0, 256, (60, 80, 3), np.uint8)
+            Image.fromarray(arr).save(pjoin(img_dir, '{}.png'.format(idx)))
+            img_ids.append('{}.png'.format(idx))
+        stimuli = dcore.Stimulus(header={'type': 'image', 'path': img_dir})
+        stimuli.set('stimID', img_ids)
+
+        # pack stimuli
+        dnn = db_models.AlexNet(False)
+        stimuli_pack = stimuli.pack(pjoin(TMP_DIR, 'test.pack.npy'), dnn.test_transform)
+
+        # assert
+        dmask = dcore.Mask()
+        dmask.set('conv2', channels=[2, 4])
+        dmask.set('fc3')
+        activation = dnn.compute_activation(stimuli, dmask, n_worker=0)
+        activation_pack = dnn.compute_activation(stimuli_pack, dmask, batch_size=4)
+        for layer in dmask.layers:
+            np.testing.assert_equal(activation.get(layer), activation_pack.get(layer))
+
+        # the packed images must be of the input size
+        stimuli_pack = stimuli.pack(pjoin(TMP_DIR, 'test_vgg.pack.npy'),
+                                    db_models.Vgg11(False).test_transform)
+        dnn.img_size = (112, 112)
+        with pytest.raises(ValueError):
+            dnn.compute_activation(stimuli_pack, dmask)
+
+    def test_compute_activation_tar(self):
+
+        # prepare images
+        img_dir = pjoin(TMP_DIR, 'compute_activation_tar')
+        if not os.path.isdir(img_dir):
+            os.makedirs(img_dir)
+        img_ids = []
+        for idx in range(10):
+            arr = np.random.randint(0, 256, (60, 80, 3), np.uint8)
+            Image.fromarray(arr).save(pjoin(img_dir, '{}.png'.format(idx)))
+            img_ids.append('{}.png'.format(idx))
+        stimuli = dcore.Stimulus(header={'type': 'image', 'path': img_dir})
+        stimuli.set('stimID', img_ids)
+        stimuli_tar = stimuli.shard(pjoin(TMP_DIR, 'test.shards'))
+
+        # assert
+        dnn = db_models.AlexNet(False)
+        dmask = dcore.Mask()
+        dmask.set('conv2', channels=[2, 4])
+        dmask.set('fc3')
+        activation = dnn.compute_activation(stimuli, dmask, n_worker=0)
+        activation_tar = dnn.compute_activation(stimuli_tar, dmask, batch_size=4, n_worker=2)
+        for layer in dmask.layers:
+            np.testing.assert_equal(activation.get(layer), activation_tar.get(layer))
+
+    def test_compute_activation_stream(self):
+
+        # prepare stimuli and DNN
+        dnn = db_models.AlexNet(False)
+        stimuli = np.random.randint(0, 256, (10, 3, 224, 224), np.uint8)
+        dmask = dcore.Mask()
+        dmask.set('conv5', channels=[1, 2, 3])
+        dmask.set('fc3')
+
+        # extract in memory and in streaming mode
+        activation = dnn.compute_activation(stimuli, dmask)
+        fname = pjoin(TMP_DIR, 'test_stream.act.h5')
+        assert dnn.compute_activation(stimuli, dmask, out_file=fname) is None
+
+        # assert
+        activation_file = dcore.Activation()
+        activation_file.load(fname)
+        assert activation_file.layers == dmask.layers
+        for layer in dmask.layers:
+            np.testing.assert_equal(activation.get(layer),
+                                    activation_file.get(layer))
+
+        # stream in channel-major chunks without compression
+        dnn.compute_activation(stimuli, dmask, out_file=fname, layout='chn',
+                               compression=None)
+        with h5py.File(fname, 'r') as rf:
+            assert rf['conv5'].chunks == (10, 1, 13, 13)
+            assert rf['conv5'].compression is None
+        activation_file.load(fname)
+        for layer in dmask.layers:
+            np.testing.assert_equal(activation.get(layer),
+                                    activation_file.get(layer))
+
+    def test_compute_activation_resume(self):
+
+        # prepare stimuli and DNN
+        dnn = db_models.AlexNet(False)
+        stimuli = np.random.randint(0, 256, (10, 3, 224, 224), np.uint8)
+        dmask = dcore.Mask()
+        dmask.set('conv5', channels=[1, 2, 3])
+        dmask.set('fc3')
+        activation = dnn.compute_activation(stimuli, dmask, out_file=None)
+
+        # simulate an interrupted extraction of the first 8 stimuli
+        fname = pjoin(TMP_DIR, 'test_resume.act.h5')
+        dnn.compute_activation(stimuli, dmask, out_file=fname)
+        with h5py.File(fname, 'a') as wf:
+            for layer in dmask.layers:
+                wf[layer].attrs['n_done'] = 8
+                wf[layer][8:] = 0
+
+        # resume the extraction
+        dnn.compute_activation(stimuli, dmask, out_file=fname, resume=True)
+        activation_file = dcore.Activation()
+        activation_file.load(fname)
+        for layer in dmask.layers:
+            np.testing.assert_equal(activation.get(layer),
+                                    activation_file.get(layer))
+
+        # resume with different stimuli or mask
+        with pytest.raises(ValueError):
+            dnn.compute_activation(stimuli[::-1], dmask, out_file=fname, resume=True)
+        dmask.set('conv5', channels=[1, 2])
+        with pytest.raises(ValueError):
+            dnn.compute_activation(stimuli, dmask, out_file=fname, resume=True)
+
+    def test_compute_activation_parallel(self):
+
+        # prepare stimuli and DNN
+        dnn = db_models.AlexNet(False)
+        stimuli = np.random.randint(0, 256, (10, 3, 224, 224), np.uint8)
+        dmask = dcore.Mask()
+        dmask.set('conv5', channels=[1, 2, 3])
+        dmask.set('fc3')
+        activation = dnn.compute_activation(stimuli, dmask)
+
+        # extract in memory and in streaming mode by 3 processes
+        activation1 = dnn.compute_activation(stimuli, dmask, n_proc=3)
+        fname = pjoin(TMP_DIR, 'test_parallel.act.h5')
+        dnn.compute_activation(stimuli, dmask, out_file=fname, n_proc=3)
+        activation2 = dcore.Activation()
+        activation2.load(fname)
+
+        # assert
+        for idx in range(3):
+            assert os.path.isfile(pjoin(TMP_DIR, 'test_parallel.part{}.act.h5'.format(idx)))
+        for layer in dmask.layers:
+            np.testing.assert_almost_equal(activation.get(layer),
+                                           activation1.get(layer), 5)
+            np.testing.assert_equal(activation1.get(layer), activation2.get(layer))
+
+        # the part files and the temporary directory are removed on failure
+        dmask.set('conv5', channels=[1000])
+        fname = pjoin(TMP_DIR, 'test_parallel_fail.act.h5')
+        tmp_dirs = os.listdir(tempfile.gettempdir())
+        with pytest.raises(RuntimeError):
+            dnn.compute_activation(stimuli, dmask, n_proc=2)
+        assert os.listdir(tempfile.gettempdir()) == tmp_dirs
+        with pytest.raises(RuntimeError):
+            dnn.compute_activation(stimuli, dmask, out_file=fname, n_proc=2)
+        for idx in range(2):
+            assert not os.path.exists(pjoin(TMP_DIR, 'test_parallel_fail.part{}.act.h5'.format(idx)))
+
+    def test_compile(self):
+
+        dnn = db_models.AlexNet(False)
+        stimuli = np.random.randint(0, 256, (5, 3, 224, 224), np.uint8)
+        dmask = dcore.Mask()
+        dmask.set('conv1', channels=[2, 4])
+        dmask.set('conv5')
+        dmask.set('fc2')
+        activation = dnn.compute_activation(stimuli, dmask)
+        activation_pool = dnn.compute_activation(stimuli, dmask, 'mean')
+        inputs = torch.rand(2, 3, 224, 224)
+        with torch.no_grad():
+            outputs = dnn(inputs)
+
+        # the compiled model is cached next to the weights
+        model_dir = pjoin(os.environ['DNNBRAIN_DATA'], 'models')
+        fnames = set(os.listdir(model_dir)) if os.path.isdir(model_dir) else set()
+        for _ in range(2):
+            assert dnn.compile() is dnn
+            activation_compiled = dnn.compute_activation(stimuli, dmask)
+            activation_pool_compiled = dnn.compute_activation(stimuli, dmask, 'mean')
+            for layer in dmask.layers:
+                np.testing.assert_allclose(activation_compiled.get(layer),
+                                           activation.get(layer), rtol=1e-4, atol=1e-5)
+                np.testing.assert_allclose(activation_pool_compiled.get(layer),
+                                           activation_pool.get(layer), rtol=1e-4, atol=1e-5)
+            with torch.no_grad():
+                np.testing.assert_allclose(dnn(inputs), outputs, rtol=1e-4, atol=1e-5)
+        fnames_new = set(os.listdir(model_dir)) - fnames
+        assert len(fnames_new) == 2
+        for fname in fnames_new:
+            assert fname.startswith('alexnet_') and fname.endswith('.jit.pt')
+            os.remove(pjoin(model_dir, fname))
+
+        # the compiled model is updated with the weights
+        dnn.compile(cache=False)
+        dnn.ablate('conv5', [1])
+        activation_compiled = dnn.compute_activation(stimuli, dmask)
+        assert set(os.listdir(model_dir)) == fnames
+        dnn.compile(False)
+        activation = dnn.compute_activation(stimuli, dmask)
+        for layer in dmask.layers:
+            np.testing.assert_allclose(activation_compiled.get(layer),
+                                       activation.get(layer), rtol=1e-4, atol=1e-5)
+
+        # gradients are computed by the eager model
+        dnn.compile(cache=False)
+        inputs.requires_grad_(True)
+        dnn(inputs).sum().backward()
+        assert inputs.grad is not None
+
+    def test_quantize(self):
+
+        dnn = db_models.AlexNet(False)
+        stimuli = np.random.randint(0, 256, (6, 3, 224, 224), np.uint8)
+        dmask = dcore.Mask()
+        dmask.set('conv1', channels=[2, 4])
+        dmask.set('conv5')
+        dmask.set('fc2')
+        activation = dnn.compute_activation(stimuli, dmask)
+        with pytest.raises(ValueError):
+            dnn.quantize(conv=True)
+
+        # only fully connected layers are quantized
+        assert dnn.quantize() is dnn
+        activation_quant = dnn.compute_activation(stimuli, dmask)
+        np.testing.assert_equal(activation_quant.get('conv1'), activation.get('conv1'))
+        np.testing.assert_equal(activation_quant.get('conv5'), activation.get('conv5'))
+        assert not np.array_equal(activation_quant.get('fc2'), activation.get('fc2'))
+        errors = dnn.quantization_error(stimuli, dmask)
+        assert list(errors.keys()) == dmask.layers
+        assert errors['conv1']['rel_err'] == 0 and np.isclose(errors['conv1']['r'], 1)
+        assert errors['fc2']['rel_err'] < 0.1 and errors['fc2']['r'] > 0.99
+
+        # convolutional layers are quantized too
+        dnn.quantize(conv=True, stimuli=stimuli, n_calib=4)
+        for layer, error in dnn.quantization_error(stimuli, dmask).items():
+            assert 0 < error['rel_err'] < 0.1 and error['r'] > 0.99
+        activation_pool = dnn.compute_activation(stimuli, dmask, 'max', n_proc=2)
+        assert activation_pool.get('conv5').shape == (6, 256, 1, 1)
+        with pytest.raises(ValueError):
+            dnn.compute_activation(stimuli, dmask, cuda=True)
+
+        # the fp32 model is restored
+        dnn.quantize(False)
+        for layer in dmask.layers:
+            np.testing.assert_equal(dnn.compute_activation(stimuli, dmask).get(layer),
+                                    activation.get(layer))
+
+    def test_load_model(self):
+
+        # the model is built when it is first used
+        dnn = db_models.DNN_REGISTRY['AlexNet']()
+        assert dnn._model is None
+        assert dnn.layers[-1] == 'fc3' and dnn.img_size == (224, 224)
+        assert dnn.weight_file.endswith('alexnet.pth')
+
+        # weights are loaded from files in both formats of torch.save
+        model = db_models.AlexNet(False).model.eval()
+        inputs = torch.rand(2, 3, 224, 224)
+        with torch.no_grad():
+            outputs = model(inputs)
+        for legacy in (False, True):
+            fname = pjoin(TMP_DIR, 'test_load_model.pth')
+            torch.save(model.state_dict(), fname,
+                       _use_new_zipfile_serialization=not legacy)
+            dnn = db_models.AlexNet(False)
+            dnn.weight_file = fname
+            with torch.no_grad():
+                np.testing.assert_equal(dnn.eval()(inputs).numpy(), outputs.numpy())
+            assert all(param.requires_grad for param in dnn.model.parameters())
+
+    def test_truncate(self):
+
+        dnn = db_models.AlexNet(False).eval()
+        inputs = torch.randn(2, 3, 224, 224)
+
+        # get conv2 output from a full forward pass
+        holder = []
+        module = dnn.layer2module('conv2')
+        handle = module.register_forward_hook(
+            lambda m, i, o: holder.append(o.detach().clone()))
+        outputs_full = dnn(inputs)
+        handle.remove()
+
+        # the truncated forward pass stops at conv2
+        with dnn.truncate(['conv1', 'conv2']):
+            outputs = dnn(inputs)
+        assert outputs_full.shape == (2, 1000)
+        torch.testing.assert_close(outputs, holder[0])
+
+        # the stop hook is removed out of the context
+        assert dnn(inputs).shape == (2, 1000)
+
     def test_get_kernel(self):
         # ground truth
         conv5_shape = torch.tensor((256, 256, 3, 3))
@@ -143,6 +516,46 @@ class TestVgg19_bn:
         torch.equal(conv16_1_0, dnn.get_kernel('conv16', 1)[0])    
 
         
+def test_compute_activations():
+
+    # prepare images
+    img_dir = pjoin(TMP_DIR, 'compute_activations')
+    if not os.path.isdir(img_dir):
+        os.makedirs(img_dir)
+    img_ids = []
+    for idx in range(5):
+        arr = np.random.randint(0, 256, (60, 80, 3), np.uint8)
+        Image.fromarray(arr).save(pjoin(img_dir, '{}.png'.format(idx)))
+        img_ids.append('{}.png'.format(idx))
+    stimuli = dcore.Stimulus(header={'type': 'image', 'path': img_dir})
+    stimuli.set('stimID', img_ids)
+
+    # AlexNet and Vgg11 share the transform, while VggFace doesn't normalize
+    dnns = [db_models.AlexNet(False), db_models.Vgg11(False), db_models.VggFace(False)]
+    dmasks = [dcore.Mask() for _ in dnns]
+    dmasks[0].set('conv2', channels=[2, 4])
+    dmasks[0].set('fc3')
+    dmasks[1].set('conv3')
+    dmasks[2].set('conv1_2', channels=[1])
+
+    # assert
+    activations = db_models.compute_activations(dnns, stimuli, dmasks, 'max',
+                                                batch_size=2, n_worker=0)
+    out_files = [pjoin(TMP_DIR, 'compute_activations{}.act.h5'.format(i)) for i in range(3)]
+    assert db_models.compute_activations(dnns, stimuli, dmasks, 'max', out_files=out_files,
+                                         batch_size=2, n_worker=0) == [None] * 3
+    for dnn, dmask, activation, out_file in zip(dnns, dmasks, activations, out_files):
+        activation_dnn = dnn.compute_activation(stimuli, dmask, 'max', batch_size=2, n_worker=0)
+        activation_file = dcore.Activation()
+        activation_file.load(out_file)
+        for layer in dmask.layers:
+            np.testing.assert_equal(activation.get(layer), activation_dnn.get(layer))
+            np.testing.assert_equal(activation_file.get(layer), activation_dnn.get(layer))
+
+    with pytest.raises(ValueError):
+        db_models.compute_activations(dnns, stimuli, dmasks[:2])
+
+
 @pytest.mark.skip
 def test_dnn_train_model():
     """
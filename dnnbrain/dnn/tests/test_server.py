@@ -0,0 +1,104 @@
+import os
+import pytest
+import threading
+import numpy as np
+
+from PIL import Image
+from os.path import join as pjoin
+from dnnbrain.dnn import core as dcore
+from dnnbrain.dnn import server as db_server
+from dnnbrain.dnn.models import AlexNet
+
+TMP_DIR = pjoin(os.path.expanduser('~'), '.dnnbrain_tmp')
+if not os.path.isdir(TMP_DIR):
+    os.makedirs(TMP_DIR)
+
+
+def test_model_server():
+
+    # start a server
+    socket_path = pjoin(TMP_DIR, 'test_server.sock')
+    dnn = AlexNet(False)
+    model_server = db_server.ModelServer(socket_path, {'AlexNet': dnn},
+                                         batch_size=2, max_wait=0.5)
+    thread = threading.Thread(target=model_server.serve_forever, daemon=True)
+    thread.start()
+    while not db_server.server_running(socket_path):
+        pass
+
+    # the server reports its mode, which clients delegating to it must match
+    header, _ = db_server.request({'op': 'ping'}, socket_path=socket_path)
+    assert header == {'nets': ['AlexNet'], 'cuda': False, 'compiled': False,
+                      'batch_size': 2}
+    assert db_server.server_running(socket_path, cuda=False, compiled=False)
+    assert not db_server.server_running(socket_path, cuda=True)
+    assert not db_server.server_running(socket_path, compiled=True)
+
+    # prepare requests
+    stimuli = np.random.randint(0, 256, (3, 4, 3, 224, 224), np.uint8)
+    dmasks = [dcore.Mask() for _ in range(3)]
+    dmasks[0].set('conv5')
+    dmasks[0].set('fc3')
+    dmasks[1].set('conv2', channels=[2, 4], rows=[3, 5])
+    dmasks[2].set('fc1', channels=[1, 8])
+
+    # concurrent requests are run in shared forward passes
+    activations = [None] * 3
+
+    def compute(idx):
+        activations[idx] = db_server.compute_activation(
+            'AlexNet', stimuli[idx], dmasks[idx], 'max' if idx == 1 else None,
+            socket_path=socket_path)
+    threads = [threading.Thread(target=compute, args=(idx,)) for idx in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert model_server.get_batcher('AlexNet').n_forward < 6
+    for idx in range(3):
+        activation = dnn.compute_activation(stimuli[idx], dmasks[idx],
+                                            'max' if idx == 1 else None)
+        assert activations[idx].layers == dmasks[idx].layers
+        for layer in dmasks[idx].layers:
+            np.testing.assert_allclose(activations[idx].get(layer),
+                                       activation.get(layer), rtol=1e-4, atol=1e-5)
+
+    # the server loads stimuli from files and saves activation
+    img_dir = pjoin(TMP_DIR, 'model_server')
+    if not os.path.isdir(img_dir):
+        os.makedirs(img_dir)
+    img_ids = []
+    for idx in range(3):
+        arr = np.random.randint(0, 256, (60, 80, 3), np.uint8)
+        Image.fromarray(arr).save(pjoin(img_dir, '{}.png'.format(idx)))
+        img_ids.append('{}.png'.format(idx))
+    stim_obj = dcore.Stimulus(header={'type': 'image', 'path': img_dir})
+    stim_obj.set('stimID', img_ids)
+    out_file = pjoin(TMP_DIR, 'test_server.act.h5')
+    stim_info = {'header': stim_obj.header, 'data': {'stimID': img_ids}}
+    db_server.request({'op': 'act', 'net': 'AlexNet', 'layer': ['conv5'], 'stim': stim_info,
+                       'out': out_file}, socket_path=socket_path)
+    activation_file = dcore.Activation()
+    activation_file.load(out_file)
+    activation = db_server.compute_activation('AlexNet', stim_obj, dmasks[0],
+                                              socket_path=socket_path)
+    activation_local = dnn.compute_activation(stim_obj, dmasks[0], batch_size=2)
+    np.testing.assert_equal(activation_file.get('conv5'), activation.get('conv5'))
+    n_forward = model_server.get_batcher('AlexNet').n_forward
+    activation = db_server.compute_activation('AlexNet', stim_obj, dmasks[0],
+                                              batch_size=3, socket_path=socket_path)
+    assert model_server.get_batcher('AlexNet').n_forward == n_forward + 1
+    for layer in dmasks[0].layers:
+        np.testing.assert_allclose(activation.get(layer), activation_local.get(layer),
+                                   rtol=1e-4, atol=1e-5)
+
+    # errors are raised at the client
+    with pytest.raises(RuntimeError):
+        db_server.compute_activation('UnknownNet', stimuli[0], dmasks[0],
+                                     socket_path=socket_path)
+
+    # stop the server
+    db_server.request({'op': 'stop'}, socket_path=socket_path)
+    thread.join()
+    assert not os.path.exists(socket_path)
+    assert not db_server.server_running(socket_path)
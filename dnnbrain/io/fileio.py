@@ -1,8 +1,15 @@
+import os
 import h5py
 import numpy as np
 
+from copy import copy
 from collections import OrderedDict
 
+# the size of chunks of DNN activation in bytes (see gen_chunks)
+CHUNK_SIZE = 2 ** 20
+# the size of the raw data chunk cache of each dataset in reading .act.h5 files
+CHUNK_CACHE_SIZE = 2 ** 26
+
 
 class StimulusFile:
     """
@@ -36,6 +43,24 @@ class StimulusFile:
         2,1,1,1,dog,0.6,0.4
         3,2,1,0,cat,0.7,0.5
         ...,...,...,...,...,...
+
+        Format of .stim.csv of packed stimuli is
+        --------------------------
+        type=pack
+        path=path_of_pack_file (.npy file of uint8 images)
+        [Several optional keys] (eg., title=packed stimuli)
+        data=stimID,[onset],[duration],[label],[condition],acc,RT
+        pic1_name,0,1,0,cat,0.4,0.5
+        ...,...,...,...,...,...
+
+        Format of .stim.csv of sharded stimuli is
+        --------------------------
+        type=tar
+        path=dir_of_tar_shards (tar files and their index.csv)
+        [Several optional keys] (eg., title=sharded stimuli)
+        data=stimID,[onset],[duration],[label],[condition],acc,RT
+        pic1_name,0,1,0,cat,0.4,0.5
+        ...,...,...,...,...,...
         """
         assert fname.endswith('.stim.csv'), "File suffix must be .stim.csv"
         self.fname = fname
@@ -65,7 +90,7 @@ class StimulusFile:
             stimuli[k] = v
         assert 'type' in stimuli.keys(), "'type' needs to be included in meta data."
         assert 'path' in stimuli.keys(), "'path' needs to be included in meta data."
-        assert stimuli['type'] in ('image', 'video'), 'not supported type: {}'.format(stimuli['type'])
+        assert stimuli['type'] in ('image', 'video', 'pack', 'tar'), 'not supported type: {}'.format(stimuli['type'])
 
         # --operate var_lines--
         # prepare keys
@@ -80,7 +105,7 @@ class StimulusFile:
         data = OrderedDict()
         for idx, key in enumerate(data_keys):
             if key == 'stimID':
-                if stimuli['type'] == 'image':
+                if stimuli['type'] in ('image', 'pack', 'tar'):
                     dtype = np.str
                 else:
                     var_data[idx] = np.float64(var_data[idx])
@@ -102,12 +127,14 @@ class StimulusFile:
         Parameters
         ----------
         type : str
-            Stimulus type in ('image', 'video')
+            Stimulus type in ('image', 'video', 'pack', 'tar')
         path : str
             Path_to_stimuli.
             
             If type is 'image', the path is the parent directory of the images.
             If type is 'video', the path is the file name of the video.
+            If type is 'pack', the path is the file name of the stimulus pack.
+            If type is 'tar', the path is the directory of the tar shards.
         data : dict
             Stimulus variable data
         opt_meta : dict
@@ -129,6 +156,289 @@ class StimulusFile:
             wf.write('\n'.join(var_data))
 
 
+def quantize(data, dtype):
+    """
+    Quantize DNN activation linearly channel by channel
+
+    Parameters
+    ----------
+    data : ndarray
+        DNN activation with shape as (n_stim, n_chn, n_row, n_col)
+    dtype : str
+        Integer data type, choices=('uint8', 'int16')
+
+    Returns
+    -------
+    data_q : ndarray
+        Quantized activation
+    scale : ndarray
+        float32 array with shape as (n_chn,)
+    offset : ndarray
+        float32 array with shape as (n_chn,)
+        data is approximately data_q * scale + offset
+    """
+    info = np.iinfo(dtype)
+    axis = (0, 2, 3)
+    data_min = data.min(axis).astype(np.float32)
+    data_max = data.max(axis).astype(np.float32)
+    scale = (data_max - data_min) / (int(info.max) - int(info.min))
+    scale[scale == 0] = 1
+    offset = data_min - info.min * scale
+
+    data_q = (data - offset[None, :, None, None]) / scale[None, :, None, None]
+    data_q = np.clip(np.round(data_q), info.min, info.max).astype(dtype)
+
+    return data_q, scale, offset
+
+
+def gen_chunks(shape, itemsize, layout=None):
+    """
+    Generate the chunk shape of DNN activation for the access pattern.
+    Each chunk is not larger than about CHUNK_SIZE bytes,
+    unless a single channel of a stimulus is larger than it.
+
+    Parameters
+    ----------
+    shape : tuple
+        (n_stim, n_chn, n_row, n_col)
+    itemsize : int
+        The number of bytes of each element
+    layout : str
+        'stim': stimulus-major; each chunk includes all channels of a batch of
+        stimuli, which suits extracting, pooling or reading a batch of stimuli.
+        'chn': channel-major; each chunk includes a channel of a batch of
+        stimuli (all of them if small enough), which suits reading channels
+        of all stimuli, such as -chn and iterating along channels.
+        If is None, the chunk shape is guessed by h5py.
+
+    Returns
+    -------
+    chunks : tuple, bool
+        The chunk shape, or True if layout is None.
+    """
+    if layout is None:
+        return True
+    n_stim, n_chn, n_row, n_col = shape
+    map_size = max(n_row * n_col * itemsize, 1)
+    if layout == 'stim':
+        n_chn_chunk = min(max(CHUNK_SIZE // map_size, 1), n_chn)
+        n_stim_chunk = 1 if n_chn_chunk < n_chn else CHUNK_SIZE // (map_size * n_chn)
+    elif layout == 'chn':
+        n_chn_chunk = 1
+        n_stim_chunk = CHUNK_SIZE // map_size
+    else:
+        raise ValueError('Unsupported layout: {}'.format(layout))
+    n_stim_chunk = min(max(n_stim_chunk, 1), max(n_stim, 1))
+
+    return n_stim_chunk, max(n_chn_chunk, 1), max(n_row, 1), max(n_col, 1)
+
+
+def gen_compression(compression='gzip'):
+    """
+    Generate the compression options of h5py datasets
+
+    Parameters
+    ----------
+    compression : str
+        'gzip': compress by gzip, which is small but slow.
+        'lzf': shuffle the bytes and compress by lzf, which is fast to
+        read and write with a moderate compression ratio.
+        If is None, store activation without compression.
+
+    Returns
+    -------
+    kwargs : dict
+        Keyword arguments of h5py.Group.create_dataset()
+    """
+    if compression == 'gzip':
+        return {'compression': 'gzip'}
+    elif compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    elif compression is None:
+        return dict()
+    else:
+        raise ValueError('Unsupported compression: {}'.format(compression))
+
+
+class LazyArray:
+    """
+    DNN activation of a layer backed by a dataset of an open .act.h5 file
+
+    The activation is read from the file only when indexed or converted
+    by np.asarray(), and only the indexed part is read. Indices of the
+    four axes (stimulus, channel, row, column) are applied independently
+    as h5py does, and the result is an ndarray.
+    """
+    def __init__(self, dataset, channels='all', rows='all', columns='all', dtype=None):
+        """
+        Parameters
+        ----------
+        dataset : h5py.Dataset
+            Dataset of the layer with shape as (n_stim, n_chn, n_row, n_col)
+        channels : str, list
+            Serial numbers of channels of interest, or 'all'.
+        rows : str, list
+            Serial numbers of rows of interest, or 'all'.
+        columns : str, list
+            Serial numbers of columns of interest, or 'all'.
+        dtype : str
+            Data type of the read activation. The same as ActivationFile.read().
+        """
+        self._dataset = dataset
+        self._scale = dataset.attrs.get('scale')
+        self._offset = dataset.attrs.get('offset')
+        self._indices = _select_indices([np.arange(n) for n in dataset.shape],
+                                        channels, rows, columns)
+        if dtype is None:
+            dtype = dataset.attrs.get('dtype', dataset.dtype)
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def fname(self):
+        return self._dataset.file.filename
+
+    @property
+    def shape(self):
+        return tuple(len(idx) for idx in self._indices)
+
+    @property
+    def ndim(self):
+        return len(self._indices)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'LazyArray(shape={0}, dtype={1}, file={2})'.format(
+            self.shape, self.dtype, self.fname)
+
+    def mask(self, channels='all', rows='all', columns='all'):
+        """
+        Mask the activation without reading it
+
+        Parameters
+        ----------
+        channels : str, list
+            Serial numbers of channels of interest, or 'all'.
+        rows : str, list
+            Serial numbers of rows of interest, or 'all'.
+        columns : str, list
+            Serial numbers of columns of interest, or 'all'.
+
+        Returns
+        -------
+        array : LazyArray
+            Activation of the masked channels, rows and columns
+        """
+        array = copy(self)
+        array._indices = _select_indices(self._indices, channels, rows, columns)
+        return array
+
+    def __getitem__(self, indices):
+        """
+        Read part of the activation
+
+        Parameters
+        ----------
+        indices : int, slice, list, ndarray, tuple
+            Indices of the axes (stimulus, channel, row, column) in order
+
+        Returns
+        -------
+        data : ndarray
+            The activation indexed by indices
+        """
+        if not isinstance(indices, tuple):
+            indices = (indices,)
+        for pos, key in enumerate(indices):
+            if key is Ellipsis:
+                n_fill = self.ndim - len(indices) + 1
+                indices = indices[:pos] + (slice(None),) * n_fill + indices[pos+1:]
+                break
+        if len(indices) > self.ndim:
+            raise IndexError('too many indices for LazyArray')
+        indices = indices + (slice(None),) * (self.ndim - len(indices))
+
+        selection = []
+        squeeze_axes = []
+        for axis, key in enumerate(indices):
+            idx = np.asarray(self._indices[axis][key])
+            if idx.ndim == 0:
+                squeeze_axes.append(axis)
+                idx = idx[None]
+            elif idx.ndim > 1:
+                raise IndexError('only 1D indices are supported for each axis')
+            selection.append(idx)
+
+        data = self._read(selection)
+        if squeeze_axes:
+            data = data.squeeze(tuple(squeeze_axes))
+        return data
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    def _read(self, selection):
+        """
+        Read the activation at the cross of indices of each axis
+        """
+        if min(len(idx) for idx in selection) == 0:
+            return np.zeros([len(idx) for idx in selection], self.dtype)
+
+        # h5py accepts increasing indices on one axis at most,
+        # so the others are read as a range and indexed in memory.
+        file_sel = []
+        mem_sel = []
+        fancy = False
+        for idx in selection:
+            start, stop = idx.min(), idx.max() + 1
+            if stop - start == len(idx) and np.all(np.diff(idx) > 0):
+                file_sel.append(slice(start, stop))
+                mem_sel.append(None)
+            elif not fancy:
+                idx_uniq, idx_inv = np.unique(idx, return_inverse=True)
+                file_sel.append(idx_uniq)
+                mem_sel.append(None if len(idx_uniq) == len(idx) and
+                               np.all(idx_uniq == idx) else idx_inv)
+                fancy = True
+            else:
+                file_sel.append(slice(start, stop))
+                mem_sel.append(idx - start)
+        data = self._dataset[tuple(file_sel)]
+        for axis, idx in enumerate(mem_sel):
+            if idx is not None:
+                data = np.take(data, idx, axis)
+
+        data = data.astype(self.dtype, copy=False)
+        if self._scale is not None:
+            # dequantize: data = quantized * scale + offset
+            channels = selection[1]
+            data *= self._scale[channels].astype(self.dtype)[None, :, None, None]
+            data += self._offset[channels].astype(self.dtype)[None, :, None, None]
+
+        return data
+
+
+def _select_indices(indices, channels='all', rows='all', columns='all'):
+    """
+    Select indices of channels, rows and columns by their serial numbers
+    """
+    indices = list(indices)
+    for axis, serials in enumerate((channels, rows, columns), 1):
+        if serials != 'all':
+            indices[axis] = indices[axis][np.asarray(serials, dtype=int) - 1]
+    return indices
+
+
 class ActivationFile:
     """
     a class to read and write activation file
@@ -142,8 +452,11 @@ class ActivationFile:
         """
         assert fname.endswith('.act.h5'), "the file's suffix must be .act.h5"
         self.fname = fname
+        self._wf = None
+        self._layout = None
+        self._compression = 'gzip'
 
-    def read(self, dmask=None):
+    def read(self, dmask=None, dtype=None, lazy=False):
         """
         Read DNN activation
 
@@ -151,6 +464,15 @@ class ActivationFile:
         ----------
         dmask : dict
             Dictionary of the DNN mask information
+        dtype : str
+            Data type of the returned activation, such as 'float32'.
+            If is None, it is the data type before the activation was
+            stored as float16 or quantized, or the stored data type otherwise.
+            Quantized activation is dequantized straight into this data type.
+        lazy : bool
+            If true, return LazyArray objects backed by the open file,
+            which read the activation only when indexed.
+            The file is closed when all of them are deleted.
 
         Returns
         -------
@@ -158,7 +480,9 @@ class ActivationFile:
             DNN activation
         """
         # prepare
-        rf = h5py.File(self.fname, 'r')
+        # the chunk cache keeps the chunks shared by discontinuous channels,
+        # rows or columns from being decompressed repeatedly
+        rf = h5py.File(self.fname, 'r', rdcc_nbytes=CHUNK_CACHE_SIZE, rdcc_nslots=10007)
 
         if dmask is None:
             dmask = dict()
@@ -168,24 +492,15 @@ class ActivationFile:
         # read activation
         activation = dict()
         for k, v in dmask.items():
-            activation[k] = dict()
-            ds = rf[k]
-            if v['chn'] != 'all':
-                channels = [chn-1 for chn in v['chn']]
-                ds = ds[:, channels, :, :]
-            if v['row'] != 'all':
-                rows = [row-1 for row in v['row']]
-                ds = ds[:, :, rows, :]
-            if v['col'] != 'all':
-                columns = [col-1 for col in v['col']]
-                ds = ds[:, :, :, columns]
-
-            activation[k] = np.asarray(ds)
+            activation[k] = LazyArray(rf[k], v['chn'], v['row'], v['col'], dtype)
+            if not lazy:
+                activation[k] = np.asarray(activation[k])
 
-        rf.close()
+        if not lazy:
+            rf.close()
         return activation
-    
-    def write(self, activation):
+
+    def write(self, activation, dtype=None, layout=None, compression='gzip'):
         """
         Write DNN activation to a hdf5 file
 
@@ -193,12 +508,199 @@ class ActivationFile:
         ----------
         activation : dict
             DNN activation
+        dtype : str
+            Data type used to store the activation.
+            If is None, store activation as it is.
+            If is 'float16', store activation as half precision floats.
+            If is 'uint8' or 'int16', quantize each channel linearly into the
+            integer's range, and record its scale and offset as attributes.
+            The original data type is recorded as the attribute 'dtype',
+            which is restored by self.read().
+        layout : str
+            Chunk layout for the access pattern, choices=(None, stim, chn).
+            See gen_chunks() for details.
+            If layout and compression are both None, the activation is stored contiguously.
+        compression : str
+            Compression method, choices=(gzip, lzf, None).
+            See gen_compression() for details.
         """
         wf = h5py.File(self.fname, 'w')
         for layer, data in activation.items():
-            wf.create_dataset(layer, data=data, compression='gzip')
+            data = np.asarray(data)
+            if dtype is None:
+                data_s = data
+            elif dtype == 'float16':
+                data_s = data.astype(np.float16)
+            elif dtype in ('uint8', 'int16'):
+                data_s, scale, offset = quantize(data, dtype)
+            else:
+                raise ValueError('Unsupported dtype: {}'.format(dtype))
+
+            if layout is None and compression is None:
+                chunks = None
+            else:
+                chunks = gen_chunks(data_s.shape, data_s.dtype.itemsize, layout)
+            ds = wf.create_dataset(layer, data=data_s, chunks=chunks,
+                                   **gen_compression(compression))
+            if dtype is None:
+                continue
+            if dtype in ('uint8', 'int16'):
+                ds.attrs['scale'] = scale
+                ds.attrs['offset'] = offset
+            ds.attrs['dtype'] = data.dtype.name
+
+        wf.close()
+
+    def open(self, mode='w', layout=None, compression='gzip'):
+        """
+        Open the file to write DNN activation batch by batch
+
+        Parameters
+        ----------
+        mode : str
+            'w': create the file, truncate if exists.
+            'a': read/write if exists, create otherwise.
+        layout : str
+            Chunk layout of the datasets created by self.write_batch(),
+            choices=(None, stim, chn). See gen_chunks() for details.
+        compression : str
+            Compression method of the datasets created by self.write_batch(),
+            choices=(gzip, lzf, None). See gen_compression() for details.
+        """
+        self._wf = h5py.File(self.fname, mode)
+        self._layout = layout
+        self._compression = compression
+
+    def write_batch(self, layer, data, start, n_stim):
+        """
+        Write a batch of DNN activation to the file opened by self.open()
+        The layer's dataset is created at the first writing with room for n_stim stimuli.
+        It is chunked by the layout given to self.open(), and resizable along
+        the stimulus axis.
+
+        Parameters
+        ----------
+        layer : str
+            Layer name
+        data : ndarray
+            DNN activation of the batch with shape as (n_batch, n_chn, n_row, n_col)
+        start : int
+            The index of the batch's first stimulus in all stimuli
+        n_stim : int
+            The number of all stimuli
+        """
+        if layer not in self._wf:
+            shape = (n_stim, *data.shape[1:])
+            chunks = gen_chunks(shape, data.dtype.itemsize, self._layout)
+            self._wf.create_dataset(layer, shape=shape, dtype=data.dtype,
+                                    maxshape=(None, *data.shape[1:]), chunks=chunks,
+                                    **gen_compression(self._compression))
+        ds = self._wf[layer]
+        stop = start + data.shape[0]
+        if stop > ds.shape[0]:
+            ds.resize(stop, axis=0)
+        ds[start:stop] = data
+
+    def read_attrs(self, layer=None):
+        """
+        Read attributes from the file opened by self.open()
+
+        Parameters
+        ----------
+        layer : str
+            Layer name
+            If is None, read attributes of the file.
+            Otherwise, read attributes of the layer's dataset.
+
+        Returns
+        -------
+        attrs : dict
+            Attributes. It is empty if the layer doesn't exist.
+        """
+        if layer is None:
+            attrs = dict(self._wf.attrs)
+        elif layer in self._wf:
+            attrs = dict(self._wf[layer].attrs)
+        else:
+            attrs = dict()
+
+        return attrs
+
+    def write_attrs(self, attrs, layer=None):
+        """
+        Write attributes to the file opened by self.open()
+
+        Parameters
+        ----------
+        attrs : dict
+            Attributes
+        layer : str
+            Layer name
+            If is None, write attributes to the file.
+            Otherwise, write attributes to the layer's dataset.
+        """
+        obj = self._wf if layer is None else self._wf[layer]
+        for k, v in attrs.items():
+            obj.attrs[k] = v
+
+    def write_virtual(self, part_files):
+        """
+        Write DNN activation which concatenates activation in the part files
+        along the stimulus axis. Each layer is a HDF5 virtual dataset which
+        maps to the part files, so no data is copied. The part files are
+        referred to by paths relative to this file, so they must be kept
+        in the same directory with it.
+
+        Parameters
+        ----------
+        part_files : list
+            File names of the part files with suffix as .act.h5
+            They must have the same layers and attributes.
+        """
+        out_dir = os.path.dirname(os.path.abspath(self.fname))
+        rfs = [h5py.File(part_file, 'r') for part_file in part_files]
+        wf = h5py.File(self.fname, 'w')
+        for k, v in rfs[0].attrs.items():
+            wf.attrs[k] = v
+        for layer in rfs[0].keys():
+            shapes = [rf[layer].shape for rf in rfs]
+            n_stim = sum([shape[0] for shape in shapes])
+            layout = h5py.VirtualLayout(shape=(n_stim, *shapes[0][1:]),
+                                        dtype=rfs[0][layer].dtype)
+            start = 0
+            for part_file, shape in zip(part_files, shapes):
+                fname = os.path.relpath(os.path.abspath(part_file), out_dir)
+                layout[start:start+shape[0]] = h5py.VirtualSource(fname, layer, shape)
+                start += shape[0]
+            ds = wf.create_virtual_dataset(layer, layout)
+            for k, v in rfs[0][layer].attrs.items():
+                ds.attrs[k] = v
+            if 'n_done' in ds.attrs:
+                # the finished stimuli are contiguous until the first unfinished part
+                n_done = 0
+                for rf in rfs:
+                    n_done_part = rf[layer].attrs.get('n_done', 0)
+                    n_done += n_done_part
+                    if n_done_part < rf[layer].shape[0]:
+                        break
+                ds.attrs['n_done'] = n_done
 
         wf.close()
+        for rf in rfs:
+            rf.close()
+
+    def flush(self):
+        """
+        Flush the batches written by self.write_batch() to the disk
+        """
+        self._wf.flush()
+
+    def close(self):
+        """
+        Close the file opened by self.open()
+        """
+        self._wf.close()
+        self._wf = None
 
 
 class MaskFile:
@@ -89,6 +89,179 @@ class TestActivationFile:
 
         rf.close()
 
+    def test_write_dtype(self):
+
+        fname = pjoin(TMP_DIR, 'test_dtype.act.h5')
+        activation = {
+            'conv5': np.random.randn(5, 3, 13, 13),
+            'fc3': np.random.rand(5, 10, 1, 1) * np.arange(1, 11)[None, :, None, None]
+        }
+        activation['conv5'][:, 1] = 0.5  # a constant channel
+
+        for dtype, decimal in [('float16', 2), ('int16', 3), ('uint8', 1)]:
+            fio.ActivationFile(fname).write(activation, dtype)
+
+            # assert storage
+            rf = h5py.File(fname, 'r')
+            for layer, data in activation.items():
+                assert rf[layer].dtype == np.dtype(dtype)
+                assert rf[layer].attrs['dtype'] == 'float64'
+            rf.close()
+
+            # assert dequantization
+            activation_file = fio.ActivationFile(fname).read()
+            for layer, data in activation.items():
+                assert activation_file[layer].dtype == np.float64
+                np.testing.assert_almost_equal(activation_file[layer], data, decimal)
+
+            # read straight into float32 with a mask
+            dmask = {'conv5': {'chn': [2, 3], 'row': 'all', 'col': [1]}}
+            activation_file = fio.ActivationFile(fname).read(dmask, 'float32')
+            assert activation_file['conv5'].dtype == np.float32
+            np.testing.assert_almost_equal(activation_file['conv5'],
+                                           activation['conv5'][:, 1:, :, :1], decimal)
+
+    def test_write_layout(self):
+
+        fname = pjoin(TMP_DIR, 'test_layout.act.h5')
+        activation = {
+            'conv5': np.random.randn(50, 64, 13, 13).astype(np.float32),
+            'fc3': np.random.randn(50, 10, 1, 1).astype(np.float32)
+        }
+        dmask = {'conv5': {'chn': [2, 9, 5], 'row': 'all', 'col': 'all'},
+                 'fc3': {'chn': 'all', 'row': 'all', 'col': 'all'}}
+
+        # assert chunks and compression
+        chunks = {('stim', 'conv5'): (24, 64, 13, 13), ('stim', 'fc3'): (50, 10, 1, 1),
+                  ('chn', 'conv5'): (50, 1, 13, 13), ('chn', 'fc3'): (50, 1, 1, 1)}
+        for layout in ('stim', 'chn'):
+            for compression in ('gzip', 'lzf', None):
+                fio.ActivationFile(fname).write(activation, layout=layout,
+                                                compression=compression)
+                rf = h5py.File(fname, 'r')
+                for layer in activation.keys():
+                    assert rf[layer].chunks == chunks[(layout, layer)]
+                    assert rf[layer].compression == compression
+                    assert rf[layer].shuffle == (compression == 'lzf')
+                rf.close()
+
+                # assert reading
+                activation_file = fio.ActivationFile(fname).read(dmask)
+                np.testing.assert_equal(activation_file['conv5'],
+                                        activation['conv5'][:, [1, 8, 4]])
+                np.testing.assert_equal(activation_file['fc3'], activation['fc3'])
+
+        # store contiguously without chunks
+        fio.ActivationFile(fname).write(activation, 'float16', compression=None)
+        rf = h5py.File(fname, 'r')
+        assert rf['conv5'].chunks is None
+        rf.close()
+
+        # a single channel of a stimulus is larger than a chunk
+        assert fio.gen_chunks((10, 3, 1000, 1000), 4, 'stim') == (1, 1, 1000, 1000)
+        assert fio.gen_chunks((10, 3, 1000, 1000), 4, 'chn') == (1, 1, 1000, 1000)
+        with pytest.raises(ValueError):
+            fio.gen_chunks((10, 3, 1, 1), 4, 'row')
+
+    def test_read_lazy(self):
+
+        fname = pjoin(TMP_DIR, 'test_lazy.act.h5')
+        data = np.random.randn(6, 5, 4, 3)
+        dmask = {'conv5': {'chn': [5, 2, 4], 'row': 'all', 'col': [3, 1]}}
+        data_mask = data[:, [4, 1, 3]][:, :, :, [2, 0]]
+        for dtype in (None, 'uint8'):
+            fio.ActivationFile(fname).write({'conv5': data}, dtype)
+            activation = fio.ActivationFile(fname).read(dmask)
+            activation_lazy = fio.ActivationFile(fname).read(dmask, lazy=True)
+            array = activation_lazy['conv5']
+
+            # assert the whole array
+            assert isinstance(array, fio.LazyArray)
+            assert array.shape == (6, 3, 4, 2) and len(array) == 6
+            assert array.dtype == np.float64
+            np.testing.assert_equal(np.asarray(array), activation['conv5'])
+
+            # assert part of the array
+            expected = activation['conv5']
+            np.testing.assert_almost_equal(expected, data_mask, 1)
+            np.testing.assert_equal(array[2], expected[2])
+            np.testing.assert_equal(array[[4, 1, 1]], expected[[4, 1, 1]])
+            np.testing.assert_equal(array[1:5:2, [2, 0], 1], expected[1:5:2][:, [2, 0], 1])
+            np.testing.assert_equal(array[..., -1], expected[..., -1])
+            np.testing.assert_equal(array[:, :, [3, 0]][:, :, :, [1]],
+                                    expected[:, :, [3, 0]][:, :, :, [1]])
+            assert array[[]].shape == (0, 3, 4, 2)
+            np.testing.assert_equal(np.asarray(array.mask([3, 1], [2])),
+                                    expected[:, [2, 0]][:, :, [1]])
+            with pytest.raises(IndexError):
+                array[0, 0, 0, 0, 0]
+
+            # the file is closed with the lazy arrays
+            del activation_lazy, array
+
+    def test_write_batch(self):
+
+        fname = pjoin(TMP_DIR, 'test_batch.act.h5')
+        # ground truth
+        activation = {
+            'conv5': np.random.randn(5, 3, 13, 13).astype(np.float32),
+            'fc3': np.random.randn(5, 10, 1, 1).astype(np.float32)
+        }
+
+        # save batch by batch
+        act_file = fio.ActivationFile(fname)
+        act_file.open('w')
+        for start, stop in [(0, 2), (2, 4), (4, 5)]:
+            for layer, data in activation.items():
+                act_file.write_batch(layer, data[start:stop], start, 5)
+            act_file.flush()
+        act_file.close()
+
+        # assert
+        activation_file = fio.ActivationFile(fname).read()
+        assert list(activation.keys()) == list(activation_file.keys())
+        for layer, data in activation.items():
+            np.testing.assert_equal(data, activation_file[layer])
+
+        # save in channel-major chunks compressed by lzf
+        act_file.open('w', 'chn', 'lzf')
+        for start, stop in [(0, 2), (2, 4), (4, 5)]:
+            for layer, data in activation.items():
+                act_file.write_batch(layer, data[start:stop], start, 5)
+        act_file.close()
+        with h5py.File(fname, 'r') as rf:
+            assert rf['conv5'].chunks == (5, 1, 13, 13)
+            assert rf['conv5'].compression == 'lzf'
+            assert rf['conv5'].shuffle
+        activation_file = fio.ActivationFile(fname).read()
+        for layer, data in activation.items():
+            np.testing.assert_equal(data, activation_file[layer])
+
+    def test_write_virtual(self):
+
+        # prepare part files
+        activation = {
+            'conv5': np.random.randn(5, 3, 13, 13),
+            'fc3': np.random.randn(5, 10, 1, 1)
+        }
+        part_files = [pjoin(TMP_DIR, 'test_part{}.act.h5'.format(idx)) for idx in range(2)]
+        fio.ActivationFile(part_files[0]).write(
+            dict((k, v[:3]) for k, v in activation.items()))
+        fio.ActivationFile(part_files[1]).write(
+            dict((k, v[3:]) for k, v in activation.items()))
+
+        # merge part files
+        fname = pjoin(TMP_DIR, 'test_virtual.act.h5')
+        fio.ActivationFile(fname).write_virtual(part_files)
+
+        # assert
+        rf = h5py.File(fname, 'r')
+        assert list(activation.keys()) == list(rf.keys())
+        for layer, data in activation.items():
+            assert rf[layer].is_virtual
+            np.testing.assert_equal(data, np.array(rf[layer]))
+        rf.close()
+
 
 class TestMaskFile:
 
@@ -0,0 +1,358 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
+
+from os.path import join as pjoin
+from dnnbrain.dnn.core import Activation, Stimulus
+from dnnbrain.io.fileio import LazyArray
+from dnnbrain.utils.util import gen_dmask, load_response, save_mapping
+
+# stages whose results are DNN activation
+ACTIVATION_OPS = ('act', 'load', 'mask', 'pool', 'fe', 'hrf')
+# stages whose results are mappings from DNN activation to brain response
+MAPPING_OPS = ('encode', 'corr')
+
+
+def load_pipeline(fname):
+    """
+    Load a pipeline description
+
+    Parameters
+    ----------
+    fname : str
+        A .json file, or a .yaml/.yml file if PyYAML is installed.
+        It contains a list of stages, or a dict with the list as 'stages'
+        and the optional 'budget' (MB) and 'spill_dir'.
+
+    Returns
+    -------
+    config : dict
+        Pipeline description with the key 'stages'
+    """
+    with open(fname) as rf:
+        if fname.endswith('.yaml') or fname.endswith('.yml'):
+            try:
+                import yaml
+            except ModuleNotFoundError:
+                raise Exception('Please install PyYAML to load pipelines from YAML files')
+            config = yaml.safe_load(rf)
+        elif fname.endswith('.json'):
+            config = json.load(rf)
+        else:
+            raise IOError('Only .json and .yaml/.yml pipeline files are supported')
+
+    if isinstance(config, list):
+        config = {'stages': config}
+
+    return config
+
+
+def activation_nbytes(activation):
+    """
+    Calculate the memory occupied by DNN activation
+
+    Parameters
+    ----------
+    activation : Activation
+        DNN activation
+
+    Returns
+    -------
+    nbytes : int
+        The number of bytes of all layers' data in memory.
+        Layers loaded lazily occupy no memory.
+    """
+    return sum(activation.get(layer).nbytes for layer in activation.layers
+               if not isinstance(activation.get(layer), LazyArray))
+
+
+class Pipeline:
+    """
+    A chain of stages run in one process, such as dnn_act -> dnn_pool ->
+    db_hrf -> db_encode. Intermediate results are passed in memory
+    rather than through .act.h5 files, and only the stages with 'out'
+    are saved.
+
+    Each stage is a dict with 'op' and the options of the corresponding
+    command line tool, which are listed below. All stages accept 'name'
+    (default is 'stage<index>'), 'input' (the name of the stage whose
+    result is processed, default is the previous stage), 'layer', 'chn'
+    and 'dmask' (masks applied to the input activation). The activation
+    saved as 'out' is stored with 'dtype', 'layout' and 'compress'
+    as dnn_act does.
+
+    +--------+---------+-------------------------------------------------+
+    | op     | tool    | options                                         |
+    +========+=========+=================================================+
+    | act    | dnn_act | net, stim, pool, cuda, batch_size, n_worker,    |
+    |        |         | exact, compile, cache, out                      |
+    +--------+---------+-------------------------------------------------+
+    | load   |         | act (loaded lazily)                             |
+    +--------+---------+-------------------------------------------------+
+    | mask   | dnn_mask| out                                             |
+    +--------+---------+-------------------------------------------------+
+    | pool   | dnn_pool| meth, out                                       |
+    +--------+---------+-------------------------------------------------+
+    | fe     | dnn_fe  | meth, n_feat, axis, out                         |
+    +--------+---------+-------------------------------------------------+
+    | hrf    | db_hrf  | stim, tr, n_vol, ops, out                       |
+    +--------+---------+-------------------------------------------------+
+    | encode |db_encode| anal, model, resp, roi, bmask, iteraxis,        |
+    |        |         | scoring, cv, out                                |
+    +--------+---------+-------------------------------------------------+
+    | corr   | db_corr | resp, roi, bmask, iteraxis, out                 |
+    +--------+---------+-------------------------------------------------+
+    """
+    def __init__(self, stages, budget=None, spill_dir=None):
+        """
+        Parameters
+        ----------
+        stages : list
+            Stages described by dicts
+        budget : float
+            The memory (MB) for the intermediate activation kept to be
+            processed by later stages. The largest ones are spilled to
+            .act.h5 files when the budget is exceeded.
+            Default is keeping all of them in memory.
+        spill_dir : str
+            The directory where the activation is spilled.
+            Default is a temporary directory removed after running.
+        """
+        self.stages = []
+        names = []
+        for idx, stage in enumerate(stages):
+            stage = dict(stage)
+            op = stage.get('op')
+            if op not in ACTIVATION_OPS + MAPPING_OPS:
+                raise ValueError('Invalid op of stage{0}: {1} (choose from {2})'.format(
+                    idx, op, ACTIVATION_OPS + MAPPING_OPS))
+            stage.setdefault('name', 'stage{}'.format(idx))
+            if stage['name'] in names:
+                raise ValueError('Duplicated stage name: {}'.format(stage['name']))
+
+            # check the input
+            if op in ('act', 'load'):
+                stage['input'] = None
+            else:
+                if idx == 0 and 'input' not in stage:
+                    raise ValueError("The first stage can't be {}, which needs "
+                                     "an input stage".format(op))
+                stage.setdefault('input', names[-1] if names else None)
+                if stage['input'] not in names:
+                    raise ValueError("The input of {0} is not an earlier stage: {1}".format(
+                        stage['name'], stage['input']))
+                if self.stages[names.index(stage['input'])]['op'] in MAPPING_OPS:
+                    raise ValueError("The input of {} must be DNN activation".format(
+                        stage['name']))
+
+            # parse the DNN mask once
+            if 'layer' in stage or 'dmask' in stage:
+                stage['dmask'] = gen_dmask(stage.get('layer'), stage.get('chn', 'all'),
+                                           stage.get('dmask'))
+            elif op == 'act':
+                raise ValueError("The act stage {} needs 'layer' or 'dmask'".format(
+                    stage['name']))
+            else:
+                stage['dmask'] = None
+
+            names.append(stage['name'])
+            self.stages.append(stage)
+
+        # the index of the last stage using each result
+        self._last_use = dict()
+        for idx, stage in enumerate(self.stages):
+            if stage['input'] is not None:
+                self._last_use[stage['input']] = idx
+
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self._results = dict()
+        self._spilled = dict()
+        self._spill_files = []
+        self._dnns = dict()
+
+    def run(self, verbose=False):
+        """
+        Run all stages in order
+
+        Parameters
+        ----------
+        verbose : bool
+            If true, print the time cost of each stage.
+
+        Returns
+        -------
+        results : dict
+            Results of the final stages, whose results are not used by
+            other stages. Keys are stage names; values are Activation
+            objects for activation stages, and dicts returned by
+            BrainEncoder.encode_dnn for encode and corr stages.
+        """
+        ops = {'act': self._act, 'load': self._load, 'mask': self._mask,
+               'pool': self._pool, 'fe': self._fe, 'hrf': self._hrf,
+               'encode': self._encode, 'corr': self._encode}
+        tmp_dir = None
+        if self.budget is not None and self.spill_dir is None:
+            tmp_dir = tempfile.mkdtemp(prefix='dnnbrain_pipeline_')
+        results = dict()
+        try:
+            for idx, stage in enumerate(self.stages):
+                time1 = time.time()
+                if stage['input'] is None:
+                    result = ops[stage['op']](stage, None)
+                else:
+                    result = ops[stage['op']](stage, self._get(stage['input']))
+                    if self._last_use[stage['input']] == idx:
+                        self._release(stage['input'])
+                if stage['op'] in ACTIVATION_OPS and 'out' in stage:
+                    result.save(stage['out'], stage.get('dtype'), stage.get('layout'),
+                                stage.get('compress', 'gzip'))
+
+                if stage['name'] in self._last_use:
+                    self._results[stage['name']] = result
+                    self._limit(tmp_dir)
+                else:
+                    results[stage['name']] = result
+                if verbose:
+                    print('Finish {0} ({1}): cost {2:.2f} seconds'.format(
+                        stage['name'], stage['op'], time.time() - time1))
+
+            # the spill files are removed below, so the results mustn't read them lazily
+            spill_files = [os.path.abspath(fname) for fname in self._spill_files]
+            for result in results.values():
+                if not isinstance(result, Activation):
+                    continue
+                for layer in result.layers:
+                    data = result.get(layer)
+                    if isinstance(data, LazyArray) and \
+                            os.path.abspath(data.fname) in spill_files:
+                        result.set(layer, np.asarray(data))
+        finally:
+            for name in list(self._spilled):
+                self._release(name)
+            self._results.clear()
+            for fname in self._spill_files:
+                if os.path.exists(fname):
+                    os.remove(fname)
+            self._spill_files.clear()
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir)
+            self._dnns.clear()
+
+        return results
+
+    def _get(self, name):
+        """
+        Get a result kept in memory or spilled to the disk
+        """
+        if name in self._spilled:
+            activation = Activation()
+            activation.load(self._spilled[name][0], lazy=True)
+            return activation
+        return self._results[name]
+
+    def _release(self, name):
+        """
+        Release a result which will not be used any more
+        A temporary spill file is removed at the end of self.run(),
+        since results of later stages may still read it lazily.
+        """
+        self._results.pop(name, None)
+        if name in self._spilled:
+            fname, temporary = self._spilled.pop(name)
+            if temporary:
+                self._spill_files.append(fname)
+
+    def _limit(self, tmp_dir):
+        """
+        Spill the largest activation until the kept ones fit in the budget
+        """
+        if self.budget is None:
+            return
+        spill_dir = tmp_dir if self.spill_dir is None else self.spill_dir
+        budget = self.budget * 2**20
+        sizes = dict((k, activation_nbytes(v)) for k, v in self._results.items()
+                     if isinstance(v, Activation))
+        total = sum(sizes.values())
+        for name in sorted(sizes, key=sizes.get, reverse=True):
+            if total <= budget:
+                break
+            stage = self.stages[[s['name'] for s in self.stages].index(name)]
+            if 'out' in stage and stage.get('dtype') is None:
+                # reload from the saved output
+                self._spilled[name] = (stage['out'], False)
+            else:
+                if not os.path.isdir(spill_dir):
+                    os.makedirs(spill_dir)
+                fname = pjoin(spill_dir, '{}.act.h5'.format(name))
+                self._results[name].save(fname)
+                self._spilled[name] = (fname, True)
+            self._results.pop(name)
+            total -= sizes[name]
+
+    @staticmethod
+    def _masked(stage, activation):
+        if stage['dmask'] is None:
+            return activation
+        return activation.mask(stage['dmask'])
+
+    def _act(self, stage, activation):
+        from dnnbrain.dnn.models import DNN_REGISTRY
+
+        # the DNN is shared among stages
+        key = (stage['net'], stage.get('compile', False))
+        if key not in self._dnns:
+            dnn = DNN_REGISTRY[stage['net']]()
+            if stage.get('compile', False):
+                dnn.compile()
+            self._dnns[key] = dnn
+        stimuli = Stimulus()
+        stimuli.load(stage['stim'])
+        return self._dnns[key].compute_activation(
+            stimuli, stage['dmask'], stage.get('pool'), stage.get('cuda', False),
+            batch_size=stage.get('batch_size', 8), n_worker=stage.get('n_worker'),
+            cache=stage.get('cache', False), draft=not stage.get('exact', False))
+
+    def _load(self, stage, activation):
+        activation = Activation()
+        activation.load(stage['act'], stage['dmask'], lazy=True)
+        return activation
+
+    def _mask(self, stage, activation):
+        return self._masked(stage, activation)
+
+    def _pool(self, stage, activation):
+        return self._masked(stage, activation).pool(stage['meth'])
+
+    def _fe(self, stage, activation):
+        return self._masked(stage, activation).fe(stage['meth'], stage['n_feat'],
+                                                  stage.get('axis'))
+
+    def _hrf(self, stage, activation):
+        stimuli = Stimulus()
+        stimuli.load(stage['stim'])
+        return self._masked(stage, activation).convolve_hrf(
+            stimuli.get('onset'), stimuli.get('duration'), stage['n_vol'],
+            stage['tr'], stage.get('ops', 100))
+
+    def _encode(self, stage, activation):
+        from dnnbrain.brain.core import BrainEncoder
+
+        resp, resp_info = load_response(stage['resp'], stage.get('roi'),
+                                        stage.get('bmask'))
+        if stage['op'] == 'encode':
+            encoder = BrainEncoder(resp, stage['anal'], stage['model'], stage.get('cv', 3),
+                                   stage.get('scoring', 'explained_variance'))
+        else:
+            encoder = BrainEncoder(resp, 'uv', 'corr')
+        encode_dict = encoder.encode_dnn(self._masked(stage, activation),
+                                         stage.get('iteraxis'))
+        if 'out' in stage:
+            save_mapping(encode_dict, stage['out'], resp_info, stage.get('iteraxis'),
+                         stage['op'] == 'corr')
+
+        return encode_dict
+
@@ -0,0 +1,103 @@
+import os
+import json
+import pytest
+import numpy as np
+
+from os.path import join as pjoin
+from dnnbrain.dnn.core import Activation, Mask
+from dnnbrain.brain.core import ROI, BrainEncoder
+from dnnbrain.utils import pipeline as db_pipeline
+
+TMP_DIR = pjoin(os.path.expanduser('~'), '.dnnbrain_tmp')
+if not os.path.isdir(TMP_DIR):
+    os.makedirs(TMP_DIR)
+
+
+def test_pipeline():
+
+    # prepare activation
+    act_file = pjoin(TMP_DIR, 'test_pipeline.act.h5')
+    activation = Activation()
+    activation.set('conv5', np.random.randn(20, 8, 6, 6).astype(np.float32))
+    activation.set('fc3', np.random.randn(20, 10, 1, 1).astype(np.float32))
+    activation.save(act_file)
+    pool_file = pjoin(TMP_DIR, 'test_pipeline_pool.act.h5')
+    stages = [
+        {'name': 'load', 'op': 'load', 'act': act_file},
+        {'name': 'mask', 'op': 'mask', 'layer': ['conv5'], 'chn': [1, 3, 5]},
+        {'name': 'pool', 'op': 'pool', 'input': 'load', 'meth': 'max', 'out': pool_file},
+        {'name': 'fe', 'op': 'fe', 'input': 'mask', 'meth': 'hist', 'n_feat': 4,
+         'axis': 'chn'}
+    ]
+
+    # assert with the chain of commands
+    dmask = Mask('conv5', channels=[1, 3, 5])
+    activation_fe = activation.mask(dmask).fe('hist', 4, 'chn')
+    activation_pool = activation.pool('max')
+    results = db_pipeline.Pipeline(stages).run()
+    assert list(results.keys()) == ['pool', 'fe']
+    for layer in activation.layers:
+        np.testing.assert_equal(results['pool'].get(layer), activation_pool.get(layer))
+    np.testing.assert_equal(results['fe'].get('conv5'), activation_fe.get('conv5'))
+
+    # only the stages with 'out' are saved
+    activation_file = Activation()
+    activation_file.load(pool_file)
+    for layer in activation.layers:
+        np.testing.assert_equal(activation_file.get(layer), activation_pool.get(layer))
+
+    # spill the intermediate activation to the disk
+    spill_dir = pjoin(TMP_DIR, 'test_pipeline_spill')
+    pipe_file = pjoin(TMP_DIR, 'test_pipeline.json')
+    json.dump({'budget': 0, 'spill_dir': spill_dir, 'stages': stages}, open(pipe_file, 'w'))
+    config = db_pipeline.load_pipeline(pipe_file)
+    results = db_pipeline.Pipeline(config['stages'], config['budget'],
+                                   config['spill_dir']).run()
+    for layer in activation.layers:
+        np.testing.assert_equal(results['pool'].get(layer), activation_pool.get(layer))
+    np.testing.assert_equal(results['fe'].get('conv5'), activation_fe.get('conv5'))
+    assert os.listdir(spill_dir) == []
+
+    # the spilled activation is reloaded lazily, but the results don't refer to it
+    stages_spill = [stages[0], {'name': 'pool', 'op': 'pool', 'meth': 'max'},
+                    {'name': 'mask', 'op': 'mask', 'layer': ['conv5'], 'chn': [1, 3, 5]},
+                    {'name': 'fe', 'op': 'fe', 'input': 'pool', 'meth': 'hist', 'n_feat': 4,
+                     'axis': 'chn'}]
+    results = db_pipeline.Pipeline(stages_spill, 0, spill_dir).run()
+    assert isinstance(results['mask'].get('conv5'), np.ndarray)
+    np.testing.assert_equal(results['mask'].get('conv5'),
+                            activation_pool.mask(dmask).get('conv5'))
+    np.testing.assert_equal(results['fe'].get('fc3'),
+                            activation_pool.fe('hist', 4, 'chn').get('fc3'))
+    assert os.listdir(spill_dir) == []
+
+    # assert invalid stages
+    with pytest.raises(ValueError):
+        db_pipeline.Pipeline([{'op': 'pool', 'meth': 'max'}])
+    with pytest.raises(ValueError):
+        db_pipeline.Pipeline([stages[0], {'op': 'pool', 'input': 'act', 'meth': 'max'}])
+    with pytest.raises(ValueError):
+        db_pipeline.Pipeline([stages[0], {'op': 'rsa'}])
+
+
+def test_pipeline_corr():
+
+    # prepare activation and brain response
+    act_file = pjoin(TMP_DIR, 'test_pipeline_corr.act.h5')
+    activation = Activation()
+    activation.set('fc3', np.random.randn(20, 10, 1, 1))
+    activation.save(act_file)
+    roi_file = pjoin(TMP_DIR, 'test_pipeline.roi.h5')
+    roi = ROI(['roi1', 'roi2'], np.random.randn(20, 2))
+    roi.save(roi_file)
+    out_dir = pjoin(TMP_DIR, 'test_pipeline_corr')
+    stages = [{'op': 'load', 'act': act_file},
+              {'name': 'corr', 'op': 'corr', 'resp': roi_file, 'iteraxis': 'channel',
+               'out': out_dir}]
+
+    # assert
+    results = db_pipeline.Pipeline(stages).run()
+    encode_dict = BrainEncoder(roi.data, 'uv', 'corr').encode_dnn(activation, 'channel')
+    np.testing.assert_equal(results['corr']['fc3']['score'], encode_dict['fc3']['score'])
+    np.testing.assert_equal(np.load(pjoin(out_dir, 'fc3', 'channel', 'location.npy')),
+                            encode_dict['fc3']['location'])
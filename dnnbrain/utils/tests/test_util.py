@@ -1,4 +1,5 @@
 import os
+import cv2
 import pytest
 import numpy as np
 
@@ -61,6 +62,58 @@ def test_gen_dmask():
     assert dmask.get('fc3')['chn'] == [1, 2, 3]
 
 
+def test_get_frame_time_info():
+
+    # prepare a video with 25 frames
+    vid_file = pjoin(TMP_DIR, 'test_frame_time.avi')
+    writer = cv2.VideoWriter(vid_file, cv2.VideoWriter_fourcc(*'MJPG'), 10, (32, 24))
+    for _ in range(25):
+        writer.write(np.zeros((24, 32, 3), np.uint8))
+    writer.release()
+
+    frame_nums, onsets, durations = db_util.get_frame_time_info(vid_file, 0, 2)
+    assert frame_nums == list(range(1, 26, 2))
+    np.testing.assert_almost_equal(durations, [0.2] * 13)
+    np.testing.assert_almost_equal(onsets, np.arange(13) * 0.2)
+
+    # get segment plans
+    frame_nums, _, _, segments = db_util.get_frame_time_info(vid_file, 0, 2, n_segment=3)
+    assert segments == [(0, 5), (5, 9), (9, 13)]
+
+
+def test_save_mapping():
+
+    from dnnbrain.brain.core import ROI
+
+    # prepare brain response and the mapping
+    roi_file = pjoin(TMP_DIR, 'test_save_mapping.roi.h5')
+    ROI(['roi1', 'roi2'], np.random.randn(10, 2)).save(roi_file)
+    resp, resp_info = db_util.load_response(roi_file, ['roi2'])
+    assert resp.shape == (10, 1)
+    assert resp_info == {'rois': ['roi2']}
+    encode_dict = {'fc3': {'score': np.random.rand(4, 1),
+                           'location': np.ones((4, 1, 3), dtype=int)}}
+
+    # db_corr saves scores of ROIs as a .csv file
+    out_dir = pjoin(TMP_DIR, 'test_save_mapping')
+    db_util.save_mapping(encode_dict, out_dir, resp_info, 'channel', corr=True)
+    with open(pjoin(out_dir, 'fc3', 'channel', 'score.csv')) as rf:
+        lines = rf.read().split('\n')
+    assert lines[0] == 'roi2'
+    np.testing.assert_almost_equal([float(line) for line in lines[1:]],
+                                   encode_dict['fc3']['score'][:, 0])
+    np.testing.assert_equal(np.load(pjoin(out_dir, 'fc3', 'channel', 'location.npy')),
+                            encode_dict['fc3']['location'])
+
+    # db_encode saves each item as a .npy file
+    db_util.save_mapping(encode_dict, out_dir, resp_info)
+    np.testing.assert_equal(np.load(pjoin(out_dir, 'fc3', 'score.npy')),
+                            encode_dict['fc3']['score'])
+
+    with pytest.raises(IOError):
+        db_util.load_response('resp.txt')
+
+
 def test_normalize():
 
     # prepare
@@ -1,10 +1,12 @@
-import cv2
+import os
 import numpy as np
 
+from os.path import join as pjoin
 from dnnbrain.dnn.core import Mask
 
 
-def get_frame_time_info(vid_file, original_onset, interval=1, before_vid=0, after_vid=0):
+def get_frame_time_info(vid_file, original_onset, interval=1, before_vid=0, after_vid=0,
+                        n_segment=None):
     """
     Extract frames of interest from a video with their onsets and durations,
     according to the experimental design.
@@ -23,6 +25,9 @@ def get_frame_time_info(vid_file, original_onset, interval=1, before_vid=0, afte
         Display the first frame as a static picture for 'before_vid' seconds before video.
     after_vid : float 
         Display the last frame as a static picture for 'after_vid' seconds after video.
+    n_segment : int
+        If is not None, split the frames of interest into n_segment contiguous
+        segments, so that each segment can be decoded sequentially by a worker.
 
     Returns
     --------
@@ -32,7 +37,13 @@ def get_frame_time_info(vid_file, original_onset, interval=1, before_vid=0, afte
         Onsets of the frames of interest.
     durations : list 
         Durations of the frames of interest.
+    segments : list
+        Only returned when n_segment is not None.
+        Each element is a tuple as (start, stop), which means the segment
+        contains frame_nums[start:stop].
     """
+    import cv2
+
     assert isinstance(interval, int) and interval > 0, "Parameter 'interval' must be a positive integer!"
 
     # load video information
@@ -54,7 +65,41 @@ def get_frame_time_info(vid_file, original_onset, interval=1, before_vid=0, afte
     for d in durations[:-1]:
         onsets.append(onsets[-1] + d)
 
-    return frame_nums, onsets, durations
+    if n_segment is None:
+        return frame_nums, onsets, durations
+    else:
+        segments = gen_segments(len(frame_nums), n_segment)
+        return frame_nums, onsets, durations, segments
+
+
+def gen_segments(n_item, n_segment, unit=1):
+    """
+    Split items into contiguous segments
+
+    Parameters
+    ----------
+    n_item : int
+        The number of items
+    n_segment : int
+        The number of segments.
+        There are fewer segments if there are fewer units than n_segment.
+    unit : int
+        Boundaries of segments are multiples of unit, except the last one.
+
+    Returns
+    -------
+    segments : list
+        Each element is a tuple as (start, stop) which means the segment
+        contains items from start to stop-1.
+    """
+    n_unit = int(np.ceil(n_item / unit))
+    segments = []
+    for units in np.array_split(np.arange(n_unit), n_segment):
+        if len(units) == 0:
+            continue
+        segments.append((int(units[0]) * unit, min(int(units[-1] + 1) * unit, n_item)))
+
+    return segments
 
 
 def gen_dmask(layers=None, channels='all', dmask_file=None):
@@ -110,6 +155,129 @@ def gen_dmask(layers=None, channels='all', dmask_file=None):
     return dmask
 
 
+def load_response(fname, rois=None, bmask_file=None):
+    """
+    Load brain response to be mapped from DNN activation,
+    as db_encode and db_corr do
+
+    Parameters
+    ----------
+    fname : str
+        A .roi.h5 file or a nifti/cifti file
+    rois : list
+        Only used for the .roi.h5 file.
+        Names of the ROIs of interest. Default is all ROIs.
+    bmask_file : str
+        Only used for the nifti/cifti file.
+        A brain mask file, whose nonzero voxels/vertices are used.
+        Default is using the voxels/vertices with nonzero response.
+
+    Returns
+    -------
+    resp : ndarray
+        Brain response with shape as (n_vol, n_meas)
+    resp_info : dict
+        Information used by save_mapping() to save results in the space
+        of the response.
+        'rois' for the .roi.h5 file;
+        'header', 'bshape', 'bmask' and 'suffix' for the nifti/cifti file.
+    """
+    if fname.endswith('.roi.h5'):
+        from dnnbrain.brain.core import ROI
+
+        roi = ROI()
+        roi.load(fname, rois)
+        return roi.data, {'rois': roi.rois}
+
+    elif fname.endswith('.nii') or fname.endswith('.nii.gz'):
+        from dnnbrain.brain.io import load_brainimg
+
+        resp, header = load_brainimg(fname)
+        bshape = resp.shape[1:]
+        if bmask_file is None:
+            bmask = np.any(resp, 0)
+        else:
+            bmask, _ = load_brainimg(bmask_file, ismask=True)
+            assert bshape == bmask.shape, 'brain mask and brain response mismatched in space'
+            bmask = bmask.astype(bool)
+        resp_info = {'header': header, 'bshape': bshape, 'bmask': bmask,
+                     'suffix': '.'.join(os.path.basename(fname).split('.')[1:])}
+        return resp[:, bmask], resp_info
+
+    else:
+        raise IOError('Only .roi.h5 and nifti/cifti are supported')
+
+
+def save_mapping(encode_dict, out_dir, resp_info, iteraxis=None, corr=False):
+    """
+    Save the mapping from DNN activation to brain response,
+    as db_encode and db_corr do
+
+    Parameters
+    ----------
+    encode_dict : dict
+        Returned by BrainEncoder.encode_dnn()
+    out_dir : str
+        The output directory. Results of each layer are saved in
+        <out_dir>/<layer>, or <out_dir>/<layer>/<iteraxis>.
+    resp_info : dict
+        Returned by load_response()
+    iteraxis : str
+        The axis along which the mapping was iterated
+    corr : bool
+        If true, save the correlation as db_corr does:
+        scores of ROIs are saved as score.csv, and only scores and
+        locations are saved.
+        Otherwise, save the encoding as db_encode does:
+        all cross validation scores are saved, and their means are saved
+        as an image of the brain response.
+    """
+    for layer, data in encode_dict.items():
+        # prepare directory
+        trg_dir = pjoin(out_dir, layer)
+        if iteraxis is not None:
+            trg_dir = pjoin(trg_dir, iteraxis)
+        if not os.path.isdir(trg_dir):
+            os.makedirs(trg_dir)
+
+        if 'rois' in resp_info:
+            if corr:
+                lines = [','.join(resp_info['rois'])]
+                for row in data['score']:
+                    lines.append(','.join(map(str, row)))
+                with open(pjoin(trg_dir, 'score.csv'), 'w') as wf:
+                    wf.write('\n'.join(lines))
+                np.save(pjoin(trg_dir, 'location'), data['location'])
+            else:
+                for k, v in data.items():
+                    np.save(pjoin(trg_dir, k), v)
+            continue
+
+        from dnnbrain.brain.io import save_brainimg
+
+        bshape, bmask = resp_info['bshape'], resp_info['bmask']
+        bshape_pos = list(range(1, len(bshape)+1))
+        for k, v in data.items():
+            if k == 'model':
+                if corr:
+                    continue
+                arr = np.zeros((v.shape[0], *bshape), dtype=object)
+                arr[:, bmask] = v
+                np.save(pjoin(trg_dir, k), arr.transpose((*bshape_pos, 0)))
+                continue
+            if k == 'location' or not corr:
+                # save locations or all cross validation scores
+                arr = np.zeros((v.shape[0], *bshape, v.shape[-1]))
+                arr[:, bmask, :] = v
+                np.save(pjoin(trg_dir, k), arr.transpose((*bshape_pos, 0, -1)))
+            if k == 'score':
+                # save mean scores of each cross validation
+                img = np.zeros((v.shape[0], *bshape))
+                img[:, bmask] = v if corr else np.mean(v, 2)
+                save_brainimg(pjoin(trg_dir, '{}.{}'.format(k, resp_info['suffix'])),
+                              img, resp_info['header'])
+
+
 def normalize(array):
     """
     Normalize an array's value domain to [0, 1]